@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Benchmark the analysis stages on synthetic CHI workbooks.
+
+Each stage is timed on its own (median of --repeat runs) and then run once
+more under tracemalloc for its peak Python memory. Results are written as
+JSON to benchmark_results/ so runs can be compared:
+
+    python benchmark-stages.py --customers 1000,10000 --months 12
+    python benchmark-stages.py --customers 10000 --compare benchmark_results/<earlier run>.json
+    python benchmark-stages.py --workbook my-chi.xlsx          # benchmark a real workbook
+
+Stages: read_sheet1, header_detection, classify, summarize_tables,
+parse_dated_sheets, history_counts (per threshold), create_trend_chart,
+export_excel, export_pdf.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core  # noqa: E402
+from chi_workbook_generator import generate_workbook  # noqa: E402
+
+RESULTS_DIR = "benchmark_results"
+
+
+def build_stages(data: bytes, threshold: float):
+    """Ordered (name, setup, fn) triples; setup prepares inputs untimed, fn is the measured stage"""
+    ctx = {}
+
+    def read_sheet1():
+        ctx["raw"] = pd.read_excel(io.BytesIO(data), sheet_name=core.SHEET1_NAME, header=None)
+
+    def header_detection():
+        scanned, _ = core._first_nonempty_row_as_header(ctx["raw"], start_row=0, end_row=20)
+        scanned.columns = core._normalize_colnames(list(scanned.columns))
+
+    def prepare_work():
+        sheet1 = core.load_sheet1(data)
+        sec_cols = [c for c in sheet1[0].columns if "security score" in c.lower()]
+        ctx["cols"] = (sheet1[1], sec_cols[1], sec_cols[0], sheet1[2])
+        ctx["work"] = core.build_sheet1_frame(sheet1, sec_cols[1], sec_cols[0])
+
+    def classify():
+        _, col_prev, col_curr, col_overall = ctx["cols"]
+        ctx["tables"] = core.classify(ctx["work"], col_prev, col_curr, col_overall, threshold=threshold)
+
+    def summarize_tables():
+        col_customer, col_prev, col_curr, _ = ctx["cols"]
+        ctx["summary"] = core.summarize_tables(ctx["tables"], col_customer, col_prev, col_curr)
+
+    def parse_dated_sheets():
+        ctx["sheets"] = core.dated_sheets(core.list_sheet_names(data))
+        ctx["frames"] = [core.load_dated_sheet(data, sheet) for sheet in ctx["sheets"]]
+
+    def history_counts():
+        ctx["history"] = core.history_from_sheets(*ctx["frames"], sheets=ctx["sheets"], threshold=threshold)
+
+    def prepare_monthly():
+        ctx["monthly"] = core.calculate_monthly_changes(ctx["history"], ctx["tables"])
+
+    def create_trend_chart():
+        core.create_trend_chart(ctx["monthly"])
+
+    def export_excel():
+        core.export_excel(ctx["tables"], ctx["summary"])
+
+    def export_pdf():
+        core.export_pdf(ctx["tables"], ctx["summary"], analysis_summary="Benchmark run")
+
+    stages = [(read_sheet1, None), (header_detection, None), (classify, prepare_work),
+              (summarize_tables, None), (parse_dated_sheets, None), (history_counts, None),
+              (create_trend_chart, prepare_monthly),
+              (export_excel, None)]
+    if core.PDF_AVAILABLE:
+        stages.append((export_pdf, None))
+    return [(fn.__name__, setup, fn) for fn, setup in stages]
+
+
+def benchmark_workbook(path: str, repeat: int, threshold: float) -> list:
+    """Time and memory-profile every stage on one workbook"""
+    with open(path, "rb") as f:
+        data = f.read()
+    results = []
+    for name, setup, fn in build_stages(data, threshold):
+        if setup is not None:
+            setup()
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            durations.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({"stage": name, "seconds": statistics.median(durations), "peak_mb": peak / 1e6})
+        print(f"   {name:<24} {statistics.median(durations) * 1000:10.1f} ms {peak / 1e6:10.1f} MB")
+    return results
+
+
+def compare(current: dict, baseline_path: str):
+    """Print per-stage time and memory ratios against an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base = {(r["workbook"], r["stage"]): r for r in baseline["results"]}
+    print(f"\n📊 Compared with {baseline_path} ({baseline['meta']['timestamp']})")
+    for r in current["results"]:
+        old = base.get((r["workbook"], r["stage"]))
+        if old is None:
+            continue
+        t_ratio = r["seconds"] / old["seconds"] if old["seconds"] else float("nan")
+        m_ratio = r["peak_mb"] / old["peak_mb"] if old["peak_mb"] else float("nan")
+        flag = "⚠️" if t_ratio > 1.2 else "✅"
+        print(f"{flag} {r['workbook']:<24} {r['stage']:<24} time x{t_ratio:5.2f}  memory x{m_ratio:5.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", default="1000,10000", help="comma-separated customer counts")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--workbook", action="append", default=[], help="benchmark an existing workbook instead")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=42.0)
+    parser.add_argument("--output", default=None, help=f"results file (default: {RESULTS_DIR}/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    run = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "app_version": core.APP_VERSION,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "machine": platform.machine(),
+            "repeat": args.repeat,
+            "threshold": args.threshold,
+        },
+        "results": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workbooks = list(args.workbook)
+        if not workbooks:
+            for n in [int(x) for x in args.customers.split(",") if x]:
+                path = os.path.join(tmp, f"chi-{n}x{args.months}.xlsx")
+                start = time.perf_counter()
+                generate_workbook(path, customers=n, months=args.months)
+                print(f"🧪 Generated {n} customers x {args.months} months in {time.perf_counter() - start:.1f}s")
+                workbooks.append(path)
+
+        for path in workbooks:
+            print(f"⏱️  {os.path.basename(path)} ({os.path.getsize(path) / 1e6:.1f} MB)")
+            for r in benchmark_workbook(path, args.repeat, args.threshold):
+                run["results"].append({"workbook": os.path.basename(path), **r})
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\n💾 Results saved to {output}")
+
+    if args.compare:
+        compare(run, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2068 @@
+"""
+CHI analysis core
+
+Parsing, classification, trends, exports and the memoized stage pipeline of
+the CHI Low Security Score Analyzer, without any Streamlit UI. The page
+(chi_low_security_score_analyzer.py), the HTTP analysis service and the stage
+benchmarks all import this module, so importing it runs no page code.
+Process-wide state (stage cache, customer dictionary, span totals) lives in
+module-level singletons, which persist across page reruns.
+"""
+
+import hashlib
+import html
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+# Version information
+try:
+    from version import get_version
+    APP_VERSION = get_version()
+except ImportError:
+    APP_VERSION = "1.0.0"
+
+# PDF generation imports
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib import colors
+    from reportlab.lib.units import inch
+    PDF_AVAILABLE = True
+    PDF_IMPORT_ERROR = None
+except ImportError as e:
+    PDF_AVAILABLE = False
+    PDF_IMPORT_ERROR = e
+
+logger = logging.getLogger('chi_analysis_core')
+
+# -------------------------------
+# Performance Instrumentation
+# -------------------------------
+
+# Process-wide totals of timed spans (pipeline stages here, q calls and
+# reruns on the page). The page adds per-session rerun records on top.
+class PerfRegistry:
+    """Process-wide span and rerun totals, shared by all sessions and threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans = {}    # (kind, name, outcome) -> [count, seconds]
+        self.reruns = {}   # label -> [count, seconds, last seconds]
+
+    def observe(self, kind: str, name: str, outcome: str, seconds: float):
+        with self._lock:
+            totals = self.spans.setdefault((kind, name, outcome), [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def observe_rerun(self, label: str, seconds: float):
+        with self._lock:
+            totals = self.reruns.setdefault(label, [0, 0.0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = seconds
+
+    def prometheus_text(self) -> str:
+        """Totals in the Prometheus text exposition format"""
+        def labels(**kv):
+            escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"') for k, v in kv.items()}
+            return ",".join(f'{k}="{v}"' for k, v in escaped.items())
+
+        with self._lock:
+            spans = sorted(self.spans.items())
+            reruns = sorted(self.reruns.items())
+        lines = ["# HELP chi_span_seconds_total Time spent in instrumented spans",
+                 "# TYPE chi_span_seconds_total counter"]
+        lines += [f"chi_span_seconds_total{{{labels(kind=k, name=n, outcome=o)}}} {v[1]:.6f}"
+                  for (k, n, o), v in spans]
+        lines += ["# HELP chi_spans_total Number of instrumented spans",
+                  "# TYPE chi_spans_total counter"]
+        lines += [f"chi_spans_total{{{labels(kind=k, name=n, outcome=o)}}} {v[0]}" for (k, n, o), v in spans]
+        lines += ["# HELP chi_rerun_seconds_total Wall time of script and fragment reruns",
+                  "# TYPE chi_rerun_seconds_total counter"]
+        lines += [f"chi_rerun_seconds_total{{{labels(run=r)}}} {v[1]:.6f}" for r, v in reruns]
+        lines += ["# HELP chi_reruns_total Number of script and fragment reruns",
+                  "# TYPE chi_reruns_total counter"]
+        lines += [f"chi_reruns_total{{{labels(run=r)}}} {v[0]}" for r, v in reruns]
+        lines += ["# HELP chi_last_rerun_seconds Wall time of the most recent rerun",
+                  "# TYPE chi_last_rerun_seconds gauge"]
+        lines += [f"chi_last_rerun_seconds{{{labels(run=r)}}} {v[2]:.6f}" for r, v in reruns]
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str, rerun: Dict):
+        """Append the rerun to a .jsonl file, or atomically rewrite the Prometheus textfile"""
+        if path.endswith('.jsonl'):
+            with self._lock, open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(rerun) + "\n")
+            return
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
+
+_perf_registry = PerfRegistry()
+
+
+def get_perf_registry() -> PerfRegistry:
+    """The single PerfRegistry for this process"""
+    return _perf_registry
+
+
+@contextmanager
+def perf_span(name: str, kind: str = 'stage', tracker=None):
+    """Time the block into the process totals and, when given, a session's rerun tracker.
+
+    Callers may set span['outcome'] (default 'ok', 'error' on exceptions).
+    """
+    span = {'outcome': 'ok'}
+    start = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        span['outcome'] = 'error'
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        get_perf_registry().observe(kind, name, span['outcome'], seconds)
+        if tracker is not None:
+            tracker.record(kind, name, span['outcome'], start, seconds)
+
+
+# -------------------------------
+# Utility helpers
+# -------------------------------
+
+def _first_nonempty_row_as_header(df: pd.DataFrame, search_cols: List[str] = None, start_row: int = 0, end_row: int = 20) -> Tuple[pd.DataFrame, int]:
+    """Try to find the header row by scanning a range of rows.
+    We look for a row that contains all keywords in `search_cols` (case-insensitive, substring match).
+    Returns (cleaned_df, header_row_index_in_original_df)
+    """
+    search_cols = search_cols or ["Customer", "Security", "Overall"]
+    header_idx_found = None
+    for i in range(start_row, min(len(df), end_row)):
+        row_vals = df.iloc[i].astype(str).fillna("")
+        hits = 0
+        for key in search_cols:
+            if any(key.lower() in str(v).lower() for v in row_vals.values):
+                hits += 1
+        if hits >= max(2, len(search_cols) - 1):  # heuristic: at least 2 hits
+            header_idx_found = i
+            break
+
+    if header_idx_found is None:
+        # fallback to the provided header row (commonly 3) without changes
+        header_idx_found = start_row
+
+    new_df = df.copy()
+    new_df.columns = new_df.iloc[header_idx_found].astype(str)
+    new_df = new_df.iloc[header_idx_found + 1 :].reset_index(drop=True)
+    # drop fully-empty columns
+    new_df = new_df.dropna(axis=1, how="all")
+    return new_df, header_idx_found
+
+
+def _coerce_numeric(series: pd.Series) -> pd.Series:
+    if pd.api.types.is_numeric_dtype(series):
+        return series
+    return pd.to_numeric(series, errors="coerce")
+
+
+def _is_score_col(col: str) -> bool:
+    return re.search(r"security score|overall score", col, flags=re.I) is not None
+
+
+def _is_customer_col(col: str) -> bool:
+    return col.lower().strip() == "customer"
+
+
+# Label columns analyses can be segmented by, matched by name (case-insensitive)
+SEGMENT_COLUMNS = [c.strip().lower() for c in os.environ.get('CHI_SEGMENT_COLUMNS', 'TAM,Region,Segment').split(',')
+                   if c.strip()]
+
+
+def _is_dimension_col(col: str) -> bool:
+    return col.strip().lower() in SEGMENT_COLUMNS and not _is_score_col(col) and not _is_customer_col(col)
+
+
+def dimension_columns(df: pd.DataFrame) -> List[str]:
+    """Segmentable columns of a compacted frame"""
+    return [c for c in df.columns if _is_dimension_col(c)]
+
+
+def compact_chi_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Keep only the columns the analysis reads, in compact dtypes.
+
+    Called once right after header detection: score columns become float64
+    (never narrower, so a score just under the threshold stays under it),
+    customer names and the SEGMENT_COLUMNS label columns categorical.
+    Working frames widen the labels back with astype(object) so results and
+    exports are unchanged.
+    """
+    unique = ~df.columns.duplicated()
+    keep = [i for i, c in enumerate(df.columns)
+            if unique[i] and (_is_score_col(c) or _is_customer_col(c) or _is_dimension_col(c))]
+    out = df.iloc[:, keep].copy()
+    for i, col in enumerate(out.columns):
+        if _is_score_col(col):
+            out.isetitem(i, pd.to_numeric(out.iloc[:, i], errors="coerce").astype("float64"))
+        else:
+            out.isetitem(i, out.iloc[:, i].astype("category"))
+    return out
+
+
+def _normalize_colnames(cols: List[str]) -> List[str]:
+    return [re.sub(r"\s+", " ", c).strip() for c in cols]
+
+
+# -------------------------------
+# Category logic
+# -------------------------------
+
+def calculate_low_score_metrics(df: pd.DataFrame, col_prev: str, col_curr: str, threshold: float = 42) -> Dict[str, int]:
+    """Calculate overall low security score metrics for trend analysis"""
+    work = df.copy()
+    work[col_prev] = _coerce_numeric(work[col_prev])
+    work[col_curr] = _coerce_numeric(work[col_curr])
+    
+    # Count customers with low scores in previous month (excluding NaN)
+    prev_low_count = len(work[(work[col_prev] < threshold) & work[col_prev].notna()])
+    
+    # Count customers with low scores in current month (excluding NaN)
+    curr_low_count = len(work[(work[col_curr] < threshold) & work[col_curr].notna()])
+    
+    # Calculate improvement metrics
+    improvement_count = prev_low_count - curr_low_count
+    if prev_low_count > 0:
+        improvement_percentage = (improvement_count / prev_low_count) * 100
+    else:
+        improvement_percentage = 0
+    
+    return {
+        "prev_month_low_total": prev_low_count,
+        "curr_month_low_total": curr_low_count,
+        "improvement_count": improvement_count,
+        "improvement_percentage": improvement_percentage
+    }
+
+def classify(df: pd.DataFrame, col_prev: str, col_curr: str, col_overall: str, threshold: float = 42) -> Dict[str, pd.DataFrame]:
+    """Classify customers into 4 categories based on previous vs current scores.
+
+    Definitions used:
+      - Exit from Red:     prev < threshold  AND curr >= threshold
+      - Return Back to Red:prev >= threshold AND curr < threshold
+      - New Comer to Red:  prev is NaN       AND curr < threshold
+      - Missing from CHI:  Overall Score is NaN (regardless of prev/curr)
+    """
+    work = df.copy()
+    work[col_prev] = _coerce_numeric(work[col_prev])
+    work[col_curr] = _coerce_numeric(work[col_curr])
+    if col_overall in work.columns:
+        work[col_overall] = _coerce_numeric(work[col_overall])
+    else:
+        work[col_overall] = pd.NA
+
+    exit_from_red = work[(work[col_prev] < threshold) & (work[col_curr] >= threshold)]
+    return_back_red = work[(work[col_prev] >= threshold) & (work[col_curr] < threshold)]
+    new_comer_red = work[work[col_prev].isna() & (work[col_curr] < threshold)]
+    missing_from_chi = work[work[col_overall].isna()]
+
+    return {
+        "Exit from Red": exit_from_red,
+        "Return Back to Red": return_back_red,
+        "New Comer to Red": new_comer_red,
+        "Missing from CHI": missing_from_chi,
+    }
+
+
+def summarize_tables(tables: Dict[str, pd.DataFrame], col_customer: str, col_prev: str, col_curr: str) -> pd.DataFrame:
+    rows = []
+    for cat, dfc in tables.items():
+        if dfc is None or dfc.empty:
+            continue
+        for _, r in dfc[[col_customer, col_prev, col_curr]].fillna("").iterrows():
+            rows.append({
+                "Category": cat,
+                "Customer": r[col_customer],
+                "Prev Score": r[col_prev],
+                "Curr Score": r[col_curr],
+            })
+    return pd.DataFrame(rows)
+
+
+def dated_sheets(sheet_names: List[str]) -> List[str]:
+    """Date-named sheets (e.g. "2025-04-07") in chronological order; Sheet1 and other sheets are skipped"""
+    sheets = [s for s in sheet_names if s != SHEET1_NAME and sheet_month(s)]
+    return sorted(sheets, key=sheet_month)
+
+
+def history_from_sheets(*frames: pd.DataFrame, sheets: List[str], threshold: float = 42) -> pd.DataFrame:
+    """Per-month low-score counts of parsed dated sheets (frames in the order of sheets).
+
+    Only this counting depends on the threshold; the frames are the cached
+    parse_sheet stages, so a threshold change does not re-read the workbook.
+    """
+    historical_data = []
+    for sheet_name, sheet_df in zip(sheets, frames):
+        sec_col = find_security_col(list(sheet_df.columns))
+        if sec_col is None:
+            continue
+        scores = sheet_df[sec_col].to_numpy(dtype="float64")
+        low_score_count = int(np.count_nonzero(scores < threshold))
+        total_customers = int(np.count_nonzero(~np.isnan(scores)))
+        date_obj = pd.to_datetime(sheet_name)
+        historical_data.append({
+            'date': date_obj,
+            'month_label': date_obj.strftime('%Y-%m'),
+            'sheet_name': sheet_name,
+            'low_score_customers': low_score_count,
+            'total_customers': total_customers,
+            'low_score_percentage': (low_score_count / total_customers * 100) if total_customers > 0 else 0
+        })
+        logger.debug("Processed %s: %s low-score customers out of %s", sheet_name, low_score_count, total_customers)
+    return pd.DataFrame(historical_data)
+
+
+def extract_historical_data(xls: pd.ExcelFile, threshold: float = 42) -> pd.DataFrame:
+    """Extract historical trend data from all sheets in the Excel file"""
+    sheets, frames = [], []
+    for sheet_name in dated_sheets(xls.sheet_names):
+        try:
+            frames.append(_parse_dated_frame(pd.read_excel(xls, sheet_name=sheet_name, header=None)))
+            sheets.append(sheet_name)
+        except Exception as e:
+            logger.warning("Could not process sheet %s: %s", sheet_name, e)
+    logger.info("Found %s dated sheets for trend analysis", len(sheets))
+    return history_from_sheets(*frames, sheets=sheets, threshold=threshold)
+
+def calculate_monthly_changes(historical_df: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """Calculate month-over-month changes including exits and returns"""
+    if len(historical_df) < 2:
+        return historical_df
+    
+    # Add change metrics
+    historical_df = historical_df.copy()
+    historical_df['exit_from_red'] = 0
+    historical_df['return_to_red'] = 0
+    historical_df['net_change'] = 0
+    
+    # Calculate changes for each month (except the first)
+    for i in range(1, len(historical_df)):
+        prev_count = historical_df.iloc[i-1]['low_score_customers']
+        curr_count = historical_df.iloc[i]['low_score_customers']
+        net_change = prev_count - curr_count
+        
+        historical_df.loc[i, 'net_change'] = net_change
+        
+        # For the latest month, use actual data from classification
+        if i == len(historical_df) - 1:
+            historical_df.loc[i, 'exit_from_red'] = len(tables.get("Exit from Red", []))
+            historical_df.loc[i, 'return_to_red'] = len(tables.get("Return Back to Red", []))
+        else:
+            # Estimate based on net change (simplified)
+            if net_change > 0:
+                historical_df.loc[i, 'exit_from_red'] = max(0, net_change)
+            else:
+                historical_df.loc[i, 'return_to_red'] = max(0, abs(net_change))
+    
+    return historical_df
+
+def create_trend_chart(historical_df: pd.DataFrame) -> go.Figure:
+    """Create a comprehensive trend chart from historical data"""
+    
+    if historical_df.empty:
+        # Create empty chart with message
+        fig = go.Figure()
+        fig.add_annotation(
+            text="No historical data available for trend analysis",
+            xref="paper", yref="paper",
+            x=0.5, y=0.5, xanchor='center', yanchor='middle',
+            showarrow=False, font=dict(size=16)
+        )
+        return fig
+    
+    # Create the figure
+    fig = go.Figure()
+    
+    # Add Low Score Customers trend line (red)
+    fig.add_trace(go.Scatter(
+        x=historical_df['month_label'],
+        y=historical_df['low_score_customers'],
+        mode='lines+markers',
+        name='Low Score Customers (<42)',
+        line=dict(color='red', width=3),
+        marker=dict(size=8),
+        hovertemplate='<b>%{x}</b><br>Low Score Customers: %{y}<extra></extra>'
+    ))
+    
+    # Add Exit from Red trend line (green)
+    fig.add_trace(go.Scatter(
+        x=historical_df['month_label'],
+        y=historical_df['exit_from_red'],
+        mode='lines+markers',
+        name='Exit from Red (Improved)',
+        line=dict(color='green', width=3),
+        marker=dict(size=8),
+        hovertemplate='<b>%{x}</b><br>Exits from Red: %{y}<extra></extra>'
+    ))
+    
+    # Add Return to Red trend line (orange)
+    fig.add_trace(go.Scatter(
+        x=historical_df['month_label'],
+        y=historical_df['return_to_red'],
+        mode='lines+markers',
+        name='Return Back to Red',
+        line=dict(color='orange', width=3),
+        marker=dict(size=8),
+        hovertemplate='<b>%{x}</b><br>Returns to Red: %{y}<extra></extra>'
+    ))
+    
+    # Update layout
+    fig.update_layout(
+        title={
+            'text': 'Security Score Historical Trends',
+            'x': 0.5,
+            'xanchor': 'center',
+            'font': {'size': 20}
+        },
+        xaxis_title='Month',
+        yaxis_title='Number of Customers',
+        hovermode='x unified',
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        ),
+        height=500,
+        showlegend=True,
+        xaxis=dict(tickangle=45)
+    )
+    
+    # Add trend annotations for the latest month
+    if len(historical_df) > 1:
+        latest = historical_df.iloc[-1]
+        previous = historical_df.iloc[-2]
+        change = latest['low_score_customers'] - previous['low_score_customers']
+        
+        fig.add_annotation(
+            x=latest['month_label'],
+            y=latest['low_score_customers'],
+            text=f"Latest: {latest['low_score_customers']} customers<br>Change: {change:+d}",
+            showarrow=True,
+            arrowhead=2,
+            arrowcolor="red" if change > 0 else "green",
+            bgcolor="white",
+            bordercolor="red" if change > 0 else "green"
+        )
+    
+    return fig
+
+def export_excel(tables: Dict[str, pd.DataFrame], summary_df: pd.DataFrame, movers=None, streaks=None,
+                 segments=None) -> bytes:
+    """Excel report: summary, one sheet per category and optionally TopMovers / RedZoneStreaks /
+    SegmentAnalysis tables"""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        summary_df.to_excel(writer, index=False, sheet_name="Summary")
+        sheets = dict(tables)
+        if streaks is not None:
+            sheets["Red-Zone Streaks"] = streaks.table
+        if movers is not None:
+            sheets["Top Improvers"] = movers.improvers
+            sheets["Top Decliners"] = movers.decliners
+        if segments is not None:
+            sheets["Segments"] = segments.matrix
+            sheets["Segment Trends"] = segments.trends.reset_index()
+            sheets.update(segment_sheets(tables, segments))
+        for name, dfc in sheets.items():
+            (dfc if not dfc.empty else pd.DataFrame({"Message": ["No records"]})) \
+                .to_excel(writer, index=False, sheet_name=name[:31])
+    output.seek(0)
+    return output.read()
+
+
+def export_pdf(tables: Dict[str, pd.DataFrame], summary_df: pd.DataFrame, 
+               analysis_summary: str = "", ai_summary: str = "", 
+               chat_history: List[Tuple[str, str]] = None, chat_digest: str = "") -> bytes:
+    """Export analysis results to PDF format with rich web-like layout including Amazon Q chat history"""
+    if not PDF_AVAILABLE:
+        raise ImportError("reportlab is required for PDF export. Install with: pip install reportlab")
+    
+    output = io.BytesIO()
+    
+    # Use A4 portrait for better readability
+    doc = SimpleDocTemplate(output, pagesize=A4, 
+                          rightMargin=0.75*inch, leftMargin=0.75*inch,
+                          topMargin=0.75*inch, bottomMargin=0.75*inch)
+    
+    # Enhanced styles matching web layout
+    styles = getSampleStyleSheet()
+    
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=20,
+        spaceAfter=20,
+        alignment=1,  # Center alignment
+        textColor=colors.darkblue,
+        fontName='Helvetica-Bold'
+    )
+    
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Normal'],
+        fontSize=12,
+        spaceAfter=15,
+        alignment=1,
+        textColor=colors.grey,
+        fontName='Helvetica'
+    )
+    
+    heading_style = ParagraphStyle(
+        'CustomHeading',
+        parent=styles['Heading2'],
+        fontSize=14,
+        spaceAfter=10,
+        spaceBefore=15,
+        textColor=colors.darkblue,
+        fontName='Helvetica-Bold',
+        borderWidth=1,
+        borderColor=colors.lightblue,
+        borderPadding=5,
+        backColor=colors.lightblue
+    )
+    
+    subheading_style = ParagraphStyle(
+        'CustomSubheading',
+        parent=styles['Heading3'],
+        fontSize=12,
+        spaceAfter=8,
+        spaceBefore=10,
+        textColor=colors.darkgreen,
+        fontName='Helvetica-Bold'
+    )
+    
+    normal_style = ParagraphStyle(
+        'CustomNormal',
+        parent=styles['Normal'],
+        fontSize=10,
+        spaceAfter=6,
+        fontName='Helvetica'
+    )
+    
+    metric_style = ParagraphStyle(
+        'MetricStyle',
+        parent=styles['Normal'],
+        fontSize=11,
+        spaceAfter=4,
+        fontName='Helvetica-Bold',
+        textColor=colors.darkred
+    )
+    
+    # Build content with rich layout
+    story = []
+    
+    # Header section
+    story.append(Paragraph("🔍 CHI Low Security Score Analysis Report", title_style))
+    story.append(Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", subtitle_style))
+    story.append(Spacer(1, 20))
+    
+    # Executive Summary Box
+    story.append(Paragraph("📊 Executive Summary", heading_style))
+    
+    # Calculate key metrics
+    total_customers = len(summary_df) if not summary_df.empty else 0
+    exit_red_count = len(tables.get('Exit from Red', []))
+    return_red_count = len(tables.get('Return Back to Red', []))
+    new_red_count = len(tables.get('New Comer to Red', []))
+    missing_count = len(tables.get('Missing from CHI', []))
+    
+    # Key metrics in a highlighted box
+    metrics_data = [
+        ['📈 Total Customers Analyzed', str(total_customers)],
+        ['✅ Customers Exiting Red Zone', f"{exit_red_count} ({(exit_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
+        ['⚠️ Customers Returning to Red', f"{return_red_count} ({(return_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
+        ['🆕 New Customers in Red Zone', f"{new_red_count} ({(new_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
+        ['❓ Missing from CHI', f"{missing_count} ({(missing_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"]
+    ]
+    
+    metrics_table = Table(metrics_data, colWidths=[4*inch, 2*inch])
+    metrics_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, -1), colors.lightblue),
+        ('TEXTCOLOR', (0, 0), (-1, -1), colors.darkblue),
+        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, -1), 11),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+        ('TOPPADDING', (0, 0), (-1, -1), 8),
+        ('GRID', (0, 0), (-1, -1), 1, colors.darkblue),
+        ('ROWBACKGROUNDS', (0, 0), (-1, -1), [colors.lightblue, colors.white])
+    ]))
+    story.append(metrics_table)
+    story.append(Spacer(1, 20))
+    
+    # Analysis Summary (if provided)
+    if analysis_summary:
+        story.append(Paragraph("📋 Analysis Summary", heading_style))
+        story.append(Paragraph(analysis_summary, normal_style))
+        story.append(Spacer(1, 15))
+    
+    # AI Summary (if available)
+    if ai_summary:
+        story.append(Paragraph("🤖 AI-Generated Insights", heading_style))
+        # Clean and format AI summary with better formatting
+        clean_summary = ai_summary.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
+        # Add some styling to the AI summary
+        ai_summary_style = ParagraphStyle(
+            'AISummary',
+            parent=normal_style,
+            backColor=colors.lightyellow,
+            borderColor=colors.orange,
+            borderWidth=1,
+            borderPadding=10,
+            fontSize=10
+        )
+        story.append(Paragraph(clean_summary, ai_summary_style))
+        story.append(Spacer(1, 20))
+    
+    # Amazon Q Chat History (if available)
+    if (chat_history and len(chat_history) > 0) or chat_digest:
+        story.append(Paragraph("💬 Amazon Q Chat History & Improvements", heading_style))
+        
+        # Chat history styles
+        question_style = ParagraphStyle(
+            'ChatQuestion',
+            parent=normal_style,
+            backColor=colors.lightblue,
+            borderColor=colors.blue,
+            borderWidth=1,
+            borderPadding=8,
+            fontSize=9,
+            fontName='Helvetica-Bold'
+        )
+        
+        answer_style = ParagraphStyle(
+            'ChatAnswer',
+            parent=normal_style,
+            backColor=colors.lightgrey,
+            borderColor=colors.darkgrey,
+            borderWidth=1,
+            borderPadding=8,
+            fontSize=9,
+            leftIndent=20
+        )
+        
+        # Earlier turns compacted into a digest
+        if chat_digest:
+            clean_digest = html.escape(chat_digest, quote=False).replace('\n', '<br/>')
+            story.append(Paragraph(f"<b>Earlier conversation (summarized):</b><br/>{clean_digest}", normal_style))
+            story.append(Spacer(1, 10))
+        
+        for i, (question, answer) in enumerate(chat_history or []):
+            # Add chat number
+            story.append(Paragraph(f"<b>Chat {i+1}:</b>", normal_style))
+            story.append(Spacer(1, 5))
+            
+            # Add question
+            clean_question = question.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
+            story.append(Paragraph(f"<b>Question:</b> {clean_question}", question_style))
+            story.append(Spacer(1, 5))
+            
+            # Add answer
+            clean_answer = answer.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
+            story.append(Paragraph(f"<b>Amazon Q Response:</b><br/>{clean_answer}", answer_style))
+            story.append(Spacer(1, 15))
+        
+        story.append(Spacer(1, 20))
+    
+    # Detailed Customer Analysis by Category
+    story.append(Paragraph("👥 Detailed Customer Analysis", heading_style))
+    
+    # Create detailed sections for each category
+    category_configs = [
+        ('Exit from Red', '✅', colors.green, 'Customers who improved their security scores'),
+        ('Return Back to Red', '⚠️', colors.orange, 'Customers whose security scores deteriorated'),
+        ('New Comer to Red', '🆕', colors.red, 'New customers with low security scores'),
+        ('Missing from CHI', '❓', colors.grey, 'Customers missing from current analysis')
+    ]
+    
+    for category, emoji, color, description in category_configs:
+        df = tables.get(category, pd.DataFrame())
+        
+        # Category header
+        story.append(Paragraph(f"{emoji} {category}", subheading_style))
+        story.append(Paragraph(description, normal_style))
+        
+        if not df.empty and 'Customer' in df.columns:
+            # Show customer count
+            story.append(Paragraph(f"Total customers: {len(df)}", metric_style))
+            
+            # Create customer table with additional details if available
+            customer_data = [['Customer Name']]
+            
+            # Add score columns if available
+            if 'Security Score (Current)' in df.columns:
+                customer_data[0].append('Current Score')
+            if 'Security Score (Previous)' in df.columns:
+                customer_data[0].append('Previous Score')
+            if 'Change' in df.columns:
+                customer_data[0].append('Change')
+            
+            # Add customer rows (limit to 20 for space)
+            for idx, row in df.head(20).iterrows():
+                customer_row = [str(row.get('Customer', 'N/A'))]
+                
+                if 'Security Score (Current)' in df.columns:
+                    current_score = row.get('Security Score (Current)', 'N/A')
+                    customer_row.append(f"{current_score:.1f}" if isinstance(current_score, (int, float)) else str(current_score))
+                
+                if 'Security Score (Previous)' in df.columns:
+                    prev_score = row.get('Security Score (Previous)', 'N/A')
+                    customer_row.append(f"{prev_score:.1f}" if isinstance(prev_score, (int, float)) else str(prev_score))
+                
+                if 'Change' in df.columns:
+                    change = row.get('Change', 'N/A')
+                    if isinstance(change, (int, float)):
+                        change_str = f"{change:+.1f}"
+                        customer_row.append(change_str)
+                    else:
+                        customer_row.append(str(change))
+                
+                customer_data.append(customer_row)
+            
+            # Show "and X more..." if there are more customers
+            if len(df) > 20:
+                more_row = [f"... and {len(df) - 20} more customers"] + [''] * (len(customer_data[0]) - 1)
+                customer_data.append(more_row)
+            
+            # Create table
+            if len(customer_data) > 1:
+                # Calculate column widths
+                num_cols = len(customer_data[0])
+                if num_cols == 1:
+                    col_widths = [6*inch]
+                elif num_cols == 2:
+                    col_widths = [4*inch, 2*inch]
+                elif num_cols == 3:
+                    col_widths = [3*inch, 1.5*inch, 1.5*inch]
+                else:
+                    col_widths = [2.5*inch, 1.2*inch, 1.2*inch, 1.1*inch]
+                
+                customer_table = Table(customer_data, colWidths=col_widths)
+                customer_table.setStyle(TableStyle([
+                    ('BACKGROUND', (0, 0), (-1, 0), color),
+                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+                    ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
+                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+                    ('FONTSIZE', (0, 0), (-1, 0), 10),
+                    ('FONTSIZE', (0, 1), (-1, -1), 9),
+                    ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+                    ('TOPPADDING', (0, 1), (-1, -1), 4),
+                    ('BOTTOMPADDING', (0, 1), (-1, -1), 4),
+                    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
+                    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
+                ]))
+                story.append(customer_table)
+        else:
+            story.append(Paragraph("No customers in this category", normal_style))
+        
+        story.append(Spacer(1, 15))
+    
+    # Add footer
+    story.append(Spacer(1, 20))
+    footer_style = ParagraphStyle(
+        'Footer',
+        parent=normal_style,
+        fontSize=8,
+        alignment=1,
+        textColor=colors.grey
+    )
+    story.append(Paragraph("Generated by CHI Low Security Score Analyzer", footer_style))
+    story.append(Paragraph("For internal use only - Contains confidential customer information", footer_style))
+    
+    # Build PDF with enhanced layout
+    doc.build(story)
+    output.seek(0)
+    return output.read()
+
+
+# -------------------------------
+# Analysis pipeline
+# -------------------------------
+
+SHEET1_NAME = "Sheet1"
+
+
+def load_sheet1(data: bytes) -> Tuple[pd.DataFrame, str, str]:
+    """Parse Sheet1 with header detection.
+
+    Returns (scanned_df, customer_column, overall_column); customer_column is
+    None when no 'Customer' column exists. The overall column is added as NA
+    when the sheet has none. The frame is compacted (see compact_chi_frame).
+    """
+    raw = pd.read_excel(io.BytesIO(data), sheet_name=SHEET1_NAME, header=None)
+    # Heuristic: find header row between 0..20
+    scanned, _ = _first_nonempty_row_as_header(raw, start_row=0, end_row=20)
+    scanned.columns = _normalize_colnames(list(scanned.columns))
+    scanned = compact_chi_frame(scanned)
+
+    cust_candidates = [c for c in scanned.columns if _is_customer_col(c)]
+    col_customer = cust_candidates[0] if cust_candidates else None
+
+    # Overall Score (optional)
+    overall_candidates = [c for c in scanned.columns if c.lower().strip() == "overall score"]
+    col_overall = overall_candidates[0] if overall_candidates else "Overall Score"
+    if col_overall not in scanned.columns:
+        scanned[col_overall] = np.nan
+    return scanned, col_customer, col_overall
+
+
+def _parse_dated_frame(tmp_raw: pd.DataFrame) -> pd.DataFrame:
+    tmp_df, _ = _first_nonempty_row_as_header(tmp_raw, start_row=0, end_row=20)
+    tmp_df.columns = _normalize_colnames(list(tmp_df.columns))
+    return compact_chi_frame(tmp_df)
+
+
+def load_dated_sheet(data: bytes, sheet: str) -> pd.DataFrame:
+    """Parse one dated sheet with header detection, compacted like Sheet1"""
+    return _parse_dated_frame(pd.read_excel(io.BytesIO(data), sheet_name=sheet, header=None))
+
+
+def list_sheet_names(data: bytes) -> List[str]:
+    return pd.ExcelFile(io.BytesIO(data)).sheet_names
+
+
+def find_security_col(cols: List[str]) -> str:
+    """Find the likely security score column (the first match)"""
+    candidates = [c for c in cols if re.search(r"security score", c, flags=re.I)]
+    if not candidates:
+        return None
+    return candidates[0]
+
+
+def build_sheet1_frame(sheet1: Tuple[pd.DataFrame, str, str], col_prev: str, col_curr: str,
+                       segment_col: str = None) -> pd.DataFrame:
+    """Mode A working frame from load_sheet1() output: customer, segment (optional), overall and the two
+    chosen score columns"""
+    scanned, col_customer, col_overall = sheet1
+    segment = {segment_col: scanned[segment_col].astype(object)} if segment_col else {}
+    return pd.DataFrame({
+        col_customer: scanned[col_customer].astype(object),
+        **segment,
+        col_overall: scanned[col_overall].to_numpy(dtype="float64"),
+        col_prev: scanned[col_prev].to_numpy(dtype="float64"),
+        col_curr: scanned[col_curr].to_numpy(dtype="float64"),
+    }, index=scanned.index)
+
+
+class CustomerDictionary:
+    """Interns customer names to stable int32 IDs.
+
+    Names are keyed exactly as they appear in the sheet (no trimming or case
+    folding), so joining on IDs matches a join on the name column. An ID
+    never changes for the lifetime of the dictionary, so per-sheet ID arrays
+    can be cached and joined across sheets on integers instead of strings.
+    Missing names map to MISSING.
+    """
+
+    MISSING = -1
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._names_array = np.empty(0, dtype=object)
+        self._lock = threading.Lock()
+        self.token = hashlib.sha1(f"{id(self)}:{time.time()}".encode('utf-8')).hexdigest()[:12]
+
+    def __repr__(self):
+        # Stage keys include this, so cached IDs are never mixed across dictionaries
+        return f"CustomerDictionary({self.token})"
+
+    def __len__(self):
+        return len(self._names)
+
+    def encode(self, names: pd.Series) -> np.ndarray:
+        """Map a column of names to IDs; only distinct names touch the dictionary"""
+        codes, uniques = pd.factorize(names.astype(object), use_na_sentinel=True)
+        with self._lock:
+            lookup = np.empty(len(uniques), dtype=np.int32)
+            for i, name in enumerate(uniques):
+                cid = self._ids.get(name)
+                if cid is None:
+                    cid = self._ids[name] = len(self._names)
+                    self._names.append(name)
+                lookup[i] = cid
+        ids = np.full(len(codes), self.MISSING, dtype=np.int32)
+        valid = codes >= 0
+        ids[valid] = lookup[codes[valid]]
+        return ids
+
+    def decode(self, ids: np.ndarray) -> np.ndarray:
+        """Map IDs back to names (NaN for MISSING)"""
+        with self._lock:
+            if len(self._names_array) != len(self._names):
+                self._names_array = np.array(self._names + [np.nan], dtype=object)
+            names = self._names_array
+        return names[np.where(ids == self.MISSING, len(names) - 1, ids)]
+
+    def sort_rank(self, ids: np.ndarray) -> np.ndarray:
+        """Per-row rank that orders rows by name (MISSING last), sorting only the distinct IDs"""
+        uniques, inverse = np.unique(ids, return_inverse=True)
+        names = self.decode(uniques)
+        present = uniques != self.MISSING
+        order = np.argsort(names[present].astype(str), kind="stable")
+        ranks = np.full(len(uniques), len(uniques), dtype=np.int64)
+        ranks[np.flatnonzero(present)[order]] = np.arange(order.size)
+        return ranks[inverse]
+
+
+CUSTOMER_DICTIONARY_MAX_NAMES = int(os.environ.get('CHI_CUSTOMER_DICT_MAX', '2000000'))
+
+
+class CustomerDictionaryHolder:
+    """Hands out the current CustomerDictionary, replacing it once it grows past max_names.
+
+    Stage keys include the dictionary's token, so results encoded with a
+    retired dictionary are never joined with new IDs; they are recomputed on
+    demand and the old entries age out of the shared cache. Callers should
+    fetch the dictionary once per run and pass it along.
+    """
+
+    def __init__(self, max_names: int = CUSTOMER_DICTIONARY_MAX_NAMES):
+        self.max_names = max_names
+        self.replaced = 0
+        self._dictionary = CustomerDictionary()
+        self._lock = threading.Lock()
+
+    def current(self) -> CustomerDictionary:
+        with self._lock:
+            if len(self._dictionary) > self.max_names:
+                logger.info("Customer dictionary reached %s names; starting a new one", len(self._dictionary))
+                self._dictionary = CustomerDictionary()
+                self.replaced += 1
+            return self._dictionary
+
+_customer_dictionary_holder = CustomerDictionaryHolder()
+
+
+def get_customer_dictionary_holder() -> CustomerDictionaryHolder:
+    return _customer_dictionary_holder
+
+
+def get_customer_dictionary() -> CustomerDictionary:
+    """The process-wide customer dictionary shared by all sessions and workbooks (bounded, see holder)"""
+    return get_customer_dictionary_holder().current()
+
+
+def encode_customers(df: pd.DataFrame, col_customer: str, dictionary: CustomerDictionary) -> np.ndarray:
+    """Customer ID array for one parsed sheet (MISSING where the sheet has no such column)"""
+    if col_customer not in df.columns:
+        return np.full(len(df), CustomerDictionary.MISSING, dtype=np.int32)
+    return dictionary.encode(df[col_customer])
+
+
+def merge_dated_sheets(df_prev: pd.DataFrame, df_curr: pd.DataFrame, prev_ids: np.ndarray, curr_ids: np.ndarray,
+                       col_customer: str, col_overall: str, dictionary: CustomerDictionary,
+                       segment_col: str = None) -> pd.DataFrame:
+    """Mode B working frame: outer merge by customer with __prev__ / __curr__ score columns.
+
+    The join runs on interned customer IDs (see encode_customers); rows come
+    back ordered by customer name, as a string-keyed outer merge would. The
+    segment column, if any, is taken from the current sheet and falls back
+    to the previous one.
+    """
+    prev_sec_col = find_security_col(list(df_prev.columns))
+    curr_sec_col = find_security_col(list(df_curr.columns))
+    if not prev_sec_col or not curr_sec_col:
+        raise ValueError("Could not detect 'Security Score' column in one or both selected sheets.")
+
+    # Build the join inputs from arrays without touching the (cached) input frames
+    curr_part = df_curr.reindex(columns=[col_overall])
+    left = pd.DataFrame({"__cid__": prev_ids, "__prev__": df_prev[prev_sec_col].to_numpy(dtype="float64")})
+    right = pd.DataFrame({"__cid__": curr_ids, col_overall: curr_part[col_overall].to_numpy(dtype="float64"),
+                          "__curr__": df_curr[curr_sec_col].to_numpy(dtype="float64")})
+    if segment_col:
+        left["__seg_prev__"] = df_prev.reindex(columns=[segment_col])[segment_col].to_numpy(dtype=object)
+        right["__seg_curr__"] = df_curr.reindex(columns=[segment_col])[segment_col].to_numpy(dtype=object)
+    merged = pd.merge(left, right, on="__cid__", how="outer")
+    if segment_col:
+        segment = merged.pop("__seg_curr__").fillna(merged.pop("__seg_prev__"))
+        merged.insert(0, segment_col, segment)
+
+    cids = merged.pop("__cid__").to_numpy()
+    order = np.argsort(dictionary.sort_rank(cids), kind="stable")
+    merged = merged.iloc[order].reset_index(drop=True)
+    merged.insert(0, col_customer, dictionary.decode(cids[order]))
+    return merged
+
+
+CATEGORY_NAMES = ["Exit from Red", "Return Back to Red", "New Comer to Red", "Missing from CHI"]
+CATEGORY_SORTS = {
+    "Sheet order": None,
+    "Customer (A→Z)": ("name", True),
+    "Customer (Z→A)": ("name", False),
+    "Biggest drop first": ("delta", True),
+    "Biggest gain first": ("delta", False),
+}
+CATEGORY_DELTA_FILTERS = ["All", "Improved (Δ > 0)", "Declined (Δ < 0)", "No change / unknown"]
+
+
+class CategoryIndex(NamedTuple):
+    """Display frame for one category plus precomputed sort orders and search keys"""
+    frame: pd.DataFrame          # display columns incl. "Score Δ"
+    name_keys: pd.Series         # lower-cased customer names, aligned with frame
+    order_name: "np.ndarray"     # row positions sorted by customer name
+    order_delta: "np.ndarray"    # row positions sorted by delta (NaN last)
+
+
+def build_category_indexes(tables: Dict[str, pd.DataFrame], col_customer: str, col_prev: str,
+                           col_curr: str, col_overall: str) -> Dict[str, CategoryIndex]:
+    """Build a searchable, presorted index per category so pages can be served without re-sorting"""
+    indexes = {}
+    for name, dfc in tables.items():
+        if dfc is None or dfc.empty:
+            indexes[name] = None
+            continue
+        show_cols = [c for c in [col_customer, col_prev, col_curr, col_overall] if c in dfc.columns]
+        frame = dfc[show_cols].rename(columns={col_prev: "Prev Score", col_curr: "Curr Score",
+                                               col_customer: "Customer", col_overall: "Overall Score"})
+        frame = frame.reset_index(drop=True)
+        frame["Score Δ"] = (_coerce_numeric(frame["Curr Score"]) - _coerce_numeric(frame["Prev Score"])).round(1)
+        name_keys = frame["Customer"].astype(str).str.lower()
+        indexes[name] = CategoryIndex(
+            frame=frame,
+            name_keys=name_keys,
+            order_name=np.argsort(name_keys.to_numpy(), kind="stable"),
+            order_delta=np.argsort(frame["Score Δ"].to_numpy(dtype=float, na_value=np.nan), kind="stable"),
+        )
+    return indexes
+
+
+def query_category_page(index: CategoryIndex, search: str = "", sort: str = "Sheet order",
+                        delta_filter: str = "All", page: int = 1, page_size: int = 50) -> Tuple[pd.DataFrame, int]:
+    """Filter, sort and slice one category; returns (page_frame, matching_row_count)"""
+    n = len(index.frame)
+    mask = np.ones(n, dtype=bool)
+    if search:
+        mask &= index.name_keys.str.contains(search.lower(), regex=False).to_numpy()
+    if delta_filter != "All":
+        delta = index.frame["Score Δ"].to_numpy(dtype=float, na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            if delta_filter == CATEGORY_DELTA_FILTERS[1]:
+                mask &= delta > 0
+            elif delta_filter == CATEGORY_DELTA_FILTERS[2]:
+                mask &= delta < 0
+            else:
+                mask &= ~(delta > 0) & ~(delta < 0)
+
+    sort_spec = CATEGORY_SORTS.get(sort)
+    if sort_spec is None:
+        positions = np.flatnonzero(mask)
+    else:
+        field, ascending = sort_spec
+        order = index.order_name if field == "name" else index.order_delta
+        positions = order[mask[order]]
+        if not ascending:
+            if field == "delta":
+                # keep unknown deltas (sorted last) at the end when reversing
+                known = ~np.isnan(index.frame["Score Δ"].to_numpy(dtype=float, na_value=np.nan)[positions])
+                positions = np.concatenate([positions[known][::-1], positions[~known]])
+            else:
+                positions = positions[::-1]
+
+    total = len(positions)
+    start = max(0, (page - 1) * page_size)
+    return index.frame.iloc[positions[start:start + page_size]], total
+
+
+TOP_MOVERS_K = int(os.environ.get('CHI_TOP_MOVERS', '25'))
+
+
+class TopMovers(NamedTuple):
+    """Largest score gains and drops between the compared months"""
+    improvers: pd.DataFrame   # biggest Score Δ first
+    decliners: pd.DataFrame   # most negative Score Δ first
+    compared: int             # customers with both scores
+
+
+def _top_k(values: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k largest values, largest first (partial selection, then a sort of only k)"""
+    picked = np.argpartition(-values, k - 1)[:k] if 0 < k < len(values) else np.arange(min(k, len(values)))
+    return picked[np.lexsort((picked, -values[picked]))]
+
+
+def find_top_movers(work: pd.DataFrame, col_customer: str, col_prev: str, col_curr: str, col_overall: str,
+                    k: int = TOP_MOVERS_K) -> TopMovers:
+    """Top-k improvers (Score Δ > 0) and decliners (Score Δ < 0); rows missing either score
+    or with no change are skipped, so either side may have fewer than k rows.
+
+    Uses argpartition, so cost is linear in the number of customers and only
+    the 2k selected rows are sorted. Independent of the threshold.
+    """
+    delta = work[col_curr].to_numpy(dtype=float) - work[col_prev].to_numpy(dtype=float)
+    valid = ~np.isnan(delta)
+    gains, drops = np.flatnonzero(valid & (delta > 0)), np.flatnonzero(valid & (delta < 0))
+
+    def movers(positions: np.ndarray) -> pd.DataFrame:
+        rows = work.iloc[positions]
+        return pd.DataFrame({
+            "Customer": rows[col_customer].to_numpy(),
+            "Prev Score": rows[col_prev].to_numpy(),
+            "Curr Score": rows[col_curr].to_numpy(),
+            "Overall Score": rows[col_overall].to_numpy() if col_overall in rows.columns else np.nan,
+            "Score Δ": delta[positions].round(1),
+        })
+
+    return TopMovers(improvers=movers(gains[_top_k(delta[gains], min(k, len(gains)))]),
+                     decliners=movers(drops[_top_k(-delta[drops], min(k, len(drops)))]),
+                     compared=int(valid.sum()))
+
+
+def format_top_movers(movers: TopMovers, n: int = 5) -> str:
+    """Short text listing of the biggest movers for AI prompts"""
+    def listing(df: pd.DataFrame) -> str:
+        top = df.head(n)
+        return ", ".join(f"{name} ({delta:+.1f})" for name, delta in zip(top["Customer"], top["Score Δ"])) or "none"
+    return f"Biggest score gains: {listing(movers.improvers)}\nBiggest score drops: {listing(movers.decliners)}"
+
+
+class MonthBitsets(NamedTuple):
+    """Per-month customer bitsets over one workbook's customer universe.
+
+    Bit i of every row stands for customer ids[i] (interned IDs, sorted);
+    row m is months[m]. Rows are uint64 words, so comparing two months is a
+    handful of bitwise ops and popcounts regardless of how they are spaced.
+    A customer with several rows in a sheet is counted once.
+    """
+    months: List[str]
+    ids: np.ndarray
+    present: np.ndarray       # has a row in the month's sheet
+    scored: np.ndarray        # has a Security Score
+    red: np.ndarray           # Security Score < threshold
+    has_overall: np.ndarray   # has an Overall Score
+
+
+def _pack_bits(mask: np.ndarray) -> np.ndarray:
+    """Bool mask -> little-endian uint64 words, zero-padded to a multiple of 64 bits"""
+    padded = np.zeros(-(-len(mask) // 64) * 64, dtype=bool)
+    padded[:len(mask)] = mask
+    return np.packbits(padded, bitorder="little").view(np.uint64)
+
+
+def _unpack_bits(words: np.ndarray, n: int) -> np.ndarray:
+    return np.unpackbits(words.view(np.uint8), bitorder="little")[:n].astype(bool)
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """Set bits per row (sum over the last axis)"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return np.unpackbits(words.view(np.uint8), axis=-1).sum(axis=-1, dtype=np.int64)
+
+
+def build_month_bitsets(*parts, sheets: List[str], col_overall: str, threshold: float) -> MonthBitsets:
+    """Bitsets from the parsed dated sheets followed by their customer ID arrays (same order as sheets)"""
+    frames, id_arrays = parts[:len(sheets)], parts[len(sheets):]
+    valid_ids = [ids[ids != CustomerDictionary.MISSING] for ids in id_arrays]
+    universe = np.unique(np.concatenate(valid_ids)) if valid_ids else np.empty(0, dtype=np.int32)
+    rows = {"present": [], "scored": [], "red": [], "has_overall": []}
+    for df, ids in zip(frames, id_arrays):
+        valid = ids != CustomerDictionary.MISSING
+        pos = np.searchsorted(universe, ids[valid])
+        sec_col = find_security_col(list(df.columns))
+        scores = df[sec_col].to_numpy(dtype="float64")[valid] if sec_col else np.full(pos.size, np.nan)
+        overall = (df[col_overall].to_numpy(dtype="float64")[valid] if col_overall in df.columns
+                   else np.full(pos.size, np.nan))
+        masks = {"present": np.ones(pos.size, dtype=bool), "scored": ~np.isnan(scores),
+                 "red": scores < threshold, "has_overall": ~np.isnan(overall)}
+        for name, mask in masks.items():
+            member = np.zeros(universe.size, dtype=bool)
+            member[pos[mask]] = True
+            rows[name].append(_pack_bits(member))
+    width = -(-universe.size // 64)
+    stack = {name: np.vstack(r) if r else np.empty((0, width), dtype=np.uint64) for name, r in rows.items()}
+    return MonthBitsets(list(sheets), universe, **stack)
+
+
+def _category_words(bits: MonthBitsets, a: int, b) -> Dict[str, np.ndarray]:
+    """classify()'s categories for prev month a vs curr month(s) b as bit words.
+
+    Each expression ANDs at least one non-negated row, so padding bits stay 0.
+    """
+    return {
+        "Exit from Red": bits.red[a] & bits.scored[b] & ~bits.red[b],
+        "Return Back to Red": bits.scored[a] & ~bits.red[a] & bits.red[b],
+        "New Comer to Red": ~bits.scored[a] & bits.red[b],
+        "Missing from CHI": (bits.present[a] | bits.present[b]) & ~bits.has_overall[b],
+    }
+
+
+def classify_month_pair(bits: MonthBitsets, a: int, b: int) -> Dict[str, int]:
+    """Distinct customers per category comparing month a (previous) with month b (current)"""
+    return {name: int(_popcount(words)) for name, words in _category_words(bits, a, b).items()}
+
+
+def month_pair_customers(bits: MonthBitsets, a: int, b: int, category: str,
+                         dictionary: CustomerDictionary) -> np.ndarray:
+    """Sorted customer names in one category for the month pair"""
+    member = _unpack_bits(_category_words(bits, a, b)[category], bits.ids.size)
+    return np.sort(dictionary.decode(bits.ids[member]).astype(str))
+
+
+def month_comparison_matrix(bits: MonthBitsets, category: str) -> pd.DataFrame:
+    """Customers in `category` for every earlier (row) vs later (column) month pair"""
+    n = len(bits.months)
+    matrix = np.full((n, n), np.nan)
+    for a in range(n - 1):
+        later = np.arange(a + 1, n)
+        matrix[a, later] = _popcount(_category_words(bits, a, later)[category])
+    return pd.DataFrame(matrix, index=bits.months, columns=bits.months)
+
+
+RED_STREAK_ALERT_MONTHS = 3   # current streaks at least this long are flagged
+
+
+class RedZoneStreaks(NamedTuple):
+    """Per-customer red-zone run statistics over a workbook's dated sheets"""
+    table: pd.DataFrame               # one row per customer that was ever red
+    months: List[str]
+    median_months_to_exit: float      # over every red spell that ended in an exit (NaN if none)
+
+
+def compute_red_streaks(bits: MonthBitsets, col_customer: str, dictionary: CustomerDictionary) -> RedZoneStreaks:
+    """Run-length encode the customers x months red matrix, all customers at once.
+
+    A spell is a run of consecutive red months. It ends in an exit when the
+    next month has a score at or above the threshold; a month without a score
+    ends the spell without counting as an exit. Re-entries are spells after
+    the first one.
+    """
+    n, m = bits.ids.size, len(bits.months)
+    red = np.zeros((n, m + 2), dtype=np.int8)
+    scored = np.zeros((n, m + 1), dtype=bool)
+    for month in range(m):
+        red[:, month + 1] = _unpack_bits(bits.red[month], n)
+        scored[:, month] = _unpack_bits(bits.scored[month], n)
+
+    # Run starts and ends in row-major order, so the k-th start pairs with the k-th end
+    edges = np.diff(red, axis=1)
+    cust, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[1]
+    length = end - start
+    exited = scored[cust, end]    # the month after the spell (end == m is the padding column)
+
+    spells = np.bincount(cust, minlength=n)
+    longest = np.zeros(n, dtype=np.int64)
+    np.maximum.at(longest, cust, length)
+    current = np.zeros(n, dtype=np.int64)
+    current[cust[end == m]] = length[end == m]
+    exit_median = pd.Series(length[exited]).groupby(cust[exited]).median()
+
+    ever = np.flatnonzero(spells)
+    order = np.lexsort((dictionary.sort_rank(bits.ids[ever]), -longest[ever], -current[ever]))
+    rows = ever[order]
+    table = pd.DataFrame({
+        col_customer: dictionary.decode(bits.ids[rows]),
+        "Current Streak": current[rows],
+        "Longest Streak": longest[rows],
+        "Red Months": np.bincount(cust, weights=length, minlength=n)[rows].astype(np.int64),
+        "Re-entries": spells[rows] - 1,
+        "Exits": np.bincount(cust[exited], minlength=n)[rows],
+        "Median Months to Exit": exit_median.reindex(rows).to_numpy(),
+    })
+    median = float(np.median(length[exited])) if exited.any() else float("nan")
+    return RedZoneStreaks(table, list(bits.months), median)
+
+
+SEGMENT_BLANK = "(blank)"
+SEGMENT_OTHER = "(not compared)"   # customers of other months that are not in the working frame
+SEGMENT_EXPORT_SHEETS = int(os.environ.get('CHI_SEGMENT_EXPORT_SHEETS', '20'))
+
+
+class SegmentAnalysis(NamedTuple):
+    """Category counts and low-score metrics per value of one dimension column"""
+    column: str
+    matrix: pd.DataFrame      # one row per segment value, largest segments first
+    trends: pd.DataFrame      # low-score customers per month (rows) and segment (columns)
+
+
+def _segment_codes(work: pd.DataFrame, segment_col: str) -> Tuple[np.ndarray, np.ndarray]:
+    """(codes, labels) for the segment column; blank values form their own segment"""
+    values = work[segment_col].astype(object)
+    return pd.factorize(values.where(values.notna(), SEGMENT_BLANK), sort=True)
+
+
+def analyze_segments(work: pd.DataFrame, bits: MonthBitsets, col_customer: str, segment_col: str, col_prev: str,
+                     col_curr: str, col_overall: str, threshold: float,
+                     dictionary: CustomerDictionary) -> SegmentAnalysis:
+    """classify() and calculate_low_score_metrics() for every segment in one grouped pass.
+
+    Each category mask is computed once over the whole frame and counted per
+    segment with np.bincount. Monthly trends count the red-zone bits of each
+    month per segment; a customer's segment is its first row in `work`.
+    """
+    codes, labels = _segment_codes(work, segment_col)
+    k = len(labels)
+    prev = _coerce_numeric(work[col_prev]).to_numpy(dtype=float)
+    curr = _coerce_numeric(work[col_curr]).to_numpy(dtype=float)
+    overall = (_coerce_numeric(work[col_overall]).to_numpy(dtype=float) if col_overall in work.columns
+               else np.full(len(work), np.nan))
+
+    def per_segment(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(codes[mask], minlength=k)
+
+    matrix = pd.DataFrame({
+        segment_col: labels,
+        "Customers": np.bincount(codes, minlength=k),
+        "Exit from Red": per_segment((prev < threshold) & (curr >= threshold)),
+        "Return Back to Red": per_segment((prev >= threshold) & (curr < threshold)),
+        "New Comer to Red": per_segment(np.isnan(prev) & (curr < threshold)),
+        "Missing from CHI": per_segment(np.isnan(overall)),
+        "Prev Low Score": per_segment(prev < threshold),
+        "Curr Low Score": per_segment(curr < threshold),
+    })
+    matrix["Improvement"] = matrix["Prev Low Score"] - matrix["Curr Low Score"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.where(matrix["Prev Low Score"] > 0, matrix["Improvement"] / matrix["Prev Low Score"] * 100, 0.0)
+    matrix["Improvement %"] = pct.round(1)
+    matrix = matrix.sort_values(["Customers", segment_col], ascending=[False, True], kind="stable")
+
+    # Segment per customer of the month bitsets' universe, first row wins (reversed so it is written last)
+    universe_codes = np.full(bits.ids.size, k)
+    if bits.ids.size:
+        ids = dictionary.encode(work[col_customer])
+        pos = np.searchsorted(bits.ids, ids).clip(max=bits.ids.size - 1)
+        found = np.flatnonzero(bits.ids[pos] == ids)[::-1]
+        universe_codes[pos[found]] = codes[found]
+    counts = np.array([np.bincount(universe_codes[_unpack_bits(words, bits.ids.size)], minlength=k + 1)
+                       for words in bits.red]).reshape(len(bits.months), k + 1)
+    trends = pd.DataFrame(counts, index=pd.Index(bits.months, name="Month"), columns=[*labels, SEGMENT_OTHER])
+    if not trends[SEGMENT_OTHER].any():
+        trends = trends.drop(columns=SEGMENT_OTHER)
+    return SegmentAnalysis(segment_col, matrix.reset_index(drop=True), trends)
+
+
+def segment_sheets(tables: Dict[str, pd.DataFrame], segments: SegmentAnalysis,
+                   limit: int = SEGMENT_EXPORT_SHEETS) -> Dict[str, pd.DataFrame]:
+    """Categorized customers of the largest segments, one frame per segment keyed by a valid sheet name"""
+    sheets = {}
+    for label in segments.matrix[segments.column].head(limit):
+        parts = []
+        for name, dfc in tables.items():
+            if dfc is None or dfc.empty or segments.column not in dfc.columns:
+                continue
+            values = dfc[segments.column].astype(object)
+            rows = dfc[values.where(values.notna(), SEGMENT_BLANK) == label]
+            parts.append(rows.assign(Category=name)[["Category", *rows.columns]])
+        sheet = re.sub(r"[\[\]:*?/\\]", "_", f"Seg {label}")[:31]
+        while sheet in sheets:
+            sheet = f"{sheet[:28]}~{len(sheets)}"
+        sheets[sheet] = (pd.concat(parts, ignore_index=True) if parts
+                         else pd.DataFrame({"Message": ["No records"]}))
+    return sheets
+
+
+class StageResult(NamedTuple):
+    """Output of a pipeline stage together with the key it was computed under"""
+    key: str
+    value: object
+    origin: str = ""      # key of the source (workbook) this result derives from
+
+
+SHARED_CACHE_MAX_MB = float(os.environ.get('CHI_SHARED_CACHE_MB', '512'))
+
+
+def _estimate_nbytes(value) -> int:
+    """Approximate in-memory size of a stage result"""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_estimate_nbytes(k) + _estimate_nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_estimate_nbytes(v) for v in value)
+    if isinstance(value, go.Figure):
+        return _figure_nbytes(value)
+    return sys.getsizeof(value)
+
+
+def _figure_nbytes(fig: go.Figure) -> int:
+    """Rough figure size from its trace data lengths, without serializing it"""
+    total = 4096
+    for trace in fig.data:
+        total += 1024
+        for name in ('x', 'y', 'z', 'text', 'customdata', 'hovertext'):
+            values = getattr(trace, name, None)
+            if values is not None and not isinstance(values, str):
+                total += 16 * len(values)
+    return total
+
+
+def _frames_copy_on_write() -> bool:
+    """Whether pandas copy-on-write is active (always in pandas 3, opt-in before)"""
+    return int(pd.__version__.split('.')[0]) >= 3 or pd.get_option('mode.copy_on_write') is True
+
+
+def _freeze(value):
+    """Make arrays inside a result read-only before it is shared"""
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+    return value
+
+
+def _shared_view(value):
+    """Per-caller view of a shared result: containers are rebuilt, frames are copied.
+
+    With copy-on-write the frame copies are shallow; without it they must be
+    deep so callers cannot modify the cached original.
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy(deep=not _frames_copy_on_write())
+    if isinstance(value, dict):
+        return {k: _shared_view(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_shared_view(v) for v in value]
+    if isinstance(value, tuple):
+        items = [_shared_view(v) for v in value]
+        return type(value)(*items) if hasattr(value, '_fields') else tuple(items)
+    if isinstance(value, go.Figure):
+        return go.Figure(value)
+    return value
+
+
+class SharedStageCache:
+    """Process-wide LRU store for stage results, shared by all sessions.
+
+    Entries are keyed by stage key (content hash of the workbook plus stage
+    parameters), so memory grows with the number of distinct workbooks and
+    parameter sets rather than with the number of users. Total size is capped
+    at max_bytes; least recently used entries are evicted first. Concurrent
+    requests for the same key compute it once and the others wait.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (value, nbytes, stage name, origin)
+        self._inflight = {}             # key -> threading.Event while being computed
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'waits': 0}
+
+    def get_or_compute(self, key: str, name: str, origin: str, compute: Callable) -> Tuple[object, bool]:
+        """Return (view of value, was_cached), calling compute() at most once per key"""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return _shared_view(entry[0]), True
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    break
+                self.counters['waits'] += 1
+            # Another session is computing this key; wait, then re-check
+            event.wait()
+
+        try:
+            value = _freeze(compute())
+            self._store(key, value, name, origin)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+        return _shared_view(value), False
+
+    def _store(self, key: str, value, name: str, origin: str):
+        nbytes = _estimate_nbytes(value)
+        with self._lock:
+            self.counters['misses'] += 1
+            if nbytes > self.max_bytes:
+                logger.warning("Stage '%s' result (%s bytes) exceeds shared cache cap; not cached", name, nbytes)
+                return
+            self._entries[key] = (value, nbytes, name, origin)
+            self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes and self._entries:
+                _, (_, evicted_bytes, evicted_name, _) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted_bytes
+                self.counters['evictions'] += 1
+                logger.info("Shared cache evicted '%s' (%s bytes)", evicted_name, evicted_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def status(self) -> Dict:
+        with self._lock:
+            workbooks = {origin for _, _, _, origin in self._entries.values() if origin}
+            return {
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'workbooks': len(workbooks),
+                **self.counters,
+            }
+
+    def usage_frame(self) -> pd.DataFrame:
+        """Per-stage entry counts and sizes for the admin view"""
+        with self._lock:
+            rows = [(name, nbytes) for _, nbytes, name, _ in self._entries.values()]
+        if not rows:
+            return pd.DataFrame(columns=['Stage', 'Entries', 'Size (MB)'])
+        df = pd.DataFrame(rows, columns=['Stage', 'Bytes'])
+        out = df.groupby('Stage', sort=False)['Bytes'].agg(['count', 'sum']).reset_index()
+        out.columns = ['Stage', 'Entries', 'Size (MB)']
+        out['Size (MB)'] = (out['Size (MB)'] / 1e6).round(2)
+        return out
+
+_shared_stage_cache = SharedStageCache(int(SHARED_CACHE_MAX_MB * 1e6))
+
+
+def get_shared_stage_cache() -> SharedStageCache:
+    """The single SharedStageCache for this process"""
+    return _shared_stage_cache
+
+
+class AnalysisPipeline:
+    """Memoized analysis stages forming a small dependency graph.
+
+    A stage's key hashes its name, its own parameters and the keys of its
+    upstream stages, so a stage is only recomputed when something it actually
+    depends on changed: a new threshold re-runs classification, metrics and
+    their downstream stages, while parsing stays cached. Results live in the
+    process-wide SharedStageCache; a pipeline (one per session) keeps only
+    keys and its own hit/miss counters. Results are shared, so stage
+    functions must not mutate their inputs.
+    """
+
+    def __init__(self, cache: SharedStageCache = None):
+        self._cache = cache
+        self.stats = {}       # stage -> {'hits': n, 'misses': n, 'seconds': total compute time}
+        self.last_run = {}    # stage -> 'hit' | 'miss' for the current rerun
+        self.tracker = None   # the session's rerun tracker, if any (see perf_span)
+
+    @property
+    def cache(self) -> SharedStageCache:
+        return self._cache if self._cache is not None else get_shared_stage_cache()
+
+    @staticmethod
+    def _key(name: str, params: Dict, deps: List[StageResult]) -> str:
+        h = hashlib.sha1(name.encode('utf-8'))
+        for k in sorted(params):
+            h.update(f"|{k}={params[k]!r}".encode('utf-8'))
+        for dep in deps:
+            h.update(f"|{dep.key}".encode('utf-8'))
+        return h.hexdigest()
+
+    def begin_run(self, tracker=None):
+        """Reset the per-rerun hit/miss record; stage spans are also recorded in tracker"""
+        self.last_run = {}
+        self.tracker = tracker
+
+    def source(self, name: str, value, key: str) -> StageResult:
+        """Register an external input (e.g. uploaded bytes) under a caller-provided key"""
+        return StageResult(f"{name}:{key}", value, f"{name}:{key}")
+
+    @classmethod
+    def prefetch(cls, cache: SharedStageCache, name: str, fn: Callable, deps: List[StageResult] = (),
+                 **params) -> StageResult:
+        """Compute a stage into the shared cache without touching any session's counters"""
+        deps = list(deps)
+        key = cls._key(name, params, deps)
+        origin = deps[0].origin if deps else ""
+        with perf_span(name, kind='background') as span:
+            value, cached = cache.get_or_compute(key, name, origin, lambda: fn(*[dep.value for dep in deps], **params))
+            span['outcome'] = 'hit' if cached else 'miss'
+        return StageResult(key, value, origin)
+
+    def stage(self, name: str, fn: Callable, deps: List[StageResult] = (), **params) -> StageResult:
+        """Return fn(*dep values, **params), computing it only on a cache miss"""
+        deps = list(deps)
+        key = self._key(name, params, deps)
+        origin = deps[0].origin if deps else ""
+        stats = self.stats.setdefault(name, {'hits': 0, 'misses': 0, 'seconds': 0.0})
+
+        start = time.perf_counter()
+        with perf_span(name, kind='stage', tracker=self.tracker) as span:
+            value, cached = self.cache.get_or_compute(
+                key, name, origin, lambda: fn(*[dep.value for dep in deps], **params))
+            span['outcome'] = 'hit' if cached else 'miss'
+        if cached:
+            stats['hits'] += 1
+            self.last_run[name] = 'hit'
+        else:
+            stats['seconds'] += time.perf_counter() - start
+            stats['misses'] += 1
+            self.last_run[name] = 'miss'
+        return StageResult(key, value, origin)
+
+    def stats_frame(self) -> pd.DataFrame:
+        rows = [{
+            'Stage': name,
+            'This run': self.last_run.get(name, '-'),
+            'Hits': st_['hits'],
+            'Misses': st_['misses'],
+            'Compute (s)': round(st_['seconds'], 3),
+        } for name, st_ in self.stats.items()]
+        return pd.DataFrame(rows)
+
+
+# -------------------------------
+# History Warehouse
+# -------------------------------
+
+# Every dated sheet the app sees is stored once, row by row, in an embedded
+# SQLite database, and the trend history is queried from there instead of
+# re-parsing every sheet of every upload. Months accumulate across uploads,
+# so a workbook only needs to carry its newest month(s) for a multi-year
+# trend. Months are grouped into datasets (e.g. one per team) so unrelated
+# portfolios never mix. The warehouse is opt-in: set CHI_HISTORY_DB to a
+# file path to turn it on. Otherwise, and while several workbooks are
+# uploaded together, history is parsed from the workbook alone.
+HISTORY_DB = os.environ.get('CHI_HISTORY_DB', '')
+HISTORY_DATASET = os.environ.get('CHI_HISTORY_DATASET', 'default')
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    dataset TEXT NOT NULL,
+    month TEXT NOT NULL,            -- snapshot date from the sheet name, YYYY-MM-DD
+    sheet_name TEXT NOT NULL,
+    workbook_sha1 TEXT NOT NULL,    -- workbook the month was last loaded from
+    rows INTEGER NOT NULL,
+    loaded_at REAL NOT NULL,
+    PRIMARY KEY (dataset, month)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    dataset TEXT NOT NULL,
+    month TEXT NOT NULL,
+    row INTEGER NOT NULL,           -- sheet row order; duplicate customer rows are kept like the sheet has them
+    customer TEXT,                  -- customer name as in the sheet, NULL if blank
+    score REAL,                     -- Security Score as parsed, NULL if blank
+    PRIMARY KEY (dataset, month, row)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scores_month_customer ON scores (dataset, month, customer);
+CREATE INDEX IF NOT EXISTS scores_customer_month ON scores (dataset, customer, month);
+"""
+
+
+def sheet_month(sheet_name: str) -> str:
+    """YYYY-MM-DD of a dated sheet name, or None (same rule as extract_historical_data)"""
+    if not re.match(r'\d{4}-\d{2}-\d{2}', sheet_name):
+        return None
+    try:
+        return pd.to_datetime(sheet_name).strftime('%Y-%m-%d')
+    except (ValueError, TypeError):
+        return None
+
+
+class HistoryWarehouse:
+    """Monthly customer scores in a local SQLite file, shared by all sessions in the process"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._synced = {}   # (dataset, workbook_sha1) -> latest month, see sync_history_warehouse()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_HISTORY_SCHEMA)
+
+    def __repr__(self):
+        # Stage keys include this, so results from different warehouse files never mix
+        return f"HistoryWarehouse({self.path!r})"
+
+    def synced_month(self, dataset: str, workbook_sha1: str) -> Tuple[bool, str]:
+        """(True, latest month) if the workbook was already synced into the dataset by this process"""
+        with self._lock:
+            if (dataset, workbook_sha1) in self._synced:
+                return True, self._synced[(dataset, workbook_sha1)]
+        return False, None
+
+    def mark_synced(self, dataset: str, workbook_sha1: str, latest: str):
+        with self._lock:
+            self._synced[(dataset, workbook_sha1)] = latest
+
+    def has_snapshot(self, dataset: str, month: str, workbook_sha1: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM snapshots WHERE dataset = ? AND month = ? AND workbook_sha1 = ?",
+                                     (dataset, month, workbook_sha1)).fetchone()
+        return row is not None
+
+    def store_month(self, dataset: str, month: str, sheet_name: str, workbook_sha1: str, df: pd.DataFrame) -> bool:
+        """Replace a month with the rows of a parsed dated sheet; False if it has no Security Score column"""
+        sec_col = find_security_col(list(df.columns))
+        if sec_col is None:
+            return False
+        col_customer = next((c for c in df.columns if _is_customer_col(c)), None)
+        scores = df[sec_col].to_numpy(dtype="float64")
+        scores = np.where(np.isnan(scores), None, scores)
+        if col_customer is not None:
+            names = df[col_customer].astype(object)
+            customers = names.where(names.notna(), None).tolist()
+        else:
+            customers = [None] * len(df)
+        rows = zip([dataset] * len(df), [month] * len(df), range(len(df)), customers, scores.tolist())
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM scores WHERE dataset = ? AND month = ?", (dataset, month))
+            self._conn.executemany("INSERT INTO scores (dataset, month, row, customer, score) VALUES (?, ?, ?, ?, ?)",
+                                   rows)
+            self._conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+                               (dataset, month, sheet_name, workbook_sha1, len(df), time.time()))
+        logger.info("History warehouse: stored %s (%s rows) in dataset '%s'", month, len(df), dataset)
+        return True
+
+    def revision(self, dataset: str) -> str:
+        """Changes whenever a month of the dataset is added or reloaded"""
+        with self._lock:
+            count, last = self._conn.execute("SELECT COUNT(*), MAX(loaded_at) FROM snapshots WHERE dataset = ?",
+                                             (dataset,)).fetchone()
+        return f"{count}:{last}"
+
+    def months(self, dataset: str) -> pd.DataFrame:
+        with self._lock:
+            return pd.read_sql_query("SELECT month, sheet_name, rows, workbook_sha1, loaded_at FROM snapshots "
+                                     "WHERE dataset = ? ORDER BY month", self._conn, params=(dataset,))
+
+    def history_frame(self, dataset: str, threshold: float, until: str = None, revision: str = None) -> pd.DataFrame:
+        """Per-month low-score counts, the same frame extract_historical_data() builds from a workbook"""
+        query = ("SELECT s.month, s.sheet_name, COALESCE(SUM(c.score < ?), 0) AS low, COUNT(c.score) AS total "
+                 "FROM snapshots s LEFT JOIN scores c ON c.dataset = s.dataset AND c.month = s.month "
+                 "WHERE s.dataset = ?")
+        params = [float(threshold), dataset]
+        if until is not None:
+            query += " AND s.month <= ?"
+            params.append(until)
+        with self._lock:
+            rows = self._conn.execute(query + " GROUP BY s.month ORDER BY s.month", params).fetchall()
+        historical_data = []
+        for month, sheet_name, low, total in rows:
+            date_obj = pd.to_datetime(month)
+            historical_data.append({
+                'date': date_obj,
+                'month_label': date_obj.strftime('%Y-%m'),
+                'sheet_name': sheet_name,
+                'low_score_customers': int(low),
+                'total_customers': int(total),
+                'low_score_percentage': (low / total * 100) if total > 0 else 0
+            })
+        return pd.DataFrame(historical_data)
+
+
+def sync_history_warehouse(run_stage: Callable, warehouse: HistoryWarehouse, workbook: StageResult,
+                           dataset: str) -> str:
+    """Store the workbook's dated sheets that the warehouse does not have from it yet.
+
+    Sheets come from the (usually pre-parsed) parse_sheet stage. Each workbook
+    is synced once per dataset and process, not on every rerun. Returns the
+    workbook's latest month, or None if it has no dated sheets.
+    """
+    workbook_sha1 = workbook.key.split(":", 1)[1]
+    synced, latest = warehouse.synced_month(dataset, workbook_sha1)
+    if synced:
+        return latest
+    for sheet in run_stage("sheet_names", list_sheet_names, [workbook]).value:
+        month = sheet_month(sheet) if sheet != SHEET1_NAME else None
+        if month is None:
+            continue
+        if not warehouse.has_snapshot(dataset, month, workbook_sha1):
+            try:
+                parsed = run_stage("parse_sheet", load_dated_sheet, [workbook], sheet=sheet).value
+            except Exception as e:
+                logger.warning("Could not process sheet %s: %s", sheet, e)
+                continue
+            if not warehouse.store_month(dataset, month, sheet, workbook_sha1, parsed):
+                continue
+        latest = max(latest or month, month)
+    warehouse.mark_synced(dataset, workbook_sha1, latest)
+    return latest
+
+
+def history_stage(run_stage: Callable, warehouse: HistoryWarehouse, workbook: StageResult, threshold: float,
+                  dataset: str = None) -> StageResult:
+    """The trend history: from the warehouse up to the workbook's latest month, or parsed from the workbook.
+
+    run_stage is pipeline.stage or an AnalysisPipeline.prefetch bound to a cache.
+    Without a warehouse or dataset, only the workbook's own sheets are used.
+    """
+    if warehouse is None or not dataset:
+        return workbook_history_stage(run_stage, workbook, threshold)
+    until = sync_history_warehouse(run_stage, warehouse, workbook, dataset)
+    return run_stage("history", warehouse_history, [], warehouse=warehouse, dataset=dataset, threshold=threshold,
+                     until=until, revision=warehouse.revision(dataset))
+
+
+def warehouse_history(warehouse: HistoryWarehouse, dataset: str, threshold: float, until: str = None,
+                      revision: str = None) -> pd.DataFrame:
+    """HistoryWarehouse.history_frame() as a stage function, with the warehouse as a stage parameter"""
+    return warehouse.history_frame(dataset, threshold, until=until, revision=revision)
+
+
+def workbook_history_stage(run_stage: Callable, workbook: StageResult, threshold: float) -> StageResult:
+    """Trend history from the workbook's own dated sheets.
+
+    Sheets come from the parse_sheet stages shared with pre-parsing and the
+    month bitsets, so a new threshold only re-counts (history_from_sheets).
+    """
+    sheets, frames = [], []
+    for sheet in dated_sheets(run_stage("sheet_names", list_sheet_names, [workbook]).value):
+        try:
+            frames.append(run_stage("parse_sheet", load_dated_sheet, [workbook], sheet=sheet))
+        except Exception as e:
+            logger.warning("Could not process sheet %s: %s", sheet, e)
+            continue
+        sheets.append(sheet)
+    return run_stage("history", history_from_sheets, frames, sheets=sheets, threshold=threshold)
+
+
+def month_bitsets_stage(run_stage: Callable, workbook: StageResult, col_customer: str, col_overall: str,
+                        threshold: float, dictionary: CustomerDictionary) -> StageResult:
+    """Per-month bitsets of the workbook's dated sheets, in date order (see MonthBitsets)"""
+    sheets = dated_sheets(run_stage("sheet_names", list_sheet_names, [workbook]).value)
+    frames = [run_stage("parse_sheet", load_dated_sheet, [workbook], sheet=sheet) for sheet in sheets]
+    ids = [run_stage("customer_ids", encode_customers, [frame], col_customer=col_customer, dictionary=dictionary)
+           for frame in frames]
+    return run_stage("month_bitsets", build_month_bitsets, frames + ids, sheets=sheets, col_overall=col_overall,
+                     threshold=threshold)
+
+
+MODE_SHEET1 = "sheet1"   # Mode A: two Security Score columns on Sheet1
+MODE_SHEETS = "sheets"   # Mode B: two dated sheets
+
+
+def run_headless_analysis(pipeline: AnalysisPipeline, data: bytes, mode: str = MODE_SHEET1,
+                          threshold: float = 42.0, prev: str = None, curr: str = None,
+                          include_history: bool = False, dictionary: CustomerDictionary = None) -> Dict:
+    """Run the page's analysis stages without any UI, using the page's defaults for unset choices.
+
+    prev/curr are Security Score columns (Mode A) or sheet names (Mode B).
+    dictionary defaults to the process-wide one. Returns a dict of stage
+    results; raises ValueError for unusable workbooks or selections.
+    """
+    if dictionary is None:
+        dictionary = get_customer_dictionary()
+    workbook = pipeline.source("workbook", data, hashlib.sha1(data).hexdigest())
+    sheet1 = pipeline.stage("parse_sheet1", load_sheet1, [workbook])
+    scanned, col_customer, col_overall = sheet1.value
+    if col_customer is None:
+        raise ValueError("Could not find a 'Customer' column on Sheet1.")
+
+    if mode == MODE_SHEET1:
+        sec_cols = [c for c in scanned.columns if re.search(r"security score", c, flags=re.I)]
+        if len(sec_cols) < 2:
+            raise ValueError("Could not find at least two 'Security Score' columns on Sheet1.")
+        col_prev, col_curr = prev or sec_cols[1], curr or sec_cols[0]
+        for col in (col_prev, col_curr):
+            if col not in sec_cols:
+                raise ValueError(f"Unknown Security Score column '{col}'. Available: {sec_cols}")
+        work = pipeline.stage("build_work", build_sheet1_frame, [sheet1], col_prev=col_prev, col_curr=col_curr,
+                              segment_col=None)
+        compared = (col_prev, col_curr)
+    elif mode == MODE_SHEETS:
+        all_sheets = pipeline.stage("sheet_names", list_sheet_names, [workbook]).value
+        sheet_names = [s for s in all_sheets if s != SHEET1_NAME]
+        if len(sheet_names) < 2:
+            raise ValueError("Need at least two dated sheets besides 'Sheet1' to compare.")
+        prev_sheet, curr_sheet = prev or sheet_names[0], curr or sheet_names[1]
+        for sheet in (prev_sheet, curr_sheet):
+            if sheet not in sheet_names:
+                raise ValueError(f"Unknown sheet '{sheet}'. Available: {sheet_names}")
+        df_prev = pipeline.stage("parse_sheet", load_dated_sheet, [workbook], sheet=prev_sheet)
+        df_curr = pipeline.stage("parse_sheet", load_dated_sheet, [workbook], sheet=curr_sheet)
+        prev_ids = pipeline.stage("customer_ids", encode_customers, [df_prev],
+                                  col_customer=col_customer, dictionary=dictionary)
+        curr_ids = pipeline.stage("customer_ids", encode_customers, [df_curr],
+                                  col_customer=col_customer, dictionary=dictionary)
+        work = pipeline.stage("build_work", merge_dated_sheets, [df_prev, df_curr, prev_ids, curr_ids],
+                              col_customer=col_customer, col_overall=col_overall, dictionary=dictionary,
+                              segment_col=None)
+        col_prev, col_curr = "__prev__", "__curr__"
+        compared = (prev_sheet, curr_sheet)
+    else:
+        raise ValueError(f"Unknown mode '{mode}'. Use '{MODE_SHEET1}' or '{MODE_SHEETS}'.")
+
+    classified = pipeline.stage("classify", classify, [work], col_prev=col_prev, col_curr=col_curr,
+                                col_overall=col_overall, threshold=threshold)
+    summary = pipeline.stage("summary_table", summarize_tables, [classified],
+                             col_customer=col_customer, col_prev=col_prev, col_curr=col_curr)
+    result = {
+        'workbook': workbook,
+        'classified': classified,
+        'summary': summary,
+        'compared': compared,
+        'columns': {'customer': col_customer, 'prev': col_prev, 'curr': col_curr, 'overall': col_overall},
+        'counts': {k: int(len(v)) for k, v in classified.value.items()},
+        'low_score_metrics': pipeline.stage("low_score_metrics", calculate_low_score_metrics, [work],
+                                            col_prev=col_prev, col_curr=col_curr, threshold=threshold).value,
+        'history': None,
+    }
+    if include_history:
+        history = workbook_history_stage(pipeline.stage, workbook, threshold)
+        if not history.value.empty:
+            history = pipeline.stage("monthly_changes", calculate_monthly_changes, [history, classified])
+        result['history'] = history.value
+    return result
+
+
+def build_portfolio_rollup(results: Dict[str, object]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Per-file summary rows and a per-month trend frame across all successfully analyzed files"""
+    rows, histories = [], []
+    for name, result in results.items():
+        if isinstance(result, str):
+            rows.append({'Workbook': name, 'Status': result})
+            continue
+        metrics = result['low_score_metrics']
+        rows.append({
+            'Workbook': name,
+            'Status': 'OK',
+            'Compared': f"{result['compared'][0]} → {result['compared'][1]}",
+            **result['counts'],
+            'Prev Low Score': metrics['prev_month_low_total'],
+            'Curr Low Score': metrics['curr_month_low_total'],
+        })
+        history = result['history']
+        if history is not None and not history.empty:
+            histories.append(history[['month_label', 'low_score_customers', 'total_customers']].assign(Workbook=name))
+
+    per_file = pd.DataFrame(rows)
+    if histories:
+        trend = pd.concat(histories, ignore_index=True).sort_values(['month_label', 'Workbook'], ignore_index=True)
+    else:
+        trend = pd.DataFrame(columns=['month_label', 'low_score_customers', 'total_customers', 'Workbook'])
+    return per_file, trend
+
+# -------------------------------
+# Amazon Q Telemetry
+# -------------------------------
+
+# Every q attempt (chat, summary, status probes, and the fake backend) is
+# recorded in a local SQLite file for tuning timeouts and context size.
+# CHI_Q_TELEMETRY_DB='' disables recording; rows older than
+# CHI_Q_TELEMETRY_DAYS are pruned when the store is opened.
+Q_TELEMETRY_DB = os.environ.get('CHI_Q_TELEMETRY_DB',
+                                os.path.join(os.path.dirname(os.path.abspath(__file__)), 'q_telemetry.sqlite3'))
+Q_TELEMETRY_RETENTION_DAYS = int(os.environ.get('CHI_Q_TELEMETRY_DAYS', '90'))
+
+_Q_TELEMETRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS q_calls (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,            -- unix time the attempt started
+    operation TEXT NOT NULL,     -- summary | chat | status | help | version | logout
+    backend TEXT,                -- q | fake
+    attempt INTEGER,             -- 1-based; 0 = rejected by the circuit breaker
+    prompt_bytes INTEGER,
+    response_bytes INTEGER,
+    duration_s REAL,
+    returncode INTEGER,          -- NULL when no process result (timeout, missing CLI, breaker)
+    error_class TEXT             -- NULL on success, else timeout | auth | quota | transient | error | not_found | circuit_open
+);
+CREATE INDEX IF NOT EXISTS q_calls_ts ON q_calls (ts);
+"""
+
+
+class QTelemetryStore:
+    """Local SQLite log of q invocations, shared by all sessions in the process"""
+
+    def __init__(self, path: str, retention_days: int = Q_TELEMETRY_RETENTION_DAYS):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_Q_TELEMETRY_SCHEMA)
+            self._conn.execute("DELETE FROM q_calls WHERE ts < ?", (time.time() - retention_days * 86400,))
+
+    def record(self, operation: str, backend: str, attempt: int, started: float, duration: float,
+               prompt_bytes: int = 0, response_bytes: int = 0, returncode: int = None, error_class: str = None):
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "INSERT INTO q_calls (ts, operation, backend, attempt, prompt_bytes, response_bytes, "
+                    "duration_s, returncode, error_class) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (started, operation, backend, attempt, prompt_bytes, response_bytes, duration,
+                     returncode, error_class))
+        except sqlite3.Error as e:
+            logger.warning("Could not record q telemetry: %s", e)
+
+    def load(self, days: float) -> pd.DataFrame:
+        with self._lock:
+            df = pd.read_sql_query("SELECT * FROM q_calls WHERE ts >= ? ORDER BY ts", self._conn,
+                                   params=(time.time() - days * 86400,))
+        df['time'] = pd.to_datetime(df['ts'], unit='s')
+        return df
+
+    @staticmethod
+    def _summarize(df: pd.DataFrame, keys: List[str]) -> pd.DataFrame:
+        """Per-group call counts, latency percentiles of the attempts that ran, failure rates and payload sizes"""
+        errors = df['error_class']
+        grouped = df.assign(ran=df['duration_s'].where(df['attempt'] > 0), failed=errors.notna(),
+                            timeout=errors.eq('timeout'), quota=errors.eq('quota'),
+                            prompt_kb=df['prompt_bytes'] / 1024, response_kb=df['response_bytes'] / 1024,
+                            ).groupby(keys)
+        out = grouped.agg(**{
+            'Calls': ('ts', 'size'),
+            'p50 (s)': ('ran', lambda s: s.quantile(0.5)),
+            'p90 (s)': ('ran', lambda s: s.quantile(0.9)),
+            'p99 (s)': ('ran', lambda s: s.quantile(0.99)),
+            'Max (s)': ('ran', 'max'),
+            'Failed %': ('failed', 'mean'),
+            'Timeout %': ('timeout', 'mean'),
+            'Quota %': ('quota', 'mean'),
+            'Prompt KB (avg)': ('prompt_kb', 'mean'),
+            'Response KB (avg)': ('response_kb', 'mean'),
+        })
+        rates = ['Failed %', 'Timeout %', 'Quota %']
+        out[rates] = out[rates] * 100
+        decimals = {'p50 (s)': 2, 'p90 (s)': 2, 'p99 (s)': 2, 'Max (s)': 2}
+        return out.round({col: decimals.get(col, 1) for col in out.columns if col != 'Calls'}).reset_index()
+
+    def summary_frame(self, days: float = 7) -> pd.DataFrame:
+        """Latency percentiles, failure rates and payload sizes per operation"""
+        df = self.load(days)
+        if df.empty:
+            return pd.DataFrame()
+        out = self._summarize(df, ['operation'])
+        return out.astype({'Calls': int}).rename(columns={'operation': 'Operation'})
+
+    def daily_frame(self, days: float = 30) -> pd.DataFrame:
+        """The same summary per day and operation, newest day first"""
+        df = self.load(days)
+        if df.empty:
+            return pd.DataFrame()
+        df['Day'] = df['time'].dt.strftime('%Y-%m-%d')
+        out = self._summarize(df, ['Day', 'operation'])
+        out = out.astype({'Calls': int}).rename(columns={'operation': 'Operation'})
+        return out.sort_values(['Day', 'Operation'], ascending=[False, True])
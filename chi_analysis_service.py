@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+Local HTTP/JSON analysis service for CHI Low Security Score Analyzer
+
+Exposes the same analysis stages as the Streamlit page for dashboards and
+scripts. Runs next to the Streamlit app on the same host (default port 8502,
+the app uses 8501) and listens on localhost only unless --host is given.
+
+    python chi_analysis_service.py --port 8502 --data-dir /shared/chi
+
+Endpoints:
+    GET  /health                 service version, cache and concurrency status
+    POST /analyze                analyze a workbook
+
+POST /analyze accepts either
+    - the raw .xlsx bytes as the request body, options in the query string:
+        curl --data-binary @chi.xlsx "http://localhost:8502/analyze?mode=sheets&threshold=42&include=history,excel"
+    - a JSON body naming a workbook under --data-dir:
+        {"path": "chi-2025-10.xlsx", "mode": "sheet1", "threshold": 42, "include": ["history"]}
+
+Options: mode (sheet1 | sheets), threshold, prev, curr (columns for sheet1,
+sheet names for sheets), include (any of history, tables, excel, pdf).
+Excel/PDF artifacts are returned base64-encoded.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core  # noqa: E402
+
+logger = logging.getLogger("chi_analysis_service")
+
+INCLUDE_OPTIONS = {"history", "tables", "excel", "pdf"}
+
+
+class ServiceError(Exception):
+    """Error with an HTTP status, reported to the client as JSON"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value):
+    """Serialize numpy/pandas scalars and timestamps"""
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _frame_records(df) -> list:
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+class AnalysisService:
+    """Analysis core shared by all request threads.
+
+    Requests run on a bounded worker pool; at most max_concurrent requests
+    are admitted at once and the rest are refused with 503 rather than
+    queued. Complete responses are cached by workbook hash plus options,
+    least recently used first out once their total size passes
+    response_cache_mb.
+    """
+
+    def __init__(self, workers: int, max_concurrent: int, cache_mb: float, response_cache_mb: float,
+                 data_dir: str, max_upload_mb: float):
+        self.pipeline = core.AnalysisPipeline(core.SharedStageCache(int(cache_mb * 1e6)))
+        self.customers = core.CustomerDictionaryHolder()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chi-service")
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.data_dir = os.path.realpath(data_dir)
+        self.max_upload_bytes = int(max_upload_mb * 1e6)
+        self.response_cache_bytes = int(response_cache_mb * 1e6)
+        self._responses = OrderedDict()
+        self._response_bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "response_cache_hits": 0, "rejected": 0, "errors": 0}
+
+    def read_workbook_path(self, path: str) -> bytes:
+        """Read a workbook from under data_dir"""
+        full = os.path.realpath(os.path.join(self.data_dir, path))
+        if os.path.commonpath([full, self.data_dir]) != self.data_dir:
+            raise ServiceError(403, "Path is outside the service data directory")
+        if not full.lower().endswith(".xlsx") or not os.path.isfile(full):
+            raise ServiceError(404, f"No .xlsx workbook at '{path}'")
+        with open(full, "rb") as f:
+            return f.read()
+
+    def analyze(self, data: bytes, options: dict) -> bytes:
+        """Return the JSON response body for one analysis request"""
+        include = set(options["include"])
+        unknown = include - INCLUDE_OPTIONS
+        if unknown:
+            raise ServiceError(400, f"Unknown include option(s): {sorted(unknown)}")
+        cache_key = hashlib.sha1(data).hexdigest() + json.dumps(options, sort_keys=True)
+
+        with self._lock:
+            self.counters["requests"] += 1
+            if cache_key in self._responses:
+                self._responses.move_to_end(cache_key)
+                self.counters["response_cache_hits"] += 1
+                return self._responses[cache_key]
+
+        if not self.slots.acquire(blocking=False):
+            with self._lock:
+                self.counters["rejected"] += 1
+            raise ServiceError(503, f"Too many concurrent analyses (limit {self.max_concurrent})")
+        try:
+            body = self.executor.submit(self._analyze, data, options, include).result()
+        finally:
+            self.slots.release()
+
+        with self._lock:
+            if len(body) <= self.response_cache_bytes and cache_key not in self._responses:
+                self._responses[cache_key] = body
+                self._response_bytes += len(body)
+                while self._response_bytes > self.response_cache_bytes:
+                    _, evicted = self._responses.popitem(last=False)
+                    self._response_bytes -= len(evicted)
+        return body
+
+    def _analyze(self, data: bytes, options: dict, include: set) -> bytes:
+        try:
+            result = core.run_headless_analysis(
+                self.pipeline, data, mode=options["mode"], threshold=options["threshold"],
+                prev=options["prev"], curr=options["curr"], include_history="history" in include,
+                dictionary=self.customers.current())
+        except ValueError as e:
+            raise ServiceError(422, str(e))
+
+        tables = result["classified"].value
+        response = {
+            "version": core.APP_VERSION,
+            "mode": options["mode"],
+            "threshold": options["threshold"],
+            "compared": {"prev": result["compared"][0], "curr": result["compared"][1]},
+            "counts": result["counts"],
+            "low_score_metrics": result["low_score_metrics"],
+        }
+        if "history" in include:
+            response["history"] = _frame_records(result["history"])
+        if "tables" in include:
+            response["tables"] = {name: _frame_records(df) for name, df in tables.items()}
+        if "excel" in include:
+            excel = self.pipeline.stage("export_excel", core.export_excel, [result["classified"], result["summary"]])
+            response["excel_base64"] = base64.b64encode(excel.value).decode("ascii")
+        if "pdf" in include:
+            if not core.PDF_AVAILABLE:
+                raise ServiceError(501, "PDF export needs reportlab: pip install reportlab")
+            pdf = self.pipeline.stage("export_pdf", core.export_pdf, [result["classified"], result["summary"]])
+            response["pdf_base64"] = base64.b64encode(pdf.value).decode("ascii")
+        return json.dumps(response, default=_json_default).encode("utf-8")
+
+    def status(self) -> dict:
+        with self._lock:
+            counters = dict(self.counters)
+            cached_responses = len(self._responses)
+            cached_response_bytes = self._response_bytes
+        return {
+            "status": "ok",
+            "version": core.APP_VERSION,
+            "max_concurrent": self.max_concurrent,
+            "cached_responses": cached_responses,
+            "cached_response_bytes": cached_response_bytes,
+            "stage_cache": self.pipeline.cache.status(),
+            "known_customers": len(self.customers.current()),
+            "customer_dictionaries_replaced": self.customers.replaced,
+            **counters,
+        }
+
+
+def parse_options(query: dict, body: dict) -> dict:
+    """Merge query-string and JSON options into a normalized dict; badly typed options raise a 400"""
+    def get(name, default=None):
+        if name in body:
+            return body[name]
+        return query[name][0] if name in query else default
+
+    include = get("include", [])
+    if isinstance(include, str):
+        include = [part.strip() for part in include.split(",") if part.strip()]
+    if not isinstance(include, list) or not all(isinstance(part, str) for part in include):
+        raise ServiceError(400, "include must be a list of strings or a comma-separated string")
+    threshold = get("threshold", 42.0)
+    try:
+        if isinstance(threshold, bool):
+            raise TypeError(threshold)
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise ServiceError(400, "threshold must be a number")
+    if not math.isfinite(threshold):
+        raise ServiceError(400, "threshold must be a finite number")
+    mode = get("mode", core.MODE_SHEET1)
+    if mode not in (core.MODE_SHEET1, core.MODE_SHEETS):
+        raise ServiceError(400, f"mode must be '{core.MODE_SHEET1}' or '{core.MODE_SHEETS}'")
+    options = {"mode": mode, "threshold": threshold, "prev": get("prev"), "curr": get("curr"),
+               "include": sorted(set(include))}
+    for name in ("prev", "curr"):
+        if options[name] is not None and not isinstance(options[name], str):
+            raise ServiceError(400, f"{name} must be a string")
+    return options
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    service: AnalysisService = None
+    server_version = "CHIAnalysisService/" + core.APP_VERSION
+
+    def _send_json(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == 503:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send_json(status, json.dumps({"error": message}).encode("utf-8"))
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/health":
+            self._send_json(200, json.dumps(self.service.status()).encode("utf-8"))
+        else:
+            self._send_error(404, "Not found")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/analyze":
+            self._send_error(404, "Not found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > self.service.max_upload_bytes:
+                raise ServiceError(413, f"Workbook larger than {self.service.max_upload_bytes} bytes")
+            payload = self.rfile.read(length)
+
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                try:
+                    body = json.loads(payload or b"{}")
+                except json.JSONDecodeError:
+                    raise ServiceError(400, "Invalid JSON body")
+                if not isinstance(body, dict) or not isinstance(body.get("path"), str):
+                    raise ServiceError(400, "JSON requests need a 'path' to a workbook under the data directory")
+                data = self.service.read_workbook_path(body["path"])
+            else:
+                body, data = {}, payload
+            if not data:
+                raise ServiceError(400, "No workbook in request")
+
+            options = parse_options(parse_qs(url.query), body)
+            self._send_json(200, self.service.analyze(data, options))
+        except ServiceError as e:
+            self._send_error(e.status, str(e))
+        except Exception as e:
+            logger.exception("Analysis request failed")
+            with self.service._lock:
+                self.service.counters["errors"] += 1
+            self._send_error(500, f"Analysis failed: {e}")
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--workers", type=int, default=2, help="analysis worker threads")
+    parser.add_argument("--max-concurrent", type=int, default=4, help="requests admitted at once; more get 503")
+    parser.add_argument("--cache-mb", type=float, default=512, help="stage cache memory cap")
+    parser.add_argument("--response-cache-mb", type=float, default=64, help="cached responses memory cap")
+    parser.add_argument("--max-upload-mb", type=float, default=50)
+    parser.add_argument("--data-dir", default=os.getcwd(), help="root for workbooks requested by path")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    AnalysisRequestHandler.service = AnalysisService(
+        workers=args.workers, max_concurrent=args.max_concurrent, cache_mb=args.cache_mb,
+        response_cache_mb=args.response_cache_mb, data_dir=args.data_dir, max_upload_mb=args.max_upload_mb)
+    server = ThreadingHTTPServer((args.host, args.port), AnalysisRequestHandler)
+    logger.info("CHI analysis service %s listening on http://%s:%s", core.APP_VERSION, args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -10,65 +10,95 @@
 #     Exit from Red, Return Back to Red, New Comer to Red, Missing from CHI
 # - Exports an Excel report with a Summary sheet and per-category sheets
 #
+# The analysis itself (parsing, classification, exports, stage pipeline) is in
+# chi_analysis_core.py, which the HTTP service and benchmarks import as well;
+# this file is the Streamlit page and the Amazon Q integration.
+#
 # How to run:
 #   1) pip install streamlit pandas openpyxl
 #   2) streamlit run app.py
 # ------------------------------------------------
 
-import io
+import atexit
+import cProfile
+import hashlib
 import re
 import subprocess
+import sys
 import json
 import logging
 import os
+import queue
+import random
+import shutil
+import sqlite3
+import threading
 import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Tuple
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.errors import StreamlitAPIException
 import plotly.express as px
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots
-
-# Version information
-try:
-    from version import __version__, get_version
-    APP_VERSION = get_version()
-except ImportError:
-    APP_VERSION = "1.0.0"
-
-# PDF generation imports
-try:
-    from reportlab.lib.pagesizes import A4, landscape
-    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-    from reportlab.lib import colors
-    from reportlab.lib.units import inch
-    PDF_AVAILABLE = True
-    print("✅ DEBUG: reportlab imported successfully, PDF_AVAILABLE = True")
-except ImportError as e:
-    PDF_AVAILABLE = False
-    print(f"❌ DEBUG: reportlab import failed: {e}, PDF_AVAILABLE = False")
-
-# Setup logging for Amazon Q CLI operations
+
+import chi_analysis_core
+from chi_analysis_core import (
+    APP_VERSION, AnalysisPipeline, CATEGORY_DELTA_FILTERS, CATEGORY_NAMES, CATEGORY_SORTS, CategoryIndex,
+    CustomerDictionary, HISTORY_DATASET, HISTORY_DB, HistoryWarehouse, MODE_SHEET1, MODE_SHEETS, PDF_AVAILABLE,
+    PDF_IMPORT_ERROR, Q_TELEMETRY_DB, QTelemetryStore, RED_STREAK_ALERT_MONTHS, RedZoneStreaks, SHEET1_NAME,
+    SegmentAnalysis, StageResult, TOP_MOVERS_K, analyze_segments, build_category_indexes, build_portfolio_rollup,
+    build_sheet1_frame, calculate_low_score_metrics, calculate_monthly_changes, classify, classify_month_pair,
+    compute_red_streaks, create_trend_chart, dimension_columns, encode_customers, export_excel, export_pdf,
+    find_top_movers, format_top_movers, get_customer_dictionary, get_perf_registry, history_stage,
+    list_sheet_names, load_dated_sheet, load_sheet1, merge_dated_sheets, month_bitsets_stage,
+    month_comparison_matrix, month_pair_customers, query_category_page, run_headless_analysis, summarize_tables,
+)
+
+# Logging: CHI_LOG_LEVEL (default INFO; DEBUG adds per-call chat/summary
+# detail), amazon_q_cli.log rotated at CHI_LOG_MAX_MB keeping CHI_LOG_BACKUPS files
+LOG_LEVEL = os.environ.get('CHI_LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(float(os.environ.get('CHI_LOG_MAX_MB', '10')) * 1e6)
+LOG_BACKUP_COUNT = int(os.environ.get('CHI_LOG_BACKUPS', '5'))
+
+
 def setup_logging():
-    """Setup logging for Amazon Q CLI operations"""
-    log_dir = os.path.dirname(os.path.abspath(__file__))
-    log_file = os.path.join(log_dir, 'amazon_q_cli.log')
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file),
-            logging.StreamHandler()  # Also log to console for debugging
-        ]
-    )
+    """Setup logging for Amazon Q CLI operations.
+
+    Records are handed to a queue and written to the rotating log file and the
+    console by a listener thread, so callers never wait on file I/O. Like
+    logging.basicConfig(), this only configures a root logger without handlers,
+    once per process even though the script re-runs on every interaction.
+    """
+    root = logging.getLogger()
+    if not root.handlers:
+        log_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'amazon_q_cli.log')
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        file_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8')
+        console_handler = logging.StreamHandler()  # Also log to console for debugging
+        for handler in (file_handler, console_handler):
+            handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler, console_handler)
+        listener.start()
+        atexit.register(listener.stop)
+        root.addHandler(QueueHandler(log_queue))
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
     return logging.getLogger('amazon_q_cli')
 
 # Initialize logger
 logger = setup_logging()
+if not PDF_AVAILABLE:
+    logger.warning("reportlab import failed, PDF export disabled: %s", PDF_IMPORT_ERROR)
 
 # Amazon Q status cache to avoid frequent checks
 _amazon_q_cache = {
@@ -78,79 +108,754 @@ _amazon_q_cache = {
     'cache_duration': 600  # 10 minutes cache
 }
 
+# -------------------------------
+# Performance Instrumentation
+# -------------------------------
+
+# Timing spans around pipeline stages and q subprocess calls. Each session
+# keeps the spans of its last PERF_HISTORY_RERUNS reruns for the sidebar
+# Performance panel; process-wide totals (kept by chi_analysis_core's
+# PerfRegistry) are exported to CHI_METRICS_FILE
+# (Prometheus text format, or JSON lines with one record per rerun when the
+# file name ends in .jsonl) at the end of every rerun.
+PERF_HISTORY_RERUNS = int(os.environ.get('CHI_PERF_HISTORY', '20'))
+METRICS_FILE = os.environ.get('CHI_METRICS_FILE', '')
+
+
+class PerfTracker:
+    """Timing spans of one session's recent reruns.
+
+    Only spans recorded on the thread that began the rerun belong to it;
+    background work (pre-parsing, trend jobs) is counted in the process-wide
+    registry only.
+    """
+
+    def __init__(self, history: int = PERF_HISTORY_RERUNS):
+        self.reruns = deque(maxlen=history)
+        self.current = None
+        self._count = 0
+
+    def begin(self, label: str):
+        self._count += 1
+        self.current = {'rerun': self._count, 'label': label, 'started': datetime.now().isoformat(timespec='seconds'),
+                        't0': time.perf_counter(), 'thread': threading.get_ident(), 'spans': []}
+
+    def record(self, kind: str, name: str, outcome: str, start: float, seconds: float):
+        rerun = self.current
+        if rerun is not None and rerun['thread'] == threading.get_ident():
+            rerun['spans'].append({'kind': kind, 'name': name, 'outcome': outcome,
+                                   'start_s': round(start - rerun['t0'], 6), 'seconds': round(seconds, 6)})
+
+    def finish(self) -> Dict:
+        """Close the current rerun and return its record"""
+        rerun, self.current = self.current, None
+        record = {k: v for k, v in rerun.items() if k not in ('t0', 'thread')}
+        record['seconds'] = round(time.perf_counter() - rerun['t0'], 6)
+        self.reruns.append(record)
+        return record
+
+    def history_frame(self) -> pd.DataFrame:
+        rows = []
+        for r in reversed(self.reruns):
+            by_kind = {}
+            for span in r['spans']:
+                by_kind[span['kind']] = by_kind.get(span['kind'], 0.0) + span['seconds']
+            slowest = max(r['spans'], key=lambda s: s['seconds'], default=None)
+            rows.append({
+                'Rerun': r['rerun'],
+                'Started': r['started'][11:],
+                'Run': r['label'],
+                'Total (ms)': round(r['seconds'] * 1000, 1),
+                'Stages (ms)': round(by_kind.get('stage', 0.0) * 1000, 1),
+                'Subprocess (ms)': round(by_kind.get('subprocess', 0.0) * 1000, 1),
+                'Slowest': f"{slowest['name']} ({slowest['seconds'] * 1000:.0f} ms)" if slowest else '-',
+            })
+        return pd.DataFrame(rows)
+
+    def spans_frame(self, rerun: int) -> pd.DataFrame:
+        record = next((r for r in self.reruns if r['rerun'] == rerun), None)
+        rows = [{
+            'Span': s['name'],
+            'Kind': s['kind'],
+            'Outcome': s['outcome'],
+            'Start (ms)': round(s['start_s'] * 1000, 1),
+            'Duration (ms)': round(s['seconds'] * 1000, 1),
+        } for s in (record['spans'] if record else [])]
+        return pd.DataFrame(rows, columns=['Span', 'Kind', 'Outcome', 'Start (ms)', 'Duration (ms)'])
+
+
+# Tracker of the session whose rerun is executing this module namespace
+_perf = {'tracker': None}
+
+
+def perf_span(name: str, kind: str = 'stage'):
+    """Time the block into the process totals and this session's rerun (see chi_analysis_core.perf_span)"""
+    return chi_analysis_core.perf_span(name, kind, _perf['tracker'])
+
+
+def begin_perf_rerun(tracker: PerfTracker, label: str = 'script'):
+    _perf['tracker'] = tracker
+    tracker.begin(label)
+
+
+def finish_perf_rerun() -> Dict:
+    """Close the current rerun, add it to the process totals and export the metrics file"""
+    record = _perf['tracker'].finish()
+    registry = get_perf_registry()
+    registry.observe_rerun(record['label'], record['seconds'])
+    if METRICS_FILE:
+        try:
+            registry.export(METRICS_FILE, record)
+        except OSError as e:
+            logger.warning("Could not write metrics file %s: %s", METRICS_FILE, e)
+    return record
+
+
+@contextmanager
+def perf_fragment(label: str):
+    """Record a fragment-only rerun; a no-op while the full script run is being recorded.
+
+    Usable as a decorator below @st.fragment.
+    """
+    tracker = _perf['tracker']
+    if tracker is None or tracker.current is not None:
+        yield
+        return
+    tracker.begin(label)
+    try:
+        yield
+    finally:
+        finish_perf_rerun()
+
+# -------------------------------
+# Profiling
+# -------------------------------
+
+# Opt-in capture of whole reruns: CHI_PROFILE=1 profiles every rerun, the
+# "Profile reruns" toggle in the Performance panel profiles one session's.
+# Each capture writes <time>_<workbook hash>_<mode>_t<threshold>.pstats
+# (cProfile, script thread) and .collapsed (sampled stacks of the script
+# thread and the background pool, for flamegraph.pl or speedscope) to
+# CHI_PROFILE_DIR.
+PROFILE_ALWAYS = os.environ.get('CHI_PROFILE') == '1'
+PROFILE_DIR = os.environ.get('CHI_PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('CHI_PROFILE_INTERVAL_MS', '5')) / 1000
+
+
+@st.cache_resource
+def get_profile_lock() -> threading.Lock:
+    """Only one capture runs at a time per process"""
+    return threading.Lock()
+
+
+class StackSampler:
+    """Samples one thread plus the background pool into collapsed-stack counts"""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chi-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = 'script' if ident == self.thread_id else names.get(ident, '')
+                # Idle pool workers sit in concurrent.futures' _worker loop
+                if name != 'script' and (not name.startswith('chi-background') or frame.f_code.co_name == '_worker'):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame))
+                    frame = frame.f_back
+                stack.append(name)
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.counts.most_common())
+
+
+class RerunProfile:
+    """cProfile plus stack sampling over one rerun, started and stopped on the script thread"""
+
+    def __init__(self, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self.started = datetime.now()
+        self.thread_id = threading.get_ident()
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(self.thread_id, PROFILE_SAMPLE_INTERVAL)
+
+    def start(self):
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self, workbook_hash: str, mode: str, threshold: float) -> List[str]:
+        """Stop capturing and write the .pstats and .collapsed files; returns their paths"""
+        if threading.get_ident() == self.thread_id:
+            self.profile.disable()
+        self.sampler.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = self.started.strftime('%Y%m%d-%H%M%S-%f')[:-3]
+        base = os.path.join(self.directory, f"{stamp}_{workbook_hash[:12]}_{mode}_t{threshold:g}")
+        self.profile.dump_stats(base + ".pstats")
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            f.write(self.sampler.collapsed())
+        return [base + ".pstats", base + ".collapsed"]
+
+
+def start_rerun_profile() -> "RerunProfile | None":
+    """Begin profiling the current rerun, or None if another capture is running"""
+    if not get_profile_lock().acquire(blocking=False):
+        logger.warning("Profile capture skipped: another rerun is being profiled")
+        return None
+    capture = RerunProfile()
+    capture.start()
+    return capture
+
+
+def finish_rerun_profile(capture: RerunProfile, workbook_hash: str, mode: str, threshold: float) -> List[str]:
+    """Stop a capture started by start_rerun_profile() and release the process-wide lock"""
+    try:
+        paths = capture.stop(workbook_hash, mode, threshold)
+        logger.info("Profile written: %s", ', '.join(paths))
+        return paths
+    except OSError as e:
+        logger.warning("Could not write profile to %s: %s", capture.directory, e)
+        return []
+    finally:
+        get_profile_lock().release()
+
+# -------------------------------
+# Amazon Q Telemetry
+# -------------------------------
+
+def classify_q_result(result: subprocess.CompletedProcess) -> str:
+    """Error class of a finished q call (None on success), using the same checks as the callers"""
+    if result.returncode == 0:
+        return None
+    stderr = (result.stderr or "").lower()
+    if "not logged in" in stderr:
+        return 'auth'
+    if "quota" in stderr or "limit" in stderr or "throttl" in stderr:
+        return 'quota'
+    if _is_transient_q_error(stderr):
+        return 'transient'
+    return 'error'
+
+
+@st.cache_resource
+def get_q_telemetry() -> "QTelemetryStore | None":
+    """The process-wide telemetry store, or None when disabled or the file cannot be opened"""
+    if not Q_TELEMETRY_DB:
+        return None
+    try:
+        return QTelemetryStore(Q_TELEMETRY_DB)
+    except sqlite3.Error as e:
+        logger.warning("q telemetry disabled, cannot open %s: %s", Q_TELEMETRY_DB, e)
+        return None
+
+
+def record_q_call(operation: str, backend: str, attempt: int, started: float, duration: float,
+                  prompt_bytes: int = 0, result: subprocess.CompletedProcess = None, error_class: str = None):
+    """Record one q attempt; error_class is derived from result when not given"""
+    store = get_q_telemetry()
+    if store is None:
+        return
+    if result is not None:
+        store.record(operation, backend, attempt, started, duration, prompt_bytes,
+                     len((result.stdout or "").encode('utf-8')), result.returncode, classify_q_result(result))
+    else:
+        store.record(operation, backend, attempt, started, duration, prompt_bytes, error_class=error_class)
+
+# -------------------------------
+# Amazon Q CLI Resilience
+# -------------------------------
+
+# Per-operation call policies for the q CLI.
+#   timeout:     per-attempt subprocess timeout (seconds)
+#   deadline:    overall budget for all attempts including backoff (seconds)
+#   attempts:    maximum number of attempts (1 = no retry)
+#   use_breaker: whether the call is gated by (and feeds) the circuit breaker
+_Q_CALL_POLICIES = {
+    'summary': {'timeout': 30, 'deadline': 75, 'attempts': 2, 'use_breaker': True},
+    'chat':    {'timeout': 90, 'deadline': 120, 'attempts': 2, 'use_breaker': True},
+    'logout':  {'timeout': 30, 'deadline': 30, 'attempts': 1, 'use_breaker': False},
+    'version': {'timeout': 5, 'deadline': 5, 'attempts': 1, 'use_breaker': False},
+    'help':    {'timeout': 5, 'deadline': 5, 'attempts': 1, 'use_breaker': False},
+    'status':  {'timeout': 3, 'deadline': 3, 'attempts': 1, 'use_breaker': False},
+}
+
+# Backoff between retries: full jitter over an exponentially growing window
+_Q_BACKOFF_BASE = 1.0   # seconds
+_Q_BACKOFF_CAP = 8.0    # seconds
+
+# stderr fragments that indicate a transient failure worth retrying
+_Q_TRANSIENT_ERRORS = (
+    'timed out', 'timeout', 'connection', 'temporarily', 'throttl',
+    'service unavailable', 'internal server error', '502', '503', '504',
+)
+
+# Circuit breaker shared by every session in this process: after
+# `failure_threshold` consecutive failures the breaker opens and calls fail
+# fast for `reset_timeout` seconds, then a single trial call is let through.
+# Non-transient errors (auth, quota, ...) neither count as failures nor close it.
+_amazon_q_breaker = {
+    'state': 'closed',  # closed | open | half_open
+    'probing': False,   # a half-open trial call is in flight
+    'failures': 0,
+    'opened_at': 0,
+    'last_error': None,
+    'failure_threshold': 3,
+    'reset_timeout': 120,
+}
+_amazon_q_breaker_lock = threading.Lock()
+
+
+class AmazonQCircuitOpenError(RuntimeError):
+    """Raised when a q call is rejected because the circuit breaker is open"""
+
+    def __init__(self, retry_in: float):
+        self.retry_in = retry_in
+        retry = f"Retrying automatically in {retry_in:.0f}s." if retry_in > 0 else "A trial call is in progress."
+        super().__init__(f"Amazon Q is temporarily unavailable after repeated failures. {retry}")
+
+
+def _is_transient_q_error(stderr: str) -> bool:
+    stderr_lower = (stderr or "").lower()
+    return any(fragment in stderr_lower for fragment in _Q_TRANSIENT_ERRORS)
+
+
+def _breaker_before_call() -> None:
+    """Fail fast while the breaker is open or its half-open trial call is running.
+
+    Once the reset timeout has passed, the first caller becomes the trial
+    call and moves the breaker to half-open.
+    """
+    with _amazon_q_breaker_lock:
+        if _amazon_q_breaker['state'] == 'closed':
+            return
+        if _amazon_q_breaker['state'] == 'half_open':
+            if _amazon_q_breaker['probing']:
+                raise AmazonQCircuitOpenError(0)
+        else:
+            elapsed = time.time() - _amazon_q_breaker['opened_at']
+            if elapsed < _amazon_q_breaker['reset_timeout']:
+                raise AmazonQCircuitOpenError(_amazon_q_breaker['reset_timeout'] - elapsed)
+            _amazon_q_breaker['state'] = 'half_open'
+            logger.info("Amazon Q circuit breaker half-open, allowing a trial call")
+        _amazon_q_breaker['probing'] = True
+
+
+def _breaker_record_success() -> None:
+    with _amazon_q_breaker_lock:
+        if _amazon_q_breaker['state'] != 'closed':
+            logger.info("Amazon Q circuit breaker closed after successful call")
+        _amazon_q_breaker.update({'state': 'closed', 'probing': False, 'failures': 0, 'last_error': None})
+
+
+def _breaker_record_neutral() -> None:
+    """The CLI answered with a non-transient error: leave the state, let the next call be the trial"""
+    with _amazon_q_breaker_lock:
+        _amazon_q_breaker['probing'] = False
+
+
+def _breaker_record_failure(error: str) -> None:
+    with _amazon_q_breaker_lock:
+        _amazon_q_breaker['failures'] += 1
+        _amazon_q_breaker['last_error'] = error
+        _amazon_q_breaker['probing'] = False
+        if (_amazon_q_breaker['state'] == 'half_open' or
+                _amazon_q_breaker['failures'] >= _amazon_q_breaker['failure_threshold']):
+            _amazon_q_breaker['state'] = 'open'
+            _amazon_q_breaker['opened_at'] = time.time()
+            logger.warning("Amazon Q circuit breaker opened after %s failures: %s", _amazon_q_breaker['failures'], error)
+
+
+def get_amazon_q_breaker_status() -> Dict:
+    """Snapshot of the circuit breaker for display in the UI"""
+    with _amazon_q_breaker_lock:
+        status = dict(_amazon_q_breaker)
+    status['retry_in'] = 0
+    if status['state'] == 'open':
+        status['retry_in'] = max(0, status['reset_timeout'] - (time.time() - status['opened_at']))
+    return status
+
+
+def reset_amazon_q_breaker():
+    """Close the circuit breaker, e.g. after the user fixed the CLI and refreshed status"""
+    with _amazon_q_breaker_lock:
+        _amazon_q_breaker.update({'state': 'closed', 'probing': False, 'failures': 0, 'opened_at': 0,
+                                  'last_error': None})
+    logger.info("Amazon Q circuit breaker reset")
+
+
+def call_with_policy(operation: str, attempt_fn: Callable[[float], subprocess.CompletedProcess],
+                     cmd: List[str] = None, prompt_bytes: int = 0) -> subprocess.CompletedProcess:
+    """Run `attempt_fn(timeout)` under the call policy for `operation`.
+
+    Transient failures (timeouts and connection/throttling errors on stderr)
+    are retried with jittered exponential backoff until the attempts or the
+    overall deadline run out. Non-transient results (success, auth or quota
+    errors) are returned immediately for the caller to interpret.
+    Raises subprocess.TimeoutExpired if the last attempt timed out,
+    FileNotFoundError if the CLI is missing and AmazonQCircuitOpenError while
+    the breaker is open. Every attempt is recorded in the q telemetry store.
+    """
+    policy = _Q_CALL_POLICIES[operation]
+    use_breaker = policy['use_breaker']
+    backend = cmd[0] if cmd else 'q'
+    if use_breaker:
+        try:
+            _breaker_before_call()
+        except AmazonQCircuitOpenError:
+            record_q_call(operation, backend, 0, time.time(), 0.0, prompt_bytes, error_class='circuit_open')
+            raise
+
+    deadline = time.monotonic() + policy['deadline']
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        timeout = max(1.0, min(policy['timeout'], remaining))
+        started, start = time.time(), time.perf_counter()
+        try:
+            result = attempt_fn(timeout)
+        except subprocess.TimeoutExpired:
+            record_q_call(operation, backend, attempt, started, time.perf_counter() - start, prompt_bytes,
+                          error_class='timeout')
+            failure, error = None, f"timed out after {timeout:.0f}s"
+        except FileNotFoundError:
+            record_q_call(operation, backend, attempt, started, time.perf_counter() - start, prompt_bytes,
+                          error_class='not_found')
+            if use_breaker:
+                _breaker_record_failure("q CLI not found")
+            raise
+        except Exception:
+            if use_breaker:
+                _breaker_record_neutral()
+            raise
+        else:
+            record_q_call(operation, backend, attempt, started, time.perf_counter() - start, prompt_bytes,
+                          result=result)
+            if result.returncode == 0:
+                if use_breaker:
+                    _breaker_record_success()
+                return result
+            if not _is_transient_q_error(result.stderr):
+                if use_breaker:
+                    _breaker_record_neutral()
+                return result
+            failure, error = result, result.stderr.strip()[:200]
+
+        logger.warning("Amazon Q %s attempt %s/%s failed: %s", operation, attempt, policy['attempts'], error)
+        if use_breaker:
+            _breaker_record_failure(error)
+
+        backoff = random.uniform(0, min(_Q_BACKOFF_CAP, _Q_BACKOFF_BASE * 2 ** (attempt - 1)))
+        out_of_budget = deadline - time.monotonic() - backoff < 1.0
+        breaker_open = use_breaker and get_amazon_q_breaker_status()['state'] == 'open'
+        if attempt >= policy['attempts'] or out_of_budget or breaker_open:
+            if failure is None:
+                raise subprocess.TimeoutExpired(cmd or [operation], timeout)
+            return failure
+        time.sleep(backoff)
+
+
+def run_q_command(cmd: List[str], operation: str, prompt_bytes: int = 0) -> subprocess.CompletedProcess:
+    """Run a q CLI command under the call policy for `operation` (see call_with_policy)"""
+    with perf_span(f"q {operation}", kind='subprocess') as span:
+        result = call_with_policy(
+            operation,
+            lambda timeout: subprocess.run(cmd, capture_output=True, text=True, timeout=timeout),
+            cmd=cmd,
+            prompt_bytes=prompt_bytes,
+        )
+        span['outcome'] = 'ok' if result.returncode == 0 else f"exit {result.returncode}"
+    return result
+
+# -------------------------------
+# LLM Backends
+# -------------------------------
+
+class LLMBackend(ABC):
+    """Text-generation backend behind generate_ai_summary() and chat_with_amazon_q().
+
+    `complete()` returns a CompletedProcess-like result (returncode, stdout,
+    stderr) so callers interpret every backend the same way as the q CLI.
+    """
+    name = "base"
+
+    @abstractmethod
+    def complete(self, prompt: str, operation: str) -> subprocess.CompletedProcess:
+        """Run one prompt for `operation` ('summary', 'chat', ...)"""
+
+    def describe(self) -> str:
+        return self.name
+
+
+class QCliBackend(LLMBackend):
+    """Amazon Q CLI (`q chat --no-interactive`)"""
+    name = "q"
+
+    def complete(self, prompt: str, operation: str) -> subprocess.CompletedProcess:
+        return run_q_command(['q', 'chat', '--no-interactive', '--trust-all-tools', prompt],
+                             operation=operation, prompt_bytes=len(prompt.encode('utf-8')))
+
+    def describe(self) -> str:
+        return "Amazon Q CLI"
+
+
+class FakeLLMBackend(LLMBackend):
+    """Local deterministic stand-in for load tests and offline benchmarks.
+
+    Responses are derived from a hash of the prompt, so identical prompts give
+    identical text. Latency, failure rate and output size are configurable;
+    failures are seeded and surface as transient errors (or timeouts when the
+    latency exceeds the attempt timeout) so the resilience layer is exercised.
+    """
+    name = "fake"
+
+    _WORDS = ("security", "posture", "customers", "improved", "score", "trend", "review",
+              "TAM", "engagement", "risk", "monthly", "focus", "remediation", "progress",
+              "attention", "healthy", "coverage", "findings", "sustained", "recommend")
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0,
+                 output_chars: int = 1200, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.output_chars = output_chars
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def _render(self, prompt: str) -> str:
+        rng = random.Random(zlib.crc32(prompt.encode('utf-8')))
+        paragraphs, words, length = [], [], 0
+        while length < self.output_chars:
+            word = rng.choice(self._WORDS)
+            words.append(word)
+            length += len(word) + 1
+            if len(words) >= 60:
+                paragraphs.append(" ".join(words).capitalize() + ".")
+                words = []
+        if words:
+            paragraphs.append(" ".join(words).capitalize() + ".")
+        return "## Monthly Security Summary\n\n" + "\n\n".join(paragraphs)
+
+    def complete(self, prompt: str, operation: str) -> subprocess.CompletedProcess:
+        def attempt(timeout: float) -> subprocess.CompletedProcess:
+            with self._lock:
+                self.calls += 1
+                fail = self._rng.random() < self.failure_rate
+            if self.latency > timeout:
+                time.sleep(timeout)
+                raise subprocess.TimeoutExpired(['fake', operation], timeout)
+            time.sleep(self.latency)
+            if fail:
+                return subprocess.CompletedProcess(['fake', operation], 1, "",
+                                                   "connection reset by fake backend")
+            return subprocess.CompletedProcess(['fake', operation], 0, self._render(prompt), "")
+
+        return call_with_policy(operation, attempt, cmd=['fake', operation],
+                                prompt_bytes=len(prompt.encode('utf-8')))
+
+    def describe(self) -> str:
+        return (f"local fake backend (latency={self.latency}s, failure_rate={self.failure_rate}, "
+                f"output_chars={self.output_chars})")
+
+
+def _backend_from_env() -> LLMBackend:
+    """Select the backend from CHI_LLM_BACKEND (q | fake); fake is tuned via CHI_FAKE_* variables"""
+    if os.environ.get('CHI_LLM_BACKEND', 'q').lower() == 'fake':
+        return FakeLLMBackend(
+            latency=float(os.environ.get('CHI_FAKE_LATENCY', '0.5')),
+            failure_rate=float(os.environ.get('CHI_FAKE_FAILURE_RATE', '0')),
+            output_chars=int(os.environ.get('CHI_FAKE_OUTPUT_CHARS', '1200')),
+            seed=int(os.environ.get('CHI_FAKE_SEED', '0')),
+        )
+    return QCliBackend()
+
+
+_llm_backend = _backend_from_env()
+
+
+def get_llm_backend() -> LLMBackend:
+    return _llm_backend
+
+
+def set_llm_backend(backend: LLMBackend):
+    """Swap the active backend (used by test scripts and benchmarks)"""
+    global _llm_backend
+    _llm_backend = backend
+    clear_amazon_q_cache()
+    logger.info("LLM backend set to %s", backend.describe())
+
 # -------------------------------
 # Amazon Q CLI Integration
 # -------------------------------
 
+# ANSI cleanup patterns, compiled once. They are applied in this order; each
+# pass runs on the output of the previous one.
+_ANSI_ESCAPE_RE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+_ANSI_LEFTOVER_RE = re.compile(r'\[[\d;]+m')
+_ANSI_LEFTOVER_SIMPLE_RE = re.compile(r'\[\d+m')
+_EXTRA_NEWLINES_RE = re.compile(r'\n\s*\n\s*\n')
+
+
 def clean_ansi_codes(text: str) -> str:
     """Remove ANSI color codes and formatting from text"""
-    import re
     # Remove ANSI escape sequences
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    cleaned = ansi_escape.sub('', text)
+    cleaned = _ANSI_ESCAPE_RE.sub('', text)
     
     # Remove additional formatting codes that might remain
-    cleaned = re.sub(r'\[[\d;]+m', '', cleaned)
-    cleaned = re.sub(r'\[\d+m', '', cleaned)
+    cleaned = _ANSI_LEFTOVER_RE.sub('', cleaned)
+    cleaned = _ANSI_LEFTOVER_SIMPLE_RE.sub('', cleaned)
     
     # Clean up extra whitespace and newlines
-    cleaned = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned)  # Multiple newlines to double
+    cleaned = _EXTRA_NEWLINES_RE.sub('\n\n', cleaned)  # Multiple newlines to double
     cleaned = cleaned.strip()
     
     return cleaned
 
+
+class _StreamingSub:
+    """Incremental `pattern.sub(repl, ...)` over a stream of chunks.
+
+    Every match of the patterns used here starts with `anchor`. Text from the
+    last anchor onwards is held back while it could still grow into a match
+    (`incomplete` fullmatches it), so a sequence split across chunks is
+    handled exactly like in the one-shot substitution.
+    """
+
+    def __init__(self, pattern: re.Pattern, repl: str, anchor: str, incomplete: re.Pattern):
+        self.pattern = pattern
+        self.repl = repl
+        self.anchor = anchor
+        self.incomplete = incomplete
+        self._pending = ""
+
+    def feed(self, text: str) -> str:
+        buf = self._pending + text
+        cut = len(buf)
+        i = buf.rfind(self.anchor)
+        if i != -1 and self.incomplete.fullmatch(buf, i):
+            cut = i
+        self._pending = buf[cut:]
+        return self.pattern.sub(self.repl, buf[:cut])
+
+    def finish(self) -> str:
+        out = self.pattern.sub(self.repl, self._pending)
+        self._pending = ""
+        return out
+
+
+class AnsiStreamCleaner:
+    """Chunk-by-chunk equivalent of clean_ansi_codes() for streamed CLI output.
+
+    ``"".join([c.feed(x) for x in chunks] + [c.finish()]) == clean_ansi_codes("".join(chunks))``
+    for any chunking, including escape sequences split across chunk boundaries.
+    Trailing whitespace is held until more text arrives, since it may still
+    be collapsed or stripped.
+    """
+
+    def __init__(self):
+        self._stages = [
+            _StreamingSub(_ANSI_ESCAPE_RE, '', '\x1b', re.compile(r'\x1B(?:\[[0-?]*[ -/]*)?')),
+            _StreamingSub(_ANSI_LEFTOVER_RE, '', '[', re.compile(r'\[[\d;]*')),
+            _StreamingSub(_ANSI_LEFTOVER_SIMPLE_RE, '', '[', re.compile(r'\[\d*')),
+        ]
+        self._whitespace = ""   # trailing whitespace run not yet emitted
+        self._started = False   # leading whitespace already stripped
+
+    def _collapse(self, text: str, final: bool) -> str:
+        buf = self._whitespace + text
+        cut = len(buf) if final else len(buf.rstrip())
+        self._whitespace = buf[cut:]
+        out = _EXTRA_NEWLINES_RE.sub('\n\n', buf[:cut])
+        if not self._started:
+            out = out.lstrip()
+            self._started = bool(out)
+        return out
+
+    def feed(self, chunk: str) -> str:
+        for stage in self._stages:
+            chunk = stage.feed(chunk)
+        return self._collapse(chunk, final=False)
+
+    def finish(self) -> str:
+        chunk = ""
+        for stage in self._stages:
+            chunk = stage.feed(chunk) + stage.finish()
+        return self._collapse(chunk, final=True).rstrip()
+
+
 def chat_with_amazon_q(message: str, context: str = "") -> tuple[bool, str]:
     """Interactive chat with Amazon Q CLI"""
     try:
-        print(f"🔍 DEBUG: chat_with_amazon_q() called")
-        print(f"🔍 DEBUG: Message: {message[:100]}...")
-        print(f"🔍 DEBUG: Context length: {len(context)} chars")
-        print(f"🔍 DEBUG: Context preview: {context[:300]}...")
-        logger.info(f"Sending chat message to Amazon Q: {message[:100]}...")
+        logger.debug("chat_with_amazon_q() called")
+        logger.debug("Message: %.100s...", message)
+        logger.debug("Context length: %s chars", len(context))
+        logger.debug("Context preview: %.300s...", context)
+        logger.info("Sending chat message to Amazon Q: %s...", message[:100])
         
         # Combine context and message
         full_prompt = f"{context}\n\nUser Question: {message}" if context else message
-        print(f"🔍 DEBUG: Full prompt length: {len(full_prompt)} chars")
-        print(f"🔍 DEBUG: Full prompt preview: {full_prompt[:500]}...")
+        logger.debug("Full prompt length: %s chars", len(full_prompt))
+        logger.debug("Full prompt preview: %.500s...", full_prompt)
         
         # Call Amazon Q CLI
-        print(f"🔍 DEBUG: Calling Amazon Q CLI with subprocess.run()")
-        result = subprocess.run([
-            'q', 'chat', '--no-interactive', '--trust-all-tools', full_prompt
-        ], capture_output=True, text=True, timeout=90)
-        print(f"🔍 DEBUG: Amazon Q CLI returned with code: {result.returncode}")
+        logger.debug("Calling %s", get_llm_backend().describe())
+        result = get_llm_backend().complete(full_prompt, operation='chat')
+        logger.debug("Amazon Q CLI returned with code: %s", result.returncode)
         
-        logger.info(f"Amazon Q CLI chat completed with return code: {result.returncode}")
+        logger.info("Amazon Q CLI chat completed with return code: %s", result.returncode)
         
         if result.returncode == 0:
             raw_output = result.stdout.strip()
-            print(f"🔍 DEBUG: Raw output length: {len(raw_output)} chars")
-            print(f"🔍 DEBUG: Raw output preview: {raw_output[:300]}...")
+            logger.debug("Raw output length: %s chars", len(raw_output))
+            logger.debug("Raw output preview: %.300s...", raw_output)
             clean_output = clean_ansi_codes(raw_output)
-            print(f"🔍 DEBUG: Clean output length: {len(clean_output)} chars")
+            logger.debug("Clean output length: %s chars", len(clean_output))
             
             if clean_output:
                 logger.info("Amazon Q chat response received successfully")
-                print(f"🔍 DEBUG: Returning SUCCESS with clean output")
+                logger.debug("Returning SUCCESS with clean output")
                 return True, clean_output
             else:
-                print(f"🔍 DEBUG: Empty response after cleaning")
+                logger.debug("Empty response after cleaning")
                 return False, "Amazon Q returned an empty response"
         else:
             error_msg = result.stderr.strip()
-            print(f"🔍 DEBUG: Error message: {error_msg}")
-            logger.error(f"Amazon Q CLI chat error: {error_msg}")
+            logger.debug("Error message: %s", error_msg)
+            logger.error("Amazon Q CLI chat error: %s", error_msg)
             
             if "not logged in" in error_msg.lower():
-                print(f"🔍 DEBUG: Not logged in error detected")
+                logger.debug("Not logged in error detected")
                 return False, "Authentication required. Please login to Amazon Q CLI."
             elif "quota" in error_msg.lower() or "limit" in error_msg.lower():
-                print(f"🔍 DEBUG: Quota/limit error detected")
+                logger.debug("Quota/limit error detected")
                 return False, "Amazon Q usage limit reached. Please try again later."
             else:
-                print(f"🔍 DEBUG: Other error detected")
+                logger.debug("Other error detected")
                 return False, f"Amazon Q error: {clean_ansi_codes(error_msg)}"
                 
+    except AmazonQCircuitOpenError as e:
+        logger.warning("Amazon Q chat rejected by circuit breaker: %s", e)
+        return False, str(e)
     except subprocess.TimeoutExpired:
         logger.error("Amazon Q CLI chat request timed out")
         return False, "Request timed out. Please try again with a shorter message."
@@ -158,7 +863,7 @@ def chat_with_amazon_q(message: str, context: str = "") -> tuple[bool, str]:
         logger.error("Amazon Q CLI not found")
         return False, "Amazon Q CLI not found. Please ensure it's installed and configured."
     except Exception as e:
-        logger.error(f"Error in Amazon Q chat: {str(e)}")
+        logger.error("Error in Amazon Q chat: %s", e)
         return False, f"Error in Amazon Q chat: {str(e)}"
 
 
@@ -184,6 +889,9 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
         - Net improvement: {analysis_data['low_score_improvement_count']} customers
         - Improvement percentage: {analysis_data['low_score_improvement_pct']:.1f}%
 
+        Top movers between the compared months (customer, score change):
+        {analysis_data.get('top_movers', 'Not available')}
+
         Please write a professional summary including the following key points:
         1. Highlights the overall low-score trend and improvement metrics
         2. Analyzes the movement between categories (Exit, Return, New Comer)
@@ -196,22 +904,20 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
         """
 
         logger.info("Sending request to Amazon Q CLI...")
-        logger.debug(f"Prompt length: {len(prompt)} characters")
+        logger.debug("Prompt length: %s characters", len(prompt))
         
-        # Call Amazon Q CLI with --no-interactive and --trust-all-tools flags
-        result = subprocess.run([
-            'q', 'chat', '--no-interactive', '--trust-all-tools', prompt
-        ], capture_output=True, text=True, timeout=30)
+        # Call the active backend (Amazon Q CLI with --no-interactive and --trust-all-tools by default)
+        result = get_llm_backend().complete(prompt, operation='summary')
         
-        logger.info(f"Amazon Q CLI completed with return code: {result.returncode}")
+        logger.info("Amazon Q CLI completed with return code: %s", result.returncode)
         
         if result.returncode == 0:
             # Clean ANSI codes from the output
             raw_output = result.stdout.strip()
-            logger.info(f"Raw output length: {len(raw_output)} characters")
+            logger.info("Raw output length: %s characters", len(raw_output))
             
             cleaned_output = clean_ansi_codes(raw_output)
-            logger.info(f"Cleaned output length: {len(cleaned_output)} characters")
+            logger.info("Cleaned output length: %s characters", len(cleaned_output))
             
             # Save the AI summary to a file
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -219,9 +925,9 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
             try:
                 with open(summary_file, 'w', encoding='utf-8') as f:
                     f.write(cleaned_output)
-                logger.info(f"AI summary saved to {summary_file}")
+                logger.info("AI summary saved to %s", summary_file)
             except Exception as e:
-                logger.warning(f"Could not save summary to file: {e}")
+                logger.warning("Could not save summary to file: %s", e)
             
             # If the output is still messy, provide a fallback
             if len(cleaned_output) < 50 or '[' in cleaned_output[:100]:
@@ -232,7 +938,7 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
             return True, cleaned_output
         else:
             error_msg = result.stderr.strip()
-            logger.error(f"Amazon Q CLI error: {error_msg}")
+            logger.error("Amazon Q CLI error: %s", error_msg)
             
             if "not logged in" in error_msg.lower():
                 return False, "Authentication required. Please login to Amazon Q CLI."
@@ -241,6 +947,9 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
             else:
                 return False, f"Amazon Q error: {clean_ansi_codes(error_msg)}"
             
+    except AmazonQCircuitOpenError as e:
+        logger.warning("Amazon Q summary rejected by circuit breaker: %s", e)
+        return False, str(e)
     except subprocess.TimeoutExpired:
         logger.error("Amazon Q CLI request timed out")
         return False, "Request timed out. Please try again."
@@ -248,52 +957,106 @@ def generate_ai_summary(analysis_data: Dict) -> tuple[bool, str]:
         logger.error("Amazon Q CLI not found")
         return False, "Amazon Q CLI not found. Please ensure it's installed and configured."
     except Exception as e:
-        logger.error(f"Error generating AI summary: {str(e)}")
+        logger.error("Error generating AI summary: %s", e)
         return False, f"Error generating AI summary: {str(e)}"
 
-def detect_q_cli_commands() -> dict:
-    """Detect available Amazon Q CLI commands and their format"""
-    try:
-        # Check help output to determine command structure
-        help_result = subprocess.run(['q', '--help'], capture_output=True, text=True, timeout=5)
-        help_text = help_result.stdout.lower()
-        
-        commands = {
-            'login': ['q', 'login'],  # Default to simple commands
-            'logout': ['q', 'logout'],
-            'test': ['q', 'chat', 'hello']
-        }
-        
-        # Based on the error message, this CLI version uses simple commands
-        # Try different command patterns based on help text
-        if 'auth' in help_text and 'login' in help_text:
-            # Some versions might have both auth subcommand and direct login
-            commands['login'] = ['q', 'auth', 'login']
-            commands['logout'] = ['q', 'auth', 'logout']
-            commands['test'] = ['q', 'chat', '--no-interactive', '--trust-all-tools', 'hello']
-        else:
-            # Most common pattern based on the error message
-            commands['login'] = ['q', 'login']
-            commands['logout'] = ['q', 'logout']
-            commands['test'] = ['q', 'chat', 'hello']
-            
-        return commands
-        
-    except Exception:
-        # Default fallback based on observed behavior
+def _parse_q_help(help_text: str) -> dict:
+    """Derive the login/logout/test command format from `q --help` output"""
+    help_text = help_text.lower()
+    # Based on the error message, this CLI version uses simple commands
+    # Try different command patterns based on help text
+    if 'auth' in help_text and 'login' in help_text:
+        # Some versions might have both auth subcommand and direct login
         return {
-            'login': ['q', 'login'],
-            'logout': ['q', 'logout'],
-            'test': ['q', 'chat', 'hello']
+            'login': ['q', 'auth', 'login'],
+            'logout': ['q', 'auth', 'logout'],
+            'test': ['q', 'chat', '--no-interactive', '--trust-all-tools', 'hello']
         }
+    # Most common pattern based on the error message
+    return {
+        'login': ['q', 'login'],
+        'logout': ['q', 'logout'],
+        'test': ['q', 'chat', 'hello']
+    }
+
+
+# Capabilities of the installed q binary (version string and command format),
+# keyed by binary path + mtime and persisted across restarts, so `q --version`
+# and `q --help` only run again when the CLI is installed, upgraded or removed.
+Q_CAPABILITY_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'q_capabilities.json')
+_q_capabilities = {}
+_q_capabilities_lock = threading.Lock()
+
+
+def _q_binary_key() -> Tuple[str, float]:
+    path = shutil.which('q')
+    if not path:
+        return None, 0
+    try:
+        return os.path.realpath(path), os.stat(path).st_mtime
+    except OSError:
+        return None, 0
+
+
+def _probe_q_capabilities(path: str, mtime: float) -> Dict:
+    """Spawn `q --version` and `q --help` once for a given binary"""
+    caps = {'path': path, 'mtime': mtime, 'installed': False, 'version': None,
+            'commands': _parse_q_help(""), 'probed_at': time.time()}
+    if not path:
+        return caps
+    try:
+        version_result = run_q_command(['q', '--version'], operation='version')
+        if version_result.returncode != 0:
+            return caps
+        caps['installed'] = True
+        caps['version'] = version_result.stdout.strip()
+        help_result = run_q_command(['q', '--help'], operation='help')
+        caps['commands'] = _parse_q_help(help_result.stdout)
+    except (subprocess.TimeoutExpired, FileNotFoundError, OSError) as e:
+        logger.warning("Could not probe Amazon Q CLI capabilities: %s", e)
+    return caps
+
+
+def get_q_capabilities(refresh: bool = False) -> Dict:
+    """Cached q CLI capabilities: installed, version, commands, path, mtime.
+
+    Validation costs one PATH lookup and stat; the CLI is only spawned when the
+    binary's path or mtime differ from the cached entry (or `refresh` is set).
+    """
+    global _q_capabilities
+    path, mtime = _q_binary_key()
+    with _q_capabilities_lock:
+        if not _q_capabilities and not refresh:
+            try:
+                with open(Q_CAPABILITY_CACHE_FILE, encoding='utf-8') as f:
+                    _q_capabilities = json.load(f)
+            except (OSError, ValueError):
+                _q_capabilities = {}
+        cached = _q_capabilities
+        if not refresh and cached and cached.get('path') == path and cached.get('mtime') == mtime:
+            return cached
+
+        logger.info("Probing Amazon Q CLI capabilities for %s", path or 'missing binary')
+        caps = _probe_q_capabilities(path, mtime)
+        _q_capabilities = caps
+        try:
+            with open(Q_CAPABILITY_CACHE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(caps, f, indent=2)
+        except OSError as e:
+            logger.warning("Could not persist Amazon Q CLI capabilities: %s", e)
+        return caps
+
+
+def detect_q_cli_commands() -> dict:
+    """Detect available Amazon Q CLI commands and their format (from the capability cache)"""
+    return get_q_capabilities()['commands']
 
 
 def amazon_q_login_simple() -> tuple[bool, str]:
     """Simple approach: just provide instructions for manual login"""
     try:
         # Check if Q CLI is installed
-        version_result = subprocess.run(['q', '--version'], capture_output=True, text=True, timeout=5)
-        if version_result.returncode != 0:
+        if not get_q_capabilities()['installed']:
             return False, "Amazon Q CLI not installed. Please install it first."
         
         # Return instructions for manual login
@@ -318,8 +1081,7 @@ def amazon_q_login() -> tuple[bool, str]:
         logger.info("Attempting Amazon Q CLI login...")
         
         # First check if Q CLI is installed
-        version_result = subprocess.run(['q', '--version'], capture_output=True, text=True, timeout=5)
-        if version_result.returncode != 0:
+        if not get_q_capabilities()['installed']:
             return False, "Amazon Q CLI not installed. Please install it first."
         
         # Check if already logged in first
@@ -332,7 +1094,7 @@ def amazon_q_login() -> tuple[bool, str]:
         return amazon_q_login_simple()
             
     except Exception as e:
-        logger.error(f"Error during Amazon Q login: {str(e)}")
+        logger.error("Error during Amazon Q login: %s", e)
         return False, f"Login error: {str(e)}. Please try manual login."
 
 
@@ -348,14 +1110,14 @@ def amazon_q_logout() -> tuple[bool, str]:
         if not logout_cmd:
             return False, "Unable to determine logout command format. Please logout manually."
         
-        logout_result = subprocess.run(logout_cmd, capture_output=True, text=True, timeout=30)
+        logout_result = run_q_command(logout_cmd, operation='logout')
         
         if logout_result.returncode == 0:
             logger.info("Amazon Q CLI logout successful")
             return True, "Logout successful!"
         else:
             error_msg = logout_result.stderr.strip() or logout_result.stdout.strip()
-            logger.error(f"Amazon Q CLI logout failed: {error_msg}")
+            logger.error("Amazon Q CLI logout failed: %s", error_msg)
             
             # Provide helpful error message
             if "unrecognized subcommand" in error_msg:
@@ -364,38 +1126,45 @@ def amazon_q_logout() -> tuple[bool, str]:
                 return False, f"Logout failed: {error_msg}"
             
     except Exception as e:
-        logger.error(f"Error during Amazon Q logout: {str(e)}")
+        logger.error("Error during Amazon Q logout: %s", e)
         return False, f"Logout error: {str(e)}"
 
 
 def check_amazon_q_availability() -> tuple[bool, str]:
     """Check if Amazon Q CLI is available and configured with caching"""
     global _amazon_q_cache
-    
+
+    # Non-CLI backends need no login or installation check
+    backend = get_llm_backend()
+    if not isinstance(backend, QCliBackend):
+        return True, f"Available ({backend.describe()})"
+
     # Check cache first
     current_time = time.time()
     if (_amazon_q_cache['timestamp'] > 0 and 
         current_time - _amazon_q_cache['timestamp'] < _amazon_q_cache['cache_duration']):
-        logger.info(f"Using cached Amazon Q status: {_amazon_q_cache['message']}")
+        logger.debug("Using cached Amazon Q status: %s", _amazon_q_cache['message'])
         return _amazon_q_cache['status'], _amazon_q_cache['message']
     
     try:
         logger.info("Checking Amazon Q CLI availability...")
         
         # Check if CLI is installed
-        version_result = subprocess.run(['q', '--version'], capture_output=True, text=True, timeout=5)
-        if version_result.returncode != 0:
+        capabilities = get_q_capabilities()
+        if not capabilities['path']:
+            raise FileNotFoundError("q")
+        if not capabilities['installed']:
             logger.error("Amazon Q CLI not installed")
             result = (False, "Amazon Q CLI not installed")
             _amazon_q_cache.update({'status': result[0], 'message': result[1], 'timestamp': current_time})
             return result
         
-        logger.info(f"Amazon Q CLI version: {version_result.stdout.strip()}")
+        logger.info("Amazon Q CLI version: %s", capabilities['version'])
         
         # Use a faster login status check instead of chat command
         try:
             # Method 1: Try login command to check if already logged in (fastest)
-            login_check = subprocess.run(['q', 'login'], capture_output=True, text=True, timeout=3)
+            login_check = run_q_command(capabilities['commands']['login'], operation='status')
             stderr_lower = login_check.stderr.lower()
             stdout_lower = login_check.stdout.lower()
             
@@ -407,7 +1176,7 @@ def check_amazon_q_availability() -> tuple[bool, str]:
                 return result
             
             # Method 2: If login check doesn't show "already logged in", try help command
-            help_result = subprocess.run(['q', 'chat', '--help'], capture_output=True, text=True, timeout=3)
+            help_result = run_q_command(['q', 'chat', '--help'], operation='status')
             if help_result.returncode == 0:
                 # If help works, assume logged in (skip slow chat test)
                 logger.info("Help command works, assuming CLI is available")
@@ -422,7 +1191,7 @@ def check_amazon_q_availability() -> tuple[bool, str]:
                     _amazon_q_cache.update({'status': result[0], 'message': result[1], 'timestamp': current_time})
                     return result
                 else:
-                    logger.error(f"Help command failed: {help_result.stderr}")
+                    logger.error("Help command failed: %s", help_result.stderr)
                     result = (False, f"CLI error: {help_result.stderr[:100]}")
                     _amazon_q_cache.update({'status': result[0], 'message': result[1], 'timestamp': current_time})
                     return result
@@ -444,633 +1213,242 @@ def check_amazon_q_availability() -> tuple[bool, str]:
         _amazon_q_cache.update({'status': result[0], 'message': result[1], 'timestamp': current_time})
         return result
     except Exception as e:
-        logger.error(f"Error checking Amazon Q: {str(e)}")
+        logger.error("Error checking Amazon Q: %s", e)
         result = (False, f"Error checking Amazon Q: {str(e)}")
         _amazon_q_cache.update({'status': result[0], 'message': result[1], 'timestamp': current_time})
         return result
 
 
 def clear_amazon_q_cache():
-    """Clear the Amazon Q status cache to force a fresh check"""
+    """Clear the Amazon Q status cache (and circuit breaker) to force a fresh check"""
     global _amazon_q_cache
     _amazon_q_cache['timestamp'] = 0
+    reset_amazon_q_breaker()
     logger.info("Amazon Q status cache cleared")
 
 
-
-
-
 # -------------------------------
-# Utility helpers
+# Chat history management
 # -------------------------------
 
-def _first_nonempty_row_as_header(df: pd.DataFrame, search_cols: List[str] = None, start_row: int = 0, end_row: int = 20) -> Tuple[pd.DataFrame, int]:
-    """Try to find the header row by scanning a range of rows.
-    We look for a row that contains all keywords in `search_cols` (case-insensitive, substring match).
-    Returns (cleaned_df, header_row_index_in_original_df)
-    """
-    search_cols = search_cols or ["Customer", "Security", "Overall"]
-    header_idx_found = None
-    for i in range(start_row, min(len(df), end_row)):
-        row_vals = df.iloc[i].astype(str).fillna("")
-        hits = 0
-        for key in search_cols:
-            if any(key.lower() in str(v).lower() for v in row_vals.values):
-                hits += 1
-        if hits >= max(2, len(search_cols) - 1):  # heuristic: at least 2 hits
-            header_idx_found = i
-            break
+# Recent turns kept verbatim in session state; older ones are compacted into
+# a short digest. Every turn is also appended to an on-disk transcript so the
+# full conversation stays available for export.
+CHAT_HISTORY_MAX_TURNS = int(os.environ.get('CHI_CHAT_MAX_TURNS', '8'))
+CHAT_HISTORY_MAX_BYTES = int(float(os.environ.get('CHI_CHAT_MAX_KB', '48')) * 1024)
+CHAT_DIGEST_MAX_LINES = int(os.environ.get('CHI_CHAT_DIGEST_LINES', '20'))
+CHAT_ARCHIVE_DIR = os.environ.get('CHI_CHAT_ARCHIVE_DIR',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_archive'))
 
-    if header_idx_found is None:
-        # fallback to the provided header row (commonly 3) without changes
-        header_idx_found = start_row
 
-    new_df = df.copy()
-    new_df.columns = new_df.iloc[header_idx_found].astype(str)
-    new_df = new_df.iloc[header_idx_found + 1 :].reset_index(drop=True)
-    # drop fully-empty columns
-    new_df = new_df.dropna(axis=1, how="all")
-    return new_df, header_idx_found
+def _chat_turn_bytes(turn: Tuple[str, str]) -> int:
+    return len(turn[0].encode('utf-8')) + len(turn[1].encode('utf-8'))
 
 
-def _coerce_numeric(series: pd.Series) -> pd.Series:
-    return pd.to_numeric(series, errors="coerce")
+def _digest_line(question: str, answer: str) -> str:
+    """One-line digest of a chat turn: the question and the first sentence of the answer"""
+    first_sentence = re.split(r'(?<=[.!?])\s', answer.strip(), maxsplit=1)[0]
+    question = " ".join(question.split())
+    first_sentence = " ".join(first_sentence.split())
+    return f"- Q: {question[:80]} -> A: {first_sentence[:120]}"
 
 
-def _normalize_colnames(cols: List[str]) -> List[str]:
-    return [re.sub(r"\s+", " ", c).strip() for c in cols]
+def init_chat_state(state) -> None:
+    """Ensure the chat history keys exist in `state` (st.session_state or a dict)"""
+    if "chat_history" not in state:
+        state["chat_history"] = []
+    if "chat_digest" not in state:
+        state["chat_digest"] = []
+    if "chat_compacted_turns" not in state:
+        state["chat_compacted_turns"] = 0
+    if "chat_archive_id" not in state:
+        state["chat_archive_id"] = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.urandom(4).hex()}"
 
 
-# -------------------------------
-# Category logic
-# -------------------------------
+def chat_archive_path(state) -> str:
+    return os.path.join(CHAT_ARCHIVE_DIR, f"chat_transcript_{state['chat_archive_id']}.jsonl")
 
-def calculate_low_score_metrics(df: pd.DataFrame, col_prev: str, col_curr: str, threshold: float = 42) -> Dict[str, int]:
-    """Calculate overall low security score metrics for trend analysis"""
-    work = df.copy()
-    work[col_prev] = _coerce_numeric(work[col_prev])
-    work[col_curr] = _coerce_numeric(work[col_curr])
-    
-    # Count customers with low scores in previous month (excluding NaN)
-    prev_low_count = len(work[(work[col_prev] < threshold) & work[col_prev].notna()])
-    
-    # Count customers with low scores in current month (excluding NaN)
-    curr_low_count = len(work[(work[col_curr] < threshold) & work[col_curr].notna()])
-    
-    # Calculate improvement metrics
-    improvement_count = prev_low_count - curr_low_count
-    if prev_low_count > 0:
-        improvement_percentage = (improvement_count / prev_low_count) * 100
-    else:
-        improvement_percentage = 0
-    
-    return {
-        "prev_month_low_total": prev_low_count,
-        "curr_month_low_total": curr_low_count,
-        "improvement_count": improvement_count,
-        "improvement_percentage": improvement_percentage
-    }
 
-def classify(df: pd.DataFrame, col_prev: str, col_curr: str, col_overall: str, threshold: float = 42) -> Dict[str, pd.DataFrame]:
-    """Classify customers into 4 categories based on previous vs current scores.
+def record_chat_turn(state, question: str, answer: str,
+                     max_turns: int = CHAT_HISTORY_MAX_TURNS,
+                     max_bytes: int = CHAT_HISTORY_MAX_BYTES) -> None:
+    """Append a turn to the history, archive it on disk and compact older turns.
 
-    Definitions used:
-      - Exit from Red:     prev < threshold  AND curr >= threshold
-      - Return Back to Red:prev >= threshold AND curr < threshold
-      - New Comer to Red:  prev is NaN       AND curr < threshold
-      - Missing from CHI:  Overall Score is NaN (regardless of prev/curr)
+    Oldest turns are moved into the digest until at most `max_turns` turns and
+    `max_bytes` of text remain (the newest turn is always kept verbatim).
     """
-    work = df.copy()
-    work[col_prev] = _coerce_numeric(work[col_prev])
-    work[col_curr] = _coerce_numeric(work[col_curr])
-    if col_overall in work.columns:
-        work[col_overall] = _coerce_numeric(work[col_overall])
-    else:
-        work[col_overall] = pd.NA
+    init_chat_state(state)
+    try:
+        os.makedirs(CHAT_ARCHIVE_DIR, exist_ok=True)
+        with open(chat_archive_path(state), 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'timestamp': datetime.now().isoformat(),
+                                'question': question, 'answer': answer}) + "\n")
+    except OSError as e:
+        logger.warning("Could not archive chat turn: %s", e)
+
+    history = list(state["chat_history"]) + [(question, answer)]
+    digest = list(state["chat_digest"])
+    total_bytes = sum(_chat_turn_bytes(t) for t in history)
+    compacted = 0
+    while len(history) > 1 and (len(history) > max_turns or total_bytes > max_bytes):
+        old_q, old_a = history.pop(0)
+        total_bytes -= _chat_turn_bytes((old_q, old_a))
+        digest.append(_digest_line(old_q, old_a))
+        compacted += 1
+
+    if compacted:
+        state["chat_compacted_turns"] += compacted
+        logger.info("Compacted %s chat turns into digest (%s total)", compacted, state['chat_compacted_turns'])
+    state["chat_history"] = history
+    state["chat_digest"] = digest[-CHAT_DIGEST_MAX_LINES:]
+
+
+def get_chat_digest(state) -> str:
+    """Digest of compacted turns for chat context and exports ('' if nothing was compacted)"""
+    digest = state.get("chat_digest") or []
+    if not digest:
+        return ""
+    omitted = state.get("chat_compacted_turns", 0) - len(digest)
+    header = f"({omitted} earlier turns omitted)\n" if omitted > 0 else ""
+    return header + "\n".join(digest)
+
+
+def load_chat_transcript(state) -> List[Tuple[str, str]]:
+    """All turns of this conversation from the on-disk archive (falls back to the in-memory history)"""
+    if "chat_archive_id" not in state or not os.path.exists(chat_archive_path(state)):
+        return list(state.get("chat_history", []))
+    turns = []
+    with open(chat_archive_path(state), encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+                turns.append((entry['question'], entry['answer']))
+            except (ValueError, KeyError):
+                continue
+    return turns
 
-    exit_from_red = work[(work[col_prev] < threshold) & (work[col_curr] >= threshold)]
-    return_back_red = work[(work[col_prev] >= threshold) & (work[col_curr] < threshold)]
-    new_comer_red = work[work[col_prev].isna() & (work[col_curr] < threshold)]
-    missing_from_chi = work[work[col_overall].isna()]
 
-    return {
-        "Exit from Red": exit_from_red,
-        "Return Back to Red": return_back_red,
-        "New Comer to Red": new_comer_red,
-        "Missing from CHI": missing_from_chi,
-    }
+def clear_chat_state(state) -> None:
+    """Drop history, digest and transcript; the next turn starts a new archive file"""
+    if "chat_archive_id" in state and os.path.exists(chat_archive_path(state)):
+        try:
+            os.remove(chat_archive_path(state))
+        except OSError as e:
+            logger.warning("Could not remove chat archive: %s", e)
+    for key in ("chat_history", "chat_digest", "chat_compacted_turns", "chat_archive_id"):
+        if key in state:
+            del state[key]
+    init_chat_state(state)
 
 
-def summarize_tables(tables: Dict[str, pd.DataFrame], col_customer: str, col_prev: str, col_curr: str) -> pd.DataFrame:
-    rows = []
-    for cat, dfc in tables.items():
-        if dfc is None or dfc.empty:
-            continue
-        for _, r in dfc[[col_customer, col_prev, col_curr]].fillna("").iterrows():
-            rows.append({
-                "Category": cat,
-                "Customer": r[col_customer],
-                "Prev Score": r[col_prev],
-                "Curr Score": r[col_curr],
-            })
-    return pd.DataFrame(rows)
+# -------------------------------
+# Background analysis
+# -------------------------------
 
+# Pre-parsing, deferred trend sections and portfolio analyses run the
+# chi_analysis_core stages on a worker pool shared by all sessions.
+BACKGROUND_WORKERS = int(os.environ.get('CHI_BACKGROUND_WORKERS', '2'))
+TREND_TIME_BUDGET_SECONDS = float(os.environ.get('CHI_TREND_BUDGET_S', '1.5'))
+TREND_POLL_SECONDS = 1.0
 
-def extract_historical_data(xls: pd.ExcelFile, threshold: float = 42) -> pd.DataFrame:
-    """Extract historical trend data from all sheets in the Excel file"""
-    historical_data = []
-    
-    # Get all sheet names and filter for date-like sheets
-    sheet_names = [s for s in xls.sheet_names if s != "Sheet1"]
-    
-    # Sort sheet names to get chronological order
-    date_sheets = []
-    for sheet in sheet_names:
-        try:
-            # Try to parse as date (assuming format like "2025-04-07")
-            if re.match(r'\d{4}-\d{2}-\d{2}', sheet):
-                date_sheets.append((pd.to_datetime(sheet), sheet))
-        except:
-            continue
-    
-    # Sort by date
-    date_sheets.sort(key=lambda x: x[0])
-    
-    logger.info(f"Found {len(date_sheets)} dated sheets for trend analysis")
-    
-    for date_obj, sheet_name in date_sheets:
+
+@st.cache_resource
+def get_background_executor() -> ThreadPoolExecutor:
+    """Process-wide worker pool for sheet pre-parsing and deferred sections"""
+    return ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="chi-background")
+
+
+def start_preparse(pipeline: AnalysisPipeline, workbook: StageResult, priority_sheets: List[str] = (),
+                   customers: CustomerDictionary = None) -> Future:
+    """Parse Sheet1 and every dated sheet into the shared cache in the background.
+
+    Sheets in priority_sheets (the user's current selection) are parsed first,
+    and each dated sheet's customers are interned right after parsing.
+    The UI's own stage calls then either hit the cache or wait on the parse
+    already in flight for the sheet they need.
+    """
+    cache = pipeline.cache
+    if customers is None:
+        customers = get_customer_dictionary()
+
+    def job():
+        start = time.perf_counter()
         try:
-            # Load the sheet
-            raw_sheet = pd.read_excel(xls, sheet_name=sheet_name, header=None)
-            sheet_df, _ = _first_nonempty_row_as_header(raw_sheet, start_row=0, end_row=20)
-            sheet_df.columns = _normalize_colnames(list(sheet_df.columns))
-            
-            # Find security score column
-            sec_col = None
-            for col in sheet_df.columns:
-                if re.search(r"security score", col, flags=re.I):
-                    sec_col = col
-                    break
-            
-            if sec_col:
-                # Calculate metrics for this month
-                sheet_df[sec_col] = _coerce_numeric(sheet_df[sec_col])
-                low_score_count = len(sheet_df[(sheet_df[sec_col] < threshold) & sheet_df[sec_col].notna()])
-                total_customers = len(sheet_df[sheet_df[sec_col].notna()])
-                
-                historical_data.append({
-                    'date': date_obj,
-                    'month_label': date_obj.strftime('%Y-%m'),
-                    'sheet_name': sheet_name,
-                    'low_score_customers': low_score_count,
-                    'total_customers': total_customers,
-                    'low_score_percentage': (low_score_count / total_customers * 100) if total_customers > 0 else 0
-                })
-                
-                logger.info(f"Processed {sheet_name}: {low_score_count} low-score customers out of {total_customers}")
-            
+            col_customer = AnalysisPipeline.prefetch(cache, "parse_sheet1", load_sheet1, [workbook]).value[1]
+            names = AnalysisPipeline.prefetch(cache, "sheet_names", list_sheet_names, [workbook]).value
+            dated = [s for s in names if s != SHEET1_NAME]
+            ordered = [s for s in priority_sheets if s in dated] + [s for s in dated if s not in priority_sheets]
+            for sheet in ordered:
+                parsed = AnalysisPipeline.prefetch(cache, "parse_sheet", load_dated_sheet, [workbook], sheet=sheet)
+                if col_customer is not None:
+                    AnalysisPipeline.prefetch(cache, "customer_ids", encode_customers, [parsed],
+                                              col_customer=col_customer, dictionary=customers)
+            logger.info("Pre-parsed %s sheets in %.2fs", len(ordered) + 1, time.perf_counter() - start)
         except Exception as e:
-            logger.warning(f"Could not process sheet {sheet_name}: {e}")
-            continue
-    
-    return pd.DataFrame(historical_data)
+            # The UI parses on demand and reports the error itself
+            logger.warning("Background pre-parse stopped: %s", e)
+
+    return get_background_executor().submit(job)
+
+
+def start_trend_job(pipeline: AnalysisPipeline, workbook: StageResult, classified: StageResult,
+                    threshold: float, dataset: str, col_customer: str, col_overall: str,
+                    customers: CustomerDictionary) -> Future:
+    """Compute history, monthly changes, the trend chart, month bitsets and red-zone streaks into the
+    shared cache in the background"""
+    cache = pipeline.cache
+    warehouse = get_history_warehouse()
+
+    def job():
+        prefetch = lambda name, fn, deps=(), **params: AnalysisPipeline.prefetch(cache, name, fn, deps, **params)
+        history = history_stage(prefetch, warehouse, workbook, threshold, dataset)
+        if not history.value.empty:
+            monthly = AnalysisPipeline.prefetch(cache, "monthly_changes", calculate_monthly_changes,
+                                                [history, classified])
+            AnalysisPipeline.prefetch(cache, "trend_chart", create_trend_chart, [monthly])
+        month_bits = month_bitsets_stage(prefetch, workbook, col_customer, col_overall, threshold, customers)
+        prefetch("red_streaks", compute_red_streaks, [month_bits], col_customer=col_customer, dictionary=customers)
+
+    return get_background_executor().submit(job)
+
+
+@st.cache_resource
+def get_history_warehouse() -> "HistoryWarehouse | None":
+    """The process-wide history warehouse, or None when disabled or the file cannot be opened"""
+    if not HISTORY_DB:
+        return None
+    try:
+        return HistoryWarehouse(HISTORY_DB)
+    except sqlite3.Error as e:
+        logger.warning("History warehouse disabled, cannot open %s: %s", HISTORY_DB, e)
+        return None
 
-def calculate_monthly_changes(historical_df: pd.DataFrame, tables: Dict[str, pd.DataFrame]) -> pd.DataFrame:
-    """Calculate month-over-month changes including exits and returns"""
-    if len(historical_df) < 2:
-        return historical_df
-    
-    # Add change metrics
-    historical_df = historical_df.copy()
-    historical_df['exit_from_red'] = 0
-    historical_df['return_to_red'] = 0
-    historical_df['net_change'] = 0
-    
-    # Calculate changes for each month (except the first)
-    for i in range(1, len(historical_df)):
-        prev_count = historical_df.iloc[i-1]['low_score_customers']
-        curr_count = historical_df.iloc[i]['low_score_customers']
-        net_change = prev_count - curr_count
-        
-        historical_df.loc[i, 'net_change'] = net_change
-        
-        # For the latest month, use actual data from classification
-        if i == len(historical_df) - 1:
-            historical_df.loc[i, 'exit_from_red'] = len(tables.get("Exit from Red", []))
-            historical_df.loc[i, 'return_to_red'] = len(tables.get("Return Back to Red", []))
-        else:
-            # Estimate based on net change (simplified)
-            if net_change > 0:
-                historical_df.loc[i, 'exit_from_red'] = max(0, net_change)
-            else:
-                historical_df.loc[i, 'return_to_red'] = max(0, abs(net_change))
-    
-    return historical_df
 
-def create_trend_chart(historical_df: pd.DataFrame) -> go.Figure:
-    """Create a comprehensive trend chart from historical data"""
-    
-    if historical_df.empty:
-        # Create empty chart with message
-        fig = go.Figure()
-        fig.add_annotation(
-            text="No historical data available for trend analysis",
-            xref="paper", yref="paper",
-            x=0.5, y=0.5, xanchor='center', yanchor='middle',
-            showarrow=False, font=dict(size=16)
-        )
-        return fig
-    
-    # Create the figure
-    fig = go.Figure()
-    
-    # Add Low Score Customers trend line (red)
-    fig.add_trace(go.Scatter(
-        x=historical_df['month_label'],
-        y=historical_df['low_score_customers'],
-        mode='lines+markers',
-        name='Low Score Customers (<42)',
-        line=dict(color='red', width=3),
-        marker=dict(size=8),
-        hovertemplate='<b>%{x}</b><br>Low Score Customers: %{y}<extra></extra>'
-    ))
-    
-    # Add Exit from Red trend line (green)
-    fig.add_trace(go.Scatter(
-        x=historical_df['month_label'],
-        y=historical_df['exit_from_red'],
-        mode='lines+markers',
-        name='Exit from Red (Improved)',
-        line=dict(color='green', width=3),
-        marker=dict(size=8),
-        hovertemplate='<b>%{x}</b><br>Exits from Red: %{y}<extra></extra>'
-    ))
-    
-    # Add Return to Red trend line (orange)
-    fig.add_trace(go.Scatter(
-        x=historical_df['month_label'],
-        y=historical_df['return_to_red'],
-        mode='lines+markers',
-        name='Return Back to Red',
-        line=dict(color='orange', width=3),
-        marker=dict(size=8),
-        hovertemplate='<b>%{x}</b><br>Returns to Red: %{y}<extra></extra>'
-    ))
-    
-    # Update layout
-    fig.update_layout(
-        title={
-            'text': 'Security Score Historical Trends',
-            'x': 0.5,
-            'xanchor': 'center',
-            'font': {'size': 20}
-        },
-        xaxis_title='Month',
-        yaxis_title='Number of Customers',
-        hovermode='x unified',
-        legend=dict(
-            orientation="h",
-            yanchor="bottom",
-            y=1.02,
-            xanchor="right",
-            x=1
-        ),
-        height=500,
-        showlegend=True,
-        xaxis=dict(tickangle=45)
-    )
-    
-    # Add trend annotations for the latest month
-    if len(historical_df) > 1:
-        latest = historical_df.iloc[-1]
-        previous = historical_df.iloc[-2]
-        change = latest['low_score_customers'] - previous['low_score_customers']
-        
-        fig.add_annotation(
-            x=latest['month_label'],
-            y=latest['low_score_customers'],
-            text=f"Latest: {latest['low_score_customers']} customers<br>Change: {change:+d}",
-            showarrow=True,
-            arrowhead=2,
-            arrowcolor="red" if change > 0 else "green",
-            bgcolor="white",
-            bordercolor="red" if change > 0 else "green"
-        )
-    
-    return fig
-
-def export_excel(tables: Dict[str, pd.DataFrame], summary_df: pd.DataFrame) -> bytes:
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        summary_df.to_excel(writer, index=False, sheet_name="Summary")
-        for name, dfc in tables.items():
-            (dfc if not dfc.empty else pd.DataFrame({"Message": ["No records"]})) \
-                .to_excel(writer, index=False, sheet_name=name[:31])
-    output.seek(0)
-    return output.read()
-
-
-def export_pdf(tables: Dict[str, pd.DataFrame], summary_df: pd.DataFrame, 
-               analysis_summary: str = "", ai_summary: str = "", 
-               chat_history: List[Tuple[str, str]] = None) -> bytes:
-    """Export analysis results to PDF format with rich web-like layout including Amazon Q chat history"""
-    if not PDF_AVAILABLE:
-        raise ImportError("reportlab is required for PDF export. Install with: pip install reportlab")
-    
-    output = io.BytesIO()
-    
-    # Use A4 portrait for better readability
-    doc = SimpleDocTemplate(output, pagesize=A4, 
-                          rightMargin=0.75*inch, leftMargin=0.75*inch,
-                          topMargin=0.75*inch, bottomMargin=0.75*inch)
-    
-    # Enhanced styles matching web layout
-    styles = getSampleStyleSheet()
-    
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=20,
-        spaceAfter=20,
-        alignment=1,  # Center alignment
-        textColor=colors.darkblue,
-        fontName='Helvetica-Bold'
-    )
-    
-    subtitle_style = ParagraphStyle(
-        'CustomSubtitle',
-        parent=styles['Normal'],
-        fontSize=12,
-        spaceAfter=15,
-        alignment=1,
-        textColor=colors.grey,
-        fontName='Helvetica'
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading2'],
-        fontSize=14,
-        spaceAfter=10,
-        spaceBefore=15,
-        textColor=colors.darkblue,
-        fontName='Helvetica-Bold',
-        borderWidth=1,
-        borderColor=colors.lightblue,
-        borderPadding=5,
-        backColor=colors.lightblue
-    )
-    
-    subheading_style = ParagraphStyle(
-        'CustomSubheading',
-        parent=styles['Heading3'],
-        fontSize=12,
-        spaceAfter=8,
-        spaceBefore=10,
-        textColor=colors.darkgreen,
-        fontName='Helvetica-Bold'
-    )
-    
-    normal_style = ParagraphStyle(
-        'CustomNormal',
-        parent=styles['Normal'],
-        fontSize=10,
-        spaceAfter=6,
-        fontName='Helvetica'
-    )
-    
-    metric_style = ParagraphStyle(
-        'MetricStyle',
-        parent=styles['Normal'],
-        fontSize=11,
-        spaceAfter=4,
-        fontName='Helvetica-Bold',
-        textColor=colors.darkred
-    )
-    
-    # Build content with rich layout
-    story = []
-    
-    # Header section
-    story.append(Paragraph("🔍 CHI Low Security Score Analysis Report", title_style))
-    story.append(Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", subtitle_style))
-    story.append(Spacer(1, 20))
-    
-    # Executive Summary Box
-    story.append(Paragraph("📊 Executive Summary", heading_style))
-    
-    # Calculate key metrics
-    total_customers = len(summary_df) if not summary_df.empty else 0
-    exit_red_count = len(tables.get('Exit from Red', []))
-    return_red_count = len(tables.get('Return Back to Red', []))
-    new_red_count = len(tables.get('New Comer to Red', []))
-    missing_count = len(tables.get('Missing from CHI', []))
-    
-    # Key metrics in a highlighted box
-    metrics_data = [
-        ['📈 Total Customers Analyzed', str(total_customers)],
-        ['✅ Customers Exiting Red Zone', f"{exit_red_count} ({(exit_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
-        ['⚠️ Customers Returning to Red', f"{return_red_count} ({(return_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
-        ['🆕 New Customers in Red Zone', f"{new_red_count} ({(new_red_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"],
-        ['❓ Missing from CHI', f"{missing_count} ({(missing_count/total_customers*100):.1f}%)" if total_customers > 0 else "0"]
-    ]
-    
-    metrics_table = Table(metrics_data, colWidths=[4*inch, 2*inch])
-    metrics_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, -1), colors.lightblue),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.darkblue),
-        ('ALIGN', (0, 0), (0, -1), 'LEFT'),
-        ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
-        ('FONTNAME', (0, 0), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 11),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.darkblue),
-        ('ROWBACKGROUNDS', (0, 0), (-1, -1), [colors.lightblue, colors.white])
-    ]))
-    story.append(metrics_table)
-    story.append(Spacer(1, 20))
-    
-    # Analysis Summary (if provided)
-    if analysis_summary:
-        story.append(Paragraph("📋 Analysis Summary", heading_style))
-        story.append(Paragraph(analysis_summary, normal_style))
-        story.append(Spacer(1, 15))
-    
-    # AI Summary (if available)
-    if ai_summary:
-        story.append(Paragraph("🤖 AI-Generated Insights", heading_style))
-        # Clean and format AI summary with better formatting
-        clean_summary = ai_summary.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
-        # Add some styling to the AI summary
-        ai_summary_style = ParagraphStyle(
-            'AISummary',
-            parent=normal_style,
-            backColor=colors.lightyellow,
-            borderColor=colors.orange,
-            borderWidth=1,
-            borderPadding=10,
-            fontSize=10
-        )
-        story.append(Paragraph(clean_summary, ai_summary_style))
-        story.append(Spacer(1, 20))
-    
-    # Amazon Q Chat History (if available)
-    if chat_history and len(chat_history) > 0:
-        story.append(Paragraph("💬 Amazon Q Chat History & Improvements", heading_style))
-        
-        # Chat history styles
-        question_style = ParagraphStyle(
-            'ChatQuestion',
-            parent=normal_style,
-            backColor=colors.lightblue,
-            borderColor=colors.blue,
-            borderWidth=1,
-            borderPadding=8,
-            fontSize=9,
-            fontName='Helvetica-Bold'
-        )
-        
-        answer_style = ParagraphStyle(
-            'ChatAnswer',
-            parent=normal_style,
-            backColor=colors.lightgrey,
-            borderColor=colors.darkgrey,
-            borderWidth=1,
-            borderPadding=8,
-            fontSize=9,
-            leftIndent=20
-        )
-        
-        for i, (question, answer) in enumerate(chat_history):
-            # Add chat number
-            story.append(Paragraph(f"<b>Chat {i+1}:</b>", normal_style))
-            story.append(Spacer(1, 5))
-            
-            # Add question
-            clean_question = question.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
-            story.append(Paragraph(f"<b>Question:</b> {clean_question}", question_style))
-            story.append(Spacer(1, 5))
-            
-            # Add answer
-            clean_answer = answer.replace('\n\n', '<br/><br/>').replace('\n', '<br/>')
-            story.append(Paragraph(f"<b>Amazon Q Response:</b><br/>{clean_answer}", answer_style))
-            story.append(Spacer(1, 15))
-        
-        story.append(Spacer(1, 20))
-    
-    # Detailed Customer Analysis by Category
-    story.append(Paragraph("👥 Detailed Customer Analysis", heading_style))
-    
-    # Create detailed sections for each category
-    category_configs = [
-        ('Exit from Red', '✅', colors.green, 'Customers who improved their security scores'),
-        ('Return Back to Red', '⚠️', colors.orange, 'Customers whose security scores deteriorated'),
-        ('New Comer to Red', '🆕', colors.red, 'New customers with low security scores'),
-        ('Missing from CHI', '❓', colors.grey, 'Customers missing from current analysis')
-    ]
-    
-    for category, emoji, color, description in category_configs:
-        df = tables.get(category, pd.DataFrame())
-        
-        # Category header
-        story.append(Paragraph(f"{emoji} {category}", subheading_style))
-        story.append(Paragraph(description, normal_style))
-        
-        if not df.empty and 'Customer' in df.columns:
-            # Show customer count
-            story.append(Paragraph(f"Total customers: {len(df)}", metric_style))
-            
-            # Create customer table with additional details if available
-            customer_data = [['Customer Name']]
-            
-            # Add score columns if available
-            if 'Security Score (Current)' in df.columns:
-                customer_data[0].append('Current Score')
-            if 'Security Score (Previous)' in df.columns:
-                customer_data[0].append('Previous Score')
-            if 'Change' in df.columns:
-                customer_data[0].append('Change')
-            
-            # Add customer rows (limit to 20 for space)
-            for idx, row in df.head(20).iterrows():
-                customer_row = [str(row.get('Customer', 'N/A'))]
-                
-                if 'Security Score (Current)' in df.columns:
-                    current_score = row.get('Security Score (Current)', 'N/A')
-                    customer_row.append(f"{current_score:.1f}" if isinstance(current_score, (int, float)) else str(current_score))
-                
-                if 'Security Score (Previous)' in df.columns:
-                    prev_score = row.get('Security Score (Previous)', 'N/A')
-                    customer_row.append(f"{prev_score:.1f}" if isinstance(prev_score, (int, float)) else str(prev_score))
-                
-                if 'Change' in df.columns:
-                    change = row.get('Change', 'N/A')
-                    if isinstance(change, (int, float)):
-                        change_str = f"{change:+.1f}"
-                        customer_row.append(change_str)
-                    else:
-                        customer_row.append(str(change))
-                
-                customer_data.append(customer_row)
-            
-            # Show "and X more..." if there are more customers
-            if len(df) > 20:
-                more_row = [f"... and {len(df) - 20} more customers"] + [''] * (len(customer_data[0]) - 1)
-                customer_data.append(more_row)
-            
-            # Create table
-            if len(customer_data) > 1:
-                # Calculate column widths
-                num_cols = len(customer_data[0])
-                if num_cols == 1:
-                    col_widths = [6*inch]
-                elif num_cols == 2:
-                    col_widths = [4*inch, 2*inch]
-                elif num_cols == 3:
-                    col_widths = [3*inch, 1.5*inch, 1.5*inch]
-                else:
-                    col_widths = [2.5*inch, 1.2*inch, 1.2*inch, 1.1*inch]
-                
-                customer_table = Table(customer_data, colWidths=col_widths)
-                customer_table.setStyle(TableStyle([
-                    ('BACKGROUND', (0, 0), (-1, 0), color),
-                    ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-                    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-                    ('ALIGN', (1, 0), (-1, -1), 'CENTER'),
-                    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                    ('FONTSIZE', (0, 0), (-1, 0), 10),
-                    ('FONTSIZE', (0, 1), (-1, -1), 9),
-                    ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-                    ('TOPPADDING', (0, 1), (-1, -1), 4),
-                    ('BOTTOMPADDING', (0, 1), (-1, -1), 4),
-                    ('BACKGROUND', (0, 1), (-1, -1), colors.white),
-                    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
-                    ('VALIGN', (0, 0), (-1, -1), 'MIDDLE')
-                ]))
-                story.append(customer_table)
-        else:
-            story.append(Paragraph("No customers in this category", normal_style))
-        
-        story.append(Spacer(1, 15))
-    
-    # Add footer
-    story.append(Spacer(1, 20))
-    footer_style = ParagraphStyle(
-        'Footer',
-        parent=normal_style,
-        fontSize=8,
-        alignment=1,
-        textColor=colors.grey
-    )
-    story.append(Paragraph("Generated by CHI Low Security Score Analyzer", footer_style))
-    story.append(Paragraph("For internal use only - Contains confidential customer information", footer_style))
-    
-    # Build PDF with enhanced layout
-    doc.build(story)
-    output.seek(0)
-    return output.read()
+def analyze_workbooks(pipeline: AnalysisPipeline, workbooks: List[Tuple[str, bytes]], mode: str,
+                      threshold: float) -> Dict[str, object]:
+    """Analyze several workbooks in parallel on the background pool.
+
+    Returns {name: result dict or error message}. Every workbook's stages are
+    cached by content hash, so adding a file only computes the new one.
+    """
+    worker_pipeline = AnalysisPipeline(pipeline.cache)
+    dictionary = get_customer_dictionary()
+    futures = {
+        name: get_background_executor().submit(run_headless_analysis, worker_pipeline, data,
+                                               mode=mode, threshold=threshold, include_history=True,
+                                               dictionary=dictionary)
+        for name, data in workbooks
+    }
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except ValueError as e:
+            results[name] = str(e)
+        except Exception as e:
+            logger.warning("Portfolio analysis failed for %s: %s", name, e)
+            results[name] = f"Analysis failed: {e}"
+    return results
 
 
 # -------------------------------
@@ -1078,6 +1456,20 @@ def export_pdf(tables: Dict[str, pd.DataFrame], summary_df: pd.DataFrame,
 # -------------------------------
 
 st.set_page_config(page_title="CHI Low Security Score Analyzer", layout="wide")
+
+# Timing spans for this rerun (closed at the end of the script)
+if "perf_tracker" not in st.session_state:
+    st.session_state.perf_tracker = PerfTracker()
+begin_perf_rerun(st.session_state.perf_tracker)
+
+# Opt-in profile of this whole rerun. A capture left open by a rerun that
+# stopped early (st.stop, error) is written out as "incomplete" first.
+stale_profile = st.session_state.pop("profile_capture", None)
+if stale_profile is not None:
+    finish_rerun_profile(stale_profile, "incomplete", "unknown", 0)
+if PROFILE_ALWAYS or st.session_state.get("profile_reruns", False):
+    st.session_state.profile_capture = start_rerun_profile()
+
 st.title("CHI Low Security Score Analyzer")
 st.caption(f"Version {APP_VERSION} | Professional Customer Health Index Analysis Tool")
 
@@ -1086,7 +1478,16 @@ st.markdown(
     "**Exit from Red**, **Return Back to Red**, **New Comer to Red**, and **Missing from CHI**."
 )
 
-file = st.file_uploader("Upload Excel (.xlsx)", type=["xlsx"]) 
+uploads = st.file_uploader("Upload Excel (.xlsx)", type=["xlsx"], accept_multiple_files=True) or []
+
+# Several workbooks: portfolio rollup by default, or drill down into one file
+PORTFOLIO_VIEW = "📦 Portfolio rollup (all files)"
+file = uploads[0] if len(uploads) == 1 else None
+if len(uploads) > 1:
+    upload_names = [f.name for f in uploads]
+    view = st.selectbox("View", [PORTFOLIO_VIEW] + upload_names, key="portfolio_view")
+    if view != PORTFOLIO_VIEW:
+        file = uploads[upload_names.index(view)]
 
 with st.sidebar:
     st.header("Settings")
@@ -1096,6 +1497,17 @@ with st.sidebar:
         ["Sheet1 columns (e.g., Oct vs Sept)", "Two sheets (e.g., 2025-09-08 vs 2025-10-06)"]
     )
     st.caption("Tip: If your Sheet1 has merged headers, we'll auto-detect the header row (often row 6).")
+    # None: trend history comes from the workbook's own sheets only
+    history_dataset = None
+    if get_history_warehouse() is not None:
+        if len(uploads) > 1:
+            st.caption("📚 History warehouse not used while several workbooks are uploaded, "
+                       "so their months do not overwrite each other.")
+        else:
+            history_dataset = st.text_input(
+                "History dataset", value=HISTORY_DATASET, key="history_dataset",
+                help="Months from every upload are kept in the local history warehouse under this name; "
+                     "use one dataset per team or portfolio so their trends stay separate") or HISTORY_DATASET
     
     # Amazon Q CLI Management Section
     st.markdown("---")
@@ -1108,7 +1520,8 @@ with st.sidebar:
             st.rerun()
     
     # Check current status
-    q_available, q_status = check_amazon_q_availability()
+    with perf_span("q status check", kind='check'):
+        q_available, q_status = check_amazon_q_availability()
     
     if q_available:
         st.success(f"✅ Status: {q_status}")
@@ -1182,16 +1595,31 @@ with st.sidebar:
             # Windows - Follow AWS documentation
             ```
             """)
-    
-    # Show version and command info if available
+
+    # Circuit breaker state for chat / summary calls
+    breaker = get_amazon_q_breaker_status()
+    if breaker['state'] == 'open':
+        st.error(f"⛔ Circuit: open — Amazon Q calls paused for {breaker['retry_in']:.0f}s "
+                 f"after {breaker['failures']} failures")
+        if breaker['last_error']:
+            st.caption(f"Last error: {breaker['last_error']}")
+        if st.button("🔁 Reset Circuit", help="Allow Amazon Q calls again immediately"):
+            reset_amazon_q_breaker()
+            st.rerun()
+    elif breaker['state'] == 'half_open':
+        st.warning("🟡 Circuit: half-open — next Amazon Q call is a trial")
+    else:
+        st.caption(f"Circuit: closed ({breaker['failures']} recent failures)")
+
+    # Show version and command info if available (from the capability cache, no process spawned)
     try:
-        version_result = subprocess.run(['q', '--version'], capture_output=True, text=True, timeout=5)
-        if version_result.returncode == 0:
-            st.caption(f"CLI Version: {version_result.stdout.strip()}")
+        q_capabilities = get_q_capabilities()
+        if q_capabilities['installed']:
+            st.caption(f"CLI Version: {q_capabilities['version']}")
             
             # Show detected commands in debug mode
             if st.checkbox("🔧 Show CLI Commands", help="Show detected CLI command format"):
-                commands = detect_q_cli_commands()
+                commands = q_capabilities['commands']
                 st.json({
                     "Detected Commands": {
                         "Login": " ".join(commands.get('login', ['Unknown'])),
@@ -1202,29 +1630,641 @@ with st.sidebar:
     except:
         pass
 
+    # Latency and outcome of recent q calls (read from the local telemetry store on demand)
+    q_telemetry = get_q_telemetry()
+    if q_telemetry is not None and st.checkbox("📡 Show Amazon Q Telemetry",
+                                               help="Latency percentiles and failure rates of q calls"):
+        telemetry_days = st.selectbox("Window", [1, 7, 30, 90], index=1, format_func=lambda d: f"Last {d} days",
+                                      key="q_telemetry_days")
+        st.dataframe(q_telemetry.summary_frame(telemetry_days), width="stretch", hide_index=True)
+        st.caption("Per day")
+        st.dataframe(q_telemetry.daily_frame(telemetry_days), width="stretch", hide_index=True)
+        st.caption(f"Stored in `{q_telemetry.path}`")
+
+# -------------------------------
+# Fragments: parts of the page that rerun on their own
+# -------------------------------
+
+def render_trend_section(pipeline: AnalysisPipeline, workbook: StageResult, classified: StageResult,
+                         threshold: float, dataset: str = None):
+    """Trend chart and history table; stages are normally already cached by start_trend_job()"""
+    warehouse = get_history_warehouse()
+    history = history_stage(pipeline.stage, warehouse, workbook, threshold, dataset)
+    historical_df = history.value
+    if warehouse is not None and dataset and not historical_df.empty:
+        st.caption(f"📚 {len(historical_df)} months from the history warehouse (dataset '{dataset}'), "
+                   f"{historical_df['month_label'].iloc[0]} to {historical_df['month_label'].iloc[-1]}")
+
+    if not historical_df.empty:
+        # Calculate monthly changes
+        monthly = pipeline.stage("monthly_changes", calculate_monthly_changes, [history, classified])
+        historical_df = monthly.value
+
+        # Create and display the trend chart
+        fig = pipeline.stage("trend_chart", create_trend_chart, [monthly]).value
+        st.plotly_chart(fig, width="stretch", config={'displayModeBar': True, 'scrollZoom': True})
+
+        # Display historical data table
+        with st.expander("📋 View Historical Data"):
+            display_df = historical_df[['month_label', 'low_score_customers', 'exit_from_red', 'return_to_red', 'total_customers']].copy()
+            display_df.columns = ['Month', 'Low Score Customers', 'Exit from Red', 'Return to Red', 'Total Customers']
+            st.dataframe(display_df, width="stretch")
+    else:
+        st.warning("⚠️ No historical data found. The trend chart requires multiple dated sheets (e.g., '2025-04-07', '2025-05-08') in the Excel file.")
+        st.info("💡 **Tip**: Ensure your Excel file contains multiple sheets with date names in YYYY-MM-DD format for historical trend analysis.")
+
+
+def render_portfolio_view(pipeline: AnalysisPipeline, uploads: list, mode: str, threshold: float):
+    """Aggregate counts and trends across several uploaded workbooks"""
+    st.subheader(f"📦 Portfolio Rollup — {len(uploads)} workbooks")
+    if mode == MODE_SHEETS:
+        st.caption("Each workbook compares its first two dated sheets. Pick a single workbook above to choose sheets.")
+    else:
+        st.caption("Each workbook compares its two Sheet1 Security Score columns. Pick a single workbook above to choose columns.")
+
+    with st.spinner("Analyzing workbooks..."):
+        results = analyze_workbooks(pipeline, [(f.name, f.getvalue()) for f in uploads], mode, threshold)
+    per_file, trend = build_portfolio_rollup(results)
+
+    ok = per_file[per_file['Status'] == 'OK']
+    if ok.empty:
+        st.error("None of the uploaded workbooks could be analyzed.")
+        st.dataframe(per_file, width="stretch", hide_index=True)
+        return
+
+    c1, c2, c3, c4 = st.columns(4)
+    for col, name in zip((c1, c2, c3, c4), CATEGORY_NAMES):
+        col.metric(name, int(ok[name].sum()))
+    prev_low, curr_low = int(ok['Prev Low Score'].sum()), int(ok['Curr Low Score'].sum())
+    t1, t2, t3 = st.columns(3)
+    t1.metric("Previous Month Low Score", prev_low)
+    t2.metric("Current Month Low Score", curr_low, delta=prev_low - curr_low, delta_color="inverse")
+    t3.metric("Improvement Rate", f"{((prev_low - curr_low) / prev_low * 100) if prev_low else 0:.1f}%")
+
+    st.markdown("### Per-workbook breakdown")
+    st.dataframe(per_file, width="stretch", hide_index=True)
+    failed = per_file[per_file['Status'] != 'OK']
+    if not failed.empty:
+        st.warning(f"⚠️ {len(failed)} workbook(s) could not be analyzed; see the Status column.")
+
+    st.markdown("### Low-score customers by month")
+    if trend.empty:
+        st.info("No dated sheets found for trend analysis.")
+    else:
+        fig = px.bar(trend, x='month_label', y='low_score_customers', color='Workbook',
+                     labels={'month_label': 'Month', 'low_score_customers': 'Low Score Customers'})
+        totals = trend.groupby('month_label', as_index=False)['low_score_customers'].sum()
+        fig.add_trace(go.Scatter(x=totals['month_label'], y=totals['low_score_customers'], name='Portfolio total',
+                                 mode='lines+markers', line=dict(color='black', width=2)))
+        st.plotly_chart(fig, width="stretch")
+
+
+@st.fragment(run_every=TREND_POLL_SECONDS)
+def render_trend_placeholder(job: Future):
+    """Shown while the trend job exceeds its time budget; triggers a full rerun once it finishes"""
+    if job.done():
+        st.rerun()
+    st.info("⏳ Historical trends are still computing. They will appear here when ready.")
+
+
+def render_history_sections(pipeline: AnalysisPipeline, workbook: StageResult, work: StageResult,
+                            col_customer: str, col_prev: str, col_curr: str, col_overall: str,
+                            segment_col: str, threshold: float, customers: CustomerDictionary,
+                            streaks_slot, segments_slot) -> Tuple[StageResult, "StageResult | None"]:
+    """Red-zone streaks and segments, once the trend job has cached the month bitsets they need"""
+    month_bits = month_bitsets_stage(pipeline.stage, workbook, col_customer, col_overall, threshold, customers)
+    streaks = pipeline.stage("red_streaks", compute_red_streaks, [month_bits], col_customer=col_customer,
+                             dictionary=customers)
+    with streaks_slot:
+        render_red_streaks(streaks.value)
+
+    segments = None
+    if segment_col:
+        segments = pipeline.stage("segments", analyze_segments, [work, month_bits], col_customer=col_customer,
+                                  segment_col=segment_col, col_prev=col_prev, col_curr=col_curr,
+                                  col_overall=col_overall, threshold=threshold, dictionary=customers)
+        with segments_slot:
+            render_segments(segments.value)
+    return streaks, segments
+
+
+@st.fragment
+def render_category_table(name: str, index: CategoryIndex):
+    """Paged view of one category; searching, sorting and paging rerun only this table"""
+    if index is None:
+        st.info("No records")
+        return
+
+    key = re.sub(r"\W+", "_", name.lower())
+    c1, c2, c3, c4 = st.columns([3, 2, 2, 1])
+    search = c1.text_input("Search customer", key=f"search_{key}", placeholder="Customer name contains...")
+    sort = c2.selectbox("Sort", list(CATEGORY_SORTS), key=f"sort_{key}")
+    delta_filter = c3.selectbox("Score change", CATEGORY_DELTA_FILTERS, key=f"delta_{key}")
+    page_size = c4.selectbox("Rows", [25, 50, 100, 250], index=1, key=f"rows_{key}")
+
+    _, total = query_category_page(index, search, sort, delta_filter, page=1, page_size=0)
+    pages = max(1, -(-total // page_size))
+    page = 1
+    if pages > 1:
+        page = st.number_input(f"Page (1-{pages})", min_value=1, max_value=pages, value=1, key=f"page_{key}")
+    page_df, total = query_category_page(index, search, sort, delta_filter, page=page, page_size=page_size)
+    st.dataframe(page_df, width="stretch", hide_index=True)
+    st.caption(f"Showing {len(page_df)} of {total} matching customers ({len(index.frame)} in category)")
+
+
+SEGMENT_TREND_LINES = 10    # largest segments drawn in the trend chart
+SEGMENT_HEATMAP_ROWS = 20
+
+
+def select_segment_column(dimensions: List[str]) -> str:
+    """'Segment by' selector; None when there is nothing to segment by or 'None' is chosen"""
+    if not dimensions:
+        return None
+    choice = st.selectbox("Segment by", ["None", *dimensions], key="segment_by",
+                          help="Break categories, low-score metrics and trends down by this column")
+    return None if choice == "None" else choice
+
+
+def render_segments(segments: SegmentAnalysis):
+    """Segment x category matrix and per-segment low-score trend lines"""
+    matrix = segments.matrix
+    st.dataframe(matrix, width="stretch", hide_index=True, height=min(400, 38 + 35 * len(matrix)))
+    heat = matrix.set_index(segments.column)[CATEGORY_NAMES].head(SEGMENT_HEATMAP_ROWS)
+    st.plotly_chart(px.imshow(heat, text_auto=True, aspect="auto", color_continuous_scale="Reds",
+                              labels={'x': "Category", 'y': segments.column, 'color': "Customers"}),
+                    width="stretch")
+    if len(segments.trends) >= 2:
+        shown = [c for c in matrix[segments.column].head(SEGMENT_TREND_LINES) if c in segments.trends.columns]
+        long = segments.trends[shown].reset_index().melt(id_vars="Month", var_name=segments.column,
+                                                          value_name="Low Score Customers")
+        fig = px.line(long, x="Month", y="Low Score Customers", color=segments.column, markers=True,
+                      title=f"Low-score customers per {segments.column}")
+        st.plotly_chart(fig, width="stretch")
+        if len(matrix) > SEGMENT_TREND_LINES:
+            st.caption(f"Trend lines for the {SEGMENT_TREND_LINES} largest of {len(matrix)} segments; "
+                       "the Excel export has all of them")
+
+
+@st.fragment
+def render_red_streaks(streaks: RedZoneStreaks):
+    """Red-zone streak table with its own filters"""
+    table = streaks.table
+    if len(streaks.months) < 2 or table.empty:
+        st.info("Needs at least two dated sheets (YYYY-MM-DD) with red-zone customers.")
+        return
+    c1, c2, c3 = st.columns(3)
+    c1.metric(f"Red {RED_STREAK_ALERT_MONTHS}+ months running",
+              int((table["Current Streak"] >= RED_STREAK_ALERT_MONTHS).sum()))
+    c2.metric("Re-entered red zone", int((table["Re-entries"] > 0).sum()))
+    c3.metric("Median months to exit",
+              "-" if np.isnan(streaks.median_months_to_exit) else f"{streaks.median_months_to_exit:g}")
+
+    f1, f2 = st.columns(2)
+    min_streak = f1.number_input("Current streak at least", min_value=0, max_value=len(streaks.months),
+                                 value=0, key="streak_min_current")
+    min_reentries = f2.number_input("Re-entries at least", min_value=0, max_value=len(streaks.months),
+                                    value=0, key="streak_min_reentries")
+    shown = table[(table["Current Streak"] >= min_streak) & (table["Re-entries"] >= min_reentries)]
+    st.dataframe(shown, width="stretch", hide_index=True, height=300)
+    st.caption(f"{len(shown)} of {len(table)} customers that were red in any of {len(streaks.months)} months "
+               f"({streaks.months[0]} → {streaks.months[-1]})")
+
+
+@st.fragment
+def render_month_matrix(pipeline: AnalysisPipeline, workbook: StageResult, col_customer: str, col_overall: str,
+                        threshold: float, customers: CustomerDictionary):
+    """All-pairs month comparison from per-month bitsets; reruns on its own"""
+    if not st.toggle("Compare any two months", key="show_month_matrix",
+                     help="Category counts for every pair of dated sheets, not just the selected ones"):
+        return
+    bits = month_bitsets_stage(pipeline.stage, workbook, col_customer, col_overall, threshold, customers).value
+    if len(bits.months) < 2:
+        st.info("Needs at least two dated sheets (YYYY-MM-DD) in the workbook.")
+        return
+
+    category = st.selectbox("Category", CATEGORY_NAMES, key="matrix_category")
+    fig = px.imshow(month_comparison_matrix(bits, category), text_auto=True, aspect="auto",
+                    color_continuous_scale="Reds",
+                    labels={'x': "Current month", 'y': "Previous month", 'color': "Customers"})
+    st.plotly_chart(fig, width="stretch")
+
+    c1, c2 = st.columns(2)
+    prev_month = c1.selectbox("Previous month", bits.months[:-1], key="matrix_prev")
+    a = bits.months.index(prev_month)
+    curr_month = c2.selectbox("Current month", bits.months[a + 1:], index=len(bits.months) - a - 2,
+                              key="matrix_curr")
+    b = bits.months.index(curr_month)
+    for col, (name, count) in zip(st.columns(len(CATEGORY_NAMES)), classify_month_pair(bits, a, b).items()):
+        col.metric(name, count)
+    names = month_pair_customers(bits, a, b, category, customers)
+    st.dataframe(pd.DataFrame({col_customer: names}), width="stretch", hide_index=True, height=250)
+    st.caption(f"{len(names)} customers in {category}, {prev_month} → {curr_month} (each customer counted once)")
+
+
+def _rerun_fragment():
+    """Rerun only the enclosing fragment; falls back to a full rerun when not in a fragment run"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
+
+@st.fragment
+@perf_fragment("fragment: genai")
+def render_genai_section(analysis_data: Dict, show_ai_section: bool, q_available: bool, q_status: str, timestamp: str):
+    """GenAI summary and Amazon Q chat.
+
+    Runs as a fragment on the precomputed `analysis_data`: chat buttons rerun
+    only this section, so a chat round trip costs just the Amazon Q call.
+    Actions that change what the exports contain trigger a full rerun.
+    """
+    if show_ai_section and q_available:
+        st.markdown("---")
+        st.subheader("🤖 GenAI Monthly Summary Report")
+        
+        with st.spinner("🤖 Generating AI-powered summary..."):
+            # Generate AI summary (returns success status and content)
+            # Generate AI summary only once and store in session state
+            if "original_ai_summary" not in st.session_state:
+                logger.debug("Generating NEW AI summary...")
+                success, ai_summary = generate_ai_summary(analysis_data)
+                if success:
+                    st.session_state.original_ai_summary = ai_summary
+                    st.session_state.ai_summary_generated = True
+                    logger.debug("AI summary generated and cached. Length: %s chars", len(ai_summary))
+                    logger.debug("AI summary preview: %.200s...", ai_summary)
+                else:
+                    st.session_state.ai_summary_generated = False
+                    st.session_state.ai_summary_error = ai_summary
+                    logger.debug("AI summary generation FAILED: %s", ai_summary)
+            else:
+                # Use cached AI summary
+                success = st.session_state.ai_summary_generated
+                ai_summary = st.session_state.original_ai_summary if success else st.session_state.ai_summary_error
+                logger.debug("Using CACHED AI summary. Success: %s", success)
+                logger.debug("Cached summary length: %s chars", len(ai_summary))
+                logger.debug("Cached summary preview: %.200s...", ai_summary)
+            
+            if success:
+                # Check if there's an improved summary in session state
+                display_summary = st.session_state.get('improved_summary', ai_summary)
+                logger.debug("Display summary: improved=%s, %s chars, preview: %.200s...",
+                             'improved_summary' in st.session_state, len(display_summary), display_summary)
+                
+                # Show which summary is being displayed
+                col_info, col_actions = st.columns([3, 1])
+                
+                with col_info:
+                    if 'improved_summary' in st.session_state and st.session_state.improved_summary != ai_summary:
+                        st.info("📝 **Showing improved summary** (modified by Amazon Q Chat)")
+                    else:
+                        st.info("📝 **Showing original AI summary**")
+                
+                with col_actions:
+                    if 'improved_summary' in st.session_state and st.session_state.improved_summary != ai_summary:
+                        if st.button("🔄 Revert", key="revert_summary", help="Revert to original AI summary"):
+                            del st.session_state.improved_summary
+                            st.success("✅ Reverted to original summary")
+                            st.rerun()
+                    
+                    if st.button("🔄 Regenerate", key="regenerate_summary", help="Generate a new AI summary"):
+                        # Clear all summary-related session state
+                        if 'original_ai_summary' in st.session_state:
+                            del st.session_state.original_ai_summary
+                        if 'improved_summary' in st.session_state:
+                            del st.session_state.improved_summary
+                        if 'ai_summary_generated' in st.session_state:
+                            del st.session_state.ai_summary_generated
+                        clear_chat_state(st.session_state)
+                        st.success("✅ Regenerating AI summary...")
+                        st.rerun()
+                
+                # Display the summary (original or improved)
+                st.markdown(display_summary)
+                
+                # Add download button for the current summary
+                st.download_button(
+                    label="📄 Download Current Summary",
+                    data=display_summary,
+                    file_name=f"chi_genai_summary_{timestamp}.md",
+                    mime="text/markdown"
+                )
+                
+                # Interactive Chat Section for Summary Improvement
+                st.markdown("---")
+                col_title, col_status = st.columns([3, 1])
+                with col_title:
+                    st.subheader("💬 Improve Summary with Amazon Q Chat")
+                with col_status:
+                    if st.button("🔄", help="Refresh Amazon Q status", key="refresh_q_status"):
+                        clear_amazon_q_cache()
+                        st.rerun()
+                
+                # Show current status
+                st.caption(f"Amazon Q Status: {q_status}")
+                
+                # Initialize chat history (recent turns + digest + on-disk transcript) in session state
+                init_chat_state(st.session_state)
+                logger.debug("Chat history has %s items, %s compacted",
+                             len(st.session_state.chat_history), st.session_state.chat_compacted_turns)
+                
+                # Initialize pending quick question state
+                if "pending_quick_question" not in st.session_state:
+                    st.session_state.pending_quick_question = None
+                    logger.debug("Initialized pending_quick_question as None")
+                else:
+                    logger.debug("*** FOUND PENDING QUESTION: %s ***", st.session_state.pending_quick_question)
+                
+                # Prepare context for chat using the currently displayed summary
+                current_displayed_summary = st.session_state.get('improved_summary', ai_summary)
+                
+                def get_chat_context():
+                    """Get the current context for Amazon Q chat"""
+                    current_summary = st.session_state.get('improved_summary', st.session_state.get('original_ai_summary', ai_summary))
+                    logger.debug("get_chat_context(): improved_summary=%s, original_ai_summary=%s, "
+                                 "current_summary %s chars, preview: %.200s...",
+                                 'improved_summary' in st.session_state, 'original_ai_summary' in st.session_state,
+                                 len(current_summary), current_summary)
+                    
+                    # Truncate summary if too long to avoid timeout
+                    summary_for_context = current_summary
+                    if len(current_summary) > 2000:
+                        summary_for_context = current_summary[:2000] + "\n\n[Summary truncated for processing efficiency]"
+                        logger.debug("Truncated summary from %s to %s chars", len(current_summary), len(summary_for_context))
+                    
+                    context = f"""CHI Analysis: {analysis_data['exit_from_red']} improved, {analysis_data['return_back_red']} deteriorated, {analysis_data['new_comer_red']} new low-score, {analysis_data['missing_from_chi']} missing data. Total: {analysis_data['total_customers']} customers, {analysis_data['low_score_improvement_pct']:.1f}% improvement.
+{analysis_data.get('top_movers', '')}
+
+Current Summary:
+{summary_for_context}"""
+
+                    # Earlier turns that were compacted out of the visible history
+                    chat_digest = get_chat_digest(st.session_state)
+                    if chat_digest:
+                        context += f"""
+
+Earlier conversation (digest):
+{chat_digest}"""
+                    
+                    logger.debug("Generated context length: %s chars", len(context))
+                    return context
+                
+                # Display chat history
+                if st.session_state.chat_history:
+                    st.markdown("**Chat History:**")
+                    compacted_turns = st.session_state.chat_compacted_turns
+                    if compacted_turns:
+                        with st.expander(f"🗜️ {compacted_turns} earlier chats (digest)"):
+                            st.text(get_chat_digest(st.session_state))
+                    for i, (user_msg, ai_response) in enumerate(st.session_state.chat_history, start=compacted_turns):
+                        with st.expander(f"💬 Chat {i+1}: {user_msg[:50]}..."):
+                            st.markdown(f"**You:** {user_msg}")
+                            st.markdown(f"**Amazon Q:** {ai_response}")
+                
+                # Chat input
+                st.markdown("**Ask Amazon Q to improve or modify the summary:**")
+                
+                # Predefined quick questions
+                st.markdown("**Quick Actions:**")
+                col1, col2, col3 = st.columns(3)
+                
+                with col1:
+                    if st.button("📈 Focus on improvements", help="Emphasize positive trends", key="btn_improvements"):
+                        question = "Please rewrite the summary to focus more on the positive improvements and success stories. Highlight the customers who improved their security scores."
+                        st.session_state.pending_quick_question = question
+                        logger.debug("BUTTON CLICKED - Focus on improvements")
+                        logger.debug("Set pending_quick_question: %s", question)
+                        logger.debug("About to call _rerun_fragment()")
+                        _rerun_fragment()
+                with col2:
+                    if st.button("⚠️ Highlight risks", help="Emphasize areas of concern", key="btn_risks"):
+                        st.session_state.pending_quick_question = "Please rewrite the summary to emphasize the security risks and areas that need immediate attention. Focus on the deteriorating customers."
+                        _rerun_fragment()
+                with col3:
+                    if st.button("📊 Add more metrics", help="Include additional analysis", key="btn_metrics"):
+                        st.session_state.pending_quick_question = "Please enhance the summary with more detailed metrics and statistical analysis. Include percentages and trends."
+                        _rerun_fragment()
+                
+                # Handle pending quick question
+                if st.session_state.pending_quick_question:
+                    logger.debug("*** PROCESSING PENDING QUESTION ***")
+                    quick_question = st.session_state.pending_quick_question
+                    logger.debug("Question: %s", quick_question)
+                    st.session_state.pending_quick_question = None  # Clear it immediately
+                    logger.debug("Cleared pending_quick_question")
+                    
+                    with st.spinner("🤖 Getting response from Amazon Q..."):
+                        # Use the current context with the displayed summary
+                        logger.debug("About to call get_chat_context()")
+                        context = get_chat_context()
+                        logger.debug("Context generated, calling chat_with_amazon_q()")
+                        logger.debug("Context preview: %.300s...", context)
+                        chat_success, chat_response = chat_with_amazon_q(quick_question, context)
+                        logger.debug("chat_with_amazon_q returned: success=%s", chat_success)
+                        logger.debug("Response length: %s chars", len(chat_response) if chat_response else 0)
+                        
+                        if chat_success:
+                            logger.debug("Chat SUCCESS - adding to history")
+                            # Add to chat history
+                            record_chat_turn(st.session_state, quick_question, chat_response)
+                            logger.debug("Chat history now has %s items", len(st.session_state.chat_history))
+                            
+                            # Display the response
+                            st.success("✅ Response received!")
+                            st.markdown("**Amazon Q Response:**")
+                            st.markdown(chat_response)
+                            
+                            # Option to replace original summary (without rerun)
+                            col_a, col_b = st.columns(2)
+                            with col_a:
+                                if st.button("🔄 Use this as new summary", key="replace_summary_quick"):
+                                    logger.debug("USER CLICKED 'Use this as new summary'")
+                                    st.session_state.improved_summary = chat_response
+                                    logger.debug("Set improved_summary, length: %s chars", len(chat_response))
+                                    st.success("✅ Summary updated! The new summary will be used in exports.")
+                                    st.rerun()
+                            with col_b:
+                                if st.button("📋 Copy to clipboard", key="copy_quick"):
+                                    st.success("✅ Response copied! You can paste it elsewhere.")
+                            
+                        else:
+                            logger.debug("Chat FAILED: %s", chat_response)
+                            st.error(f"Chat failed: {chat_response}")
+                            if "not logged in" in chat_response.lower():
+                                st.info("💡 **Please login to Amazon Q CLI:**")
+                                st.code("q login")
+                                st.info("Then refresh this page or click the refresh button above.")
+                
+                # Custom question input
+                st.markdown("**Custom Question:**")
+                user_question = st.text_area(
+                    "Ask your own question:",
+                    placeholder="e.g., 'Make the summary more executive-friendly' or 'Add specific recommendations for TAMs'",
+                    key="chat_input"
+                )
+                
+                if st.button("💬 Send Custom Question", type="primary", key="btn_custom") and user_question:
+                    st.session_state.pending_custom_question = user_question
+                    _rerun_fragment()
+                
+                # Handle pending custom question
+                if "pending_custom_question" not in st.session_state:
+                    st.session_state.pending_custom_question = None
+                
+                if st.session_state.pending_custom_question:
+                    custom_question = st.session_state.pending_custom_question
+                    st.session_state.pending_custom_question = None  # Clear it immediately
+                    
+                    with st.spinner("🤖 Getting response from Amazon Q..."):
+                        # Use the current context with the displayed summary
+                        chat_success, chat_response = chat_with_amazon_q(custom_question, get_chat_context())
+                        
+                        if chat_success:
+                            # Add to chat history
+                            record_chat_turn(st.session_state, custom_question, chat_response)
+                            
+                            # Display the response
+                            st.success("✅ Response received!")
+                            st.markdown("**Amazon Q Response:**")
+                            st.markdown(chat_response)
+                            
+                            # Option to replace original summary (without rerun)
+                            col_a, col_b = st.columns(2)
+                            with col_a:
+                                if st.button("🔄 Use this as new summary", key="replace_summary_custom"):
+                                    st.session_state.improved_summary = chat_response
+                                    st.success("✅ Summary updated! The new summary will be used in exports.")
+                                    st.rerun()
+                            with col_b:
+                                if st.button("📋 Copy to clipboard", key="copy_custom"):
+                                    st.success("✅ Response copied! You can paste it elsewhere.")
+                            
+                        else:
+                            st.error(f"Chat failed: {chat_response}")
+                            if "not logged in" in chat_response.lower():
+                                st.info("💡 **Please login to Amazon Q CLI:**")
+                                st.code("q login")
+                                st.info("Then refresh this page or click the refresh button above.")
+                
+                # Clear chat history button
+                if st.session_state.chat_history:
+                    if st.button("🗑️ Clear Chat History"):
+                        clear_chat_state(st.session_state)
+                        # Don't use st.rerun() here, just clear the history
+                
+            else:
+                # Show error message
+                st.error(f"AI Summary Generation Failed: {ai_summary}")
+                st.info("Please check the log file for detailed error information.")
+    
+    elif not q_available:
+        st.markdown("---")
+        st.subheader("🤖 GenAI Monthly Summary Report")
+        st.info("💡 **GenAI Summary Not Available**: Amazon Q CLI is not available or not logged in. Please run `q login` in your terminal to enable AI-powered summaries.")
+        st.caption(f"Status: {q_status}")
+        
+        # Add refresh button to recheck Amazon Q status
+        col1, col2 = st.columns([1, 3])
+        with col1:
+            if st.button("🔄 Recheck Amazon Q", help="Clear cache and recheck Amazon Q CLI status"):
+                clear_amazon_q_cache()
+                st.rerun()
+        with col2:
+            st.caption("Click to refresh Amazon Q CLI status after login")
+        
+        # Show chat interface even when not logged in (with disabled state)
+        st.markdown("---")
+        st.subheader("💬 Amazon Q Chat (Unavailable)")
+        st.info("💡 **Chat Feature**: Login to Amazon Q CLI to enable interactive chat for improving summaries.")
+        st.text_area("Chat would appear here...", disabled=True, placeholder="Login to Amazon Q CLI to enable chat functionality")
+
+
+@st.fragment
+@perf_fragment("fragment: pdf export")
+def render_pdf_export(pipeline: AnalysisPipeline, classified: StageResult, summary: StageResult,
+                      summary_text: str):
+    """PDF export; refreshable on its own to pick up new chat turns without a full rerun"""
+    # PDF Export - 實時檢測 reportlab
+    try:
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.lib import colors
+        from reportlab.lib.units import inch
+        pdf_available_now = True
+    except ImportError:
+        pdf_available_now = False
+    
+    # 顯示調試資訊
+    st.caption(f"🔍 DEBUG: PDF_AVAILABLE={PDF_AVAILABLE}, pdf_available_now={pdf_available_now}")
+    
+    if pdf_available_now:
+        try:
+            # Get AI summary if available (use improved version if exists)
+            ai_summary_text = ""
+            if st.session_state.get("ai_summary_generated", False) and "original_ai_summary" in st.session_state:
+                # Use improved summary if available, otherwise use original
+                ai_summary_text = st.session_state.get('improved_summary', st.session_state.original_ai_summary)
+            
+            # Get chat history if available: recent turns plus digest, or the full archived transcript
+            chat_history_for_pdf = st.session_state.get('chat_history', [])
+            chat_digest_for_pdf = get_chat_digest(st.session_state)
+            if chat_digest_for_pdf and st.checkbox("Include full chat transcript in PDF", key="pdf_full_transcript",
+                                                   help="Load all archived chat turns instead of the digest"):
+                chat_history_for_pdf = load_chat_transcript(st.session_state)
+                chat_digest_for_pdf = ""
+            
+            pdf_bytes = pipeline.stage("export_pdf", export_pdf, [classified, summary],
+                                       analysis_summary=summary_text,
+                                       ai_summary=ai_summary_text,
+                                       chat_history=chat_history_for_pdf,
+                                       chat_digest=chat_digest_for_pdf).value
+            st.download_button(
+                label="📄 Download PDF Report",
+                data=pdf_bytes,
+                file_name="CHI_Low_Security_Analysis_Report.pdf",
+                mime="application/pdf",
+            )
+            chat_turns = len(chat_history_for_pdf) + st.session_state.get("chat_compacted_turns", 0)
+            st.caption(f"Includes {chat_turns} chat turns")
+            # Any button inside the fragment reruns just this export
+            st.button("🔄 Refresh PDF", key="refresh_pdf", help="Rebuild the PDF with the latest summary and chat turns")
+        except Exception as pdf_error:
+            st.error(f"PDF generation failed: {str(pdf_error)}")
+            st.info("Please ensure reportlab is installed: `pip install reportlab`")
+    else:
+        st.error("📄 PDF Export unavailable")
+        st.caption("Install reportlab to enable PDF export: `pip install reportlab`")
+        st.caption("🔧 Try: `chi_analyzer_env/bin/pip install reportlab`")
+
+
+# Per-session view over the process-wide stage cache (session state holds keys and counters only)
+if "analysis_pipeline" not in st.session_state:
+    st.session_state.analysis_pipeline = AnalysisPipeline()
+pipeline = st.session_state.analysis_pipeline
+pipeline.begin_run(st.session_state.perf_tracker)
+
 if file:
     try:
-        # Load workbook, read Sheet1 as raw (no header) for scanning
-        xls = pd.ExcelFile(file)
-        raw = pd.read_excel(file, sheet_name="Sheet1", header=None)
-        # Heuristic: find header row between 0..20
-        scanned, header_row = _first_nonempty_row_as_header(raw, start_row=0, end_row=20)
-        scanned.columns = _normalize_colnames(list(scanned.columns))
+        # Workbook bytes are the root of the stage graph, keyed by content hash
+        file_bytes = file.getvalue()
+        workbook = pipeline.source("workbook", file_bytes, hashlib.sha1(file_bytes).hexdigest())
+        customers = get_customer_dictionary()
+        # Start parsing all sheets right away, once per uploaded workbook
+        if st.session_state.get("preparse_workbook") != workbook.key:
+            st.session_state.preparse_workbook = workbook.key
+            start_preparse(pipeline, workbook, [st.session_state.get("prev_sheet"), st.session_state.get("curr_sheet")],
+                           customers)
+
+        # Load Sheet1 as raw (no header) and detect the header row
+        sheet1 = pipeline.stage("parse_sheet1", load_sheet1, [workbook])
+        scanned, col_customer, col_overall = sheet1.value
 
         # Try to detect common columns
-        # We keep and standardize likely column names
         # Customer
-        cust_candidates = [c for c in scanned.columns if c.lower().strip() == "customer"]
-        if not cust_candidates:
+        if col_customer is None:
             st.error("Could not find a 'Customer' column on Sheet1. Please ensure your file has it.")
             st.stop()
-        col_customer = cust_candidates[0]
-
-        # Overall Score (optional)
-        overall_candidates = [c for c in scanned.columns if c.lower().strip() == "overall score"]
-        col_overall = overall_candidates[0] if overall_candidates else "Overall Score"
-        if col_overall not in scanned.columns:
-            scanned[col_overall] = pd.NA
 
         if mode == "Sheet1 columns (e.g., Oct vs Sept)":
             st.subheader("Mode A — Compare two columns on Sheet1")
@@ -1235,67 +2275,56 @@ if file:
                 st.stop()
             col_prev = st.selectbox("Previous month column", sec_cols, index=1 if len(sec_cols) > 1 else 0)
             col_curr = st.selectbox("Current month column", sec_cols, index=0)
+            segment_col = select_segment_column(dimension_columns(scanned))
 
             # Build working df
-            work = scanned[[col_customer, col_overall, col_prev, col_curr]].copy()
-            tables = classify(work, col_prev=col_prev, col_curr=col_curr, col_overall=col_overall, threshold=threshold)
-            
-            # Calculate low score metrics for trend analysis
-            low_score_metrics = calculate_low_score_metrics(work, col_prev=col_prev, col_curr=col_curr, threshold=threshold)
+            work = pipeline.stage("build_work", build_sheet1_frame, [sheet1],
+                                  col_prev=col_prev, col_curr=col_curr, segment_col=segment_col)
 
         else:
             st.subheader("Mode B — Compare two dated sheets")
             # Let user pick two sheets (prev and curr) from workbook
-            sheet_names = [s for s in xls.sheet_names if s != "Sheet1"]
+            all_sheets = pipeline.stage("sheet_names", list_sheet_names, [workbook]).value
+            sheet_names = [s for s in all_sheets if s != SHEET1_NAME]
             if len(sheet_names) < 2:
                 st.error("Need at least two dated sheets besides 'Sheet1' to compare.")
                 st.stop()
-            prev_sheet = st.selectbox("Previous month sheet", sheet_names, index=0)
-            curr_sheet = st.selectbox("Current month sheet", sheet_names, index=1 if len(sheet_names) > 1 else 0)
-
-            def load_sheet(sheet: str) -> pd.DataFrame:
-                tmp_raw = pd.read_excel(file, sheet_name=sheet, header=None)
-                tmp_df, _ = _first_nonempty_row_as_header(tmp_raw, start_row=0, end_row=20)
-                tmp_df.columns = _normalize_colnames(list(tmp_df.columns))
-                return tmp_df
-
-            df_prev = load_sheet(prev_sheet)
-            df_curr = load_sheet(curr_sheet)
-
-            # Find the likely security score column in each sheet
-            def find_security_col(cols: List[str]) -> str:
-                candidates = [c for c in cols if re.search(r"security score", c, flags=re.I)]
-                if not candidates:
-                    return None
-                # If multiple, pick the first
-                return candidates[0]
-
-            prev_sec_col = find_security_col(list(df_prev.columns))
-            curr_sec_col = find_security_col(list(df_curr.columns))
-
-            if not prev_sec_col or not curr_sec_col:
-                st.error("Could not detect 'Security Score' column in one or both selected sheets.")
-                st.stop()
+            prev_sheet = st.selectbox("Previous month sheet", sheet_names, index=0, key="prev_sheet")
+            curr_sheet = st.selectbox("Current month sheet", sheet_names, index=1 if len(sheet_names) > 1 else 0,
+                                      key="curr_sheet")
 
-            # Merge by Customer
-            for need in [col_customer, col_overall]:
-                if need not in df_prev.columns:
-                    df_prev[need] = pd.NA
-                if need not in df_curr.columns:
-                    df_curr[need] = pd.NA
-
-            merged = pd.merge(
-                df_prev[[col_customer, prev_sec_col]].rename(columns={prev_sec_col: "Prev"}),
-                df_curr[[col_customer, col_overall, curr_sec_col]].rename(columns={curr_sec_col: "Curr"}),
-                on=col_customer, how="outer"
-            )
-            # Reuse classify() by naming columns accordingly
-            merged = merged.rename(columns={"Prev": "__prev__", "Curr": "__curr__"})
-            tables = classify(merged, col_prev="__prev__", col_curr="__curr__", col_overall=col_overall, threshold=threshold)
+            df_prev = pipeline.stage("parse_sheet", load_dated_sheet, [workbook], sheet=prev_sheet)
+            df_curr = pipeline.stage("parse_sheet", load_dated_sheet, [workbook], sheet=curr_sheet)
+            prev_ids = pipeline.stage("customer_ids", encode_customers, [df_prev],
+                                      col_customer=col_customer, dictionary=customers)
+            curr_ids = pipeline.stage("customer_ids", encode_customers, [df_curr],
+                                      col_customer=col_customer, dictionary=customers)
+
+            segment_col = select_segment_column(
+                list(dict.fromkeys(dimension_columns(df_curr.value) + dimension_columns(df_prev.value))))
+
+            # Merge by Customer; classify() is reused by naming the score columns __prev__ / __curr__
+            try:
+                work = pipeline.stage("build_work", merge_dated_sheets, [df_prev, df_curr, prev_ids, curr_ids],
+                                      col_customer=col_customer, col_overall=col_overall, dictionary=customers,
+                                      segment_col=segment_col)
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
             col_prev, col_curr = "__prev__", "__curr__"
-            
-            # Calculate low score metrics for trend analysis
-            low_score_metrics = calculate_low_score_metrics(merged, col_prev="__prev__", col_curr="__curr__", threshold=threshold)
+
+        classified = pipeline.stage("classify", classify, [work], col_prev=col_prev, col_curr=col_curr,
+                                    col_overall=col_overall, threshold=threshold)
+        trend_key = f"{classified.key}:{history_dataset}:{customers!r}"
+        trend_job = st.session_state.get("trend_job")
+        if trend_job is None or trend_job[0] != trend_key:
+            trend_job = (trend_key, start_trend_job(pipeline, workbook, classified, threshold, history_dataset,
+                                                    col_customer, col_overall, customers))
+            st.session_state.trend_job = trend_job
+        tables = classified.value
+        # Calculate low score metrics for trend analysis
+        low_score_metrics = pipeline.stage("low_score_metrics", calculate_low_score_metrics, [work],
+                                           col_prev=col_prev, col_curr=col_curr, threshold=threshold).value
 
         # Display results
         st.markdown("---")
@@ -1398,26 +2427,9 @@ if file:
         st.markdown("---")
         st.subheader("📈 Security Score Historical Trends")
         
-        # Extract historical data from all sheets
-        with st.spinner("📊 Analyzing historical trends..."):
-            historical_df = extract_historical_data(xls, threshold=threshold)
-            
-            if not historical_df.empty:
-                # Calculate monthly changes
-                historical_df = calculate_monthly_changes(historical_df, tables)
-                
-                # Create and display the trend chart
-                fig = create_trend_chart(historical_df)
-                st.plotly_chart(fig, width="stretch", config={'displayModeBar': True, 'scrollZoom': True})
-                
-                # Display historical data table
-                with st.expander("📋 View Historical Data"):
-                    display_df = historical_df[['month_label', 'low_score_customers', 'exit_from_red', 'return_to_red', 'total_customers']].copy()
-                    display_df.columns = ['Month', 'Low Score Customers', 'Exit from Red', 'Return to Red', 'Total Customers']
-                    st.dataframe(display_df, width="stretch")
-            else:
-                st.warning("⚠️ No historical data found. The trend chart requires multiple dated sheets (e.g., '2025-04-07', '2025-05-08') in the Excel file.")
-                st.info("💡 **Tip**: Ensure your Excel file contains multiple sheets with date names in YYYY-MM-DD format for historical trend analysis.")
+        # Historical trends are computed in the background and filled in at the end of the run,
+        # so the tables and exports below are not held up by parsing every dated sheet
+        trend_slot = st.container()
         
         # Add chart insights
         col_insight1, col_insight2 = st.columns(2)
@@ -1435,15 +2447,40 @@ if file:
             else:
                 st.info("💡 **Opportunity**: Focus on helping customers exit the red zone")
 
-        # Per-category tables
-        for name in ["Exit from Red", "Return Back to Red", "New Comer to Red", "Missing from CHI"]:
+        # Per-category tables (paged; only the visible page is sent to the browser)
+        category_indexes = pipeline.stage("category_index", build_category_indexes, [classified],
+                                          col_customer=col_customer, col_prev=col_prev,
+                                          col_curr=col_curr, col_overall=col_overall).value
+        # Biggest score gains and drops between the compared months
+        st.markdown("### 🚀 Top Movers")
+        movers = pipeline.stage("top_movers", find_top_movers, [work], col_customer=col_customer,
+                                col_prev=col_prev, col_curr=col_curr, col_overall=col_overall)
+        m1, m2 = st.columns(2)
+        m1.markdown("**Biggest gains**")
+        m1.dataframe(movers.value.improvers, width="stretch", hide_index=True)
+        m2.markdown("**Biggest drops**")
+        m2.dataframe(movers.value.decliners, width="stretch", hide_index=True)
+        st.caption(f"Top {TOP_MOVERS_K} each way among {movers.value.compared} customers scored in both months "
+                   f"({len(movers.value.improvers)} gains, {len(movers.value.decliners)} drops shown)")
+
+        for name in CATEGORY_NAMES:
             st.markdown(f"### {name}")
-            dfc = tables[name]
-            if dfc is None or dfc.empty:
-                st.info("No records")
-            else:
-                show_cols = [c for c in [col_customer, col_prev, col_curr, col_overall] if c in dfc.columns]
-                st.dataframe(dfc[show_cols].rename(columns={col_prev: "Prev Score", col_curr: "Curr Score", col_customer: "Customer", col_overall: "Overall Score"}), width="stretch")
+            render_category_table(name, category_indexes[name])
+
+        # Any pair of dated sheets, from per-month customer bitsets
+        st.markdown("### 🧮 Month-Pair Comparison")
+        render_month_matrix(pipeline, workbook, col_customer, col_overall, threshold, customers)
+
+        # Red-zone streaks and recurrence across all dated sheets; like the trends, they need every
+        # dated sheet and are filled in once the trend job has built the month bitsets
+        st.markdown("### 🔁 Red-Zone Streaks")
+        streaks_slot = st.container()
+
+        # Categories and low-score metrics per segment value
+        segments_slot = st.container()
+        if segment_col:
+            with segments_slot:
+                st.markdown(f"### 🧩 Segments by {segment_col}")
 
         # Monthly Summary Report
         st.markdown("---")
@@ -1489,7 +2526,8 @@ if file:
             'prev_month_low_total': low_score_metrics['prev_month_low_total'],
             'curr_month_low_total': low_score_metrics['curr_month_low_total'],
             'low_score_improvement_count': low_score_metrics['improvement_count'],
-            'low_score_improvement_pct': low_score_metrics['improvement_percentage']
+            'low_score_improvement_pct': low_score_metrics['improvement_percentage'],
+            'top_movers': format_top_movers(movers.value),
         }
         
         # Standard Monthly Summary Report (Always Show)
@@ -1516,304 +2554,28 @@ if file:
         # Show if user clicked generate button OR if we already have a summary
         show_ai_section = (use_ai and q_available) or ("original_ai_summary" in st.session_state and st.session_state.get("ai_summary_generated", False))
         
-        if show_ai_section and q_available:
-            st.markdown("---")
-            st.subheader("🤖 GenAI Monthly Summary Report")
-            
-            with st.spinner("🤖 Generating AI-powered summary..."):
-                # Generate AI summary (returns success status and content)
-                # Generate AI summary only once and store in session state
-                if "original_ai_summary" not in st.session_state:
-                    print("🔍 DEBUG: Generating NEW AI summary...")
-                    success, ai_summary = generate_ai_summary(analysis_data)
-                    if success:
-                        st.session_state.original_ai_summary = ai_summary
-                        st.session_state.ai_summary_generated = True
-                        print(f"🔍 DEBUG: AI summary generated and cached. Length: {len(ai_summary)} chars")
-                        print(f"🔍 DEBUG: AI summary preview: {ai_summary[:200]}...")
-                    else:
-                        st.session_state.ai_summary_generated = False
-                        st.session_state.ai_summary_error = ai_summary
-                        print(f"🔍 DEBUG: AI summary generation FAILED: {ai_summary}")
-                else:
-                    # Use cached AI summary
-                    success = st.session_state.ai_summary_generated
-                    ai_summary = st.session_state.original_ai_summary if success else st.session_state.ai_summary_error
-                    print(f"🔍 DEBUG: Using CACHED AI summary. Success: {success}")
-                    print(f"🔍 DEBUG: Cached summary length: {len(ai_summary)} chars")
-                    print(f"🔍 DEBUG: Cached summary preview: {ai_summary[:200]}...")
-                
-                if success:
-                    # Check if there's an improved summary in session state
-                    display_summary = st.session_state.get('improved_summary', ai_summary)
-                    print(f"🔍 DEBUG: Display summary selection:")
-                    print(f"🔍 DEBUG: - Has improved_summary: {'improved_summary' in st.session_state}")
-                    print(f"🔍 DEBUG: - Using improved: {'improved_summary' in st.session_state}")
-                    print(f"🔍 DEBUG: - Display summary length: {len(display_summary)} chars")
-                    print(f"🔍 DEBUG: - Display summary preview: {display_summary[:200]}...")
-                    
-                    # Show which summary is being displayed
-                    col_info, col_actions = st.columns([3, 1])
-                    
-                    with col_info:
-                        if 'improved_summary' in st.session_state and st.session_state.improved_summary != ai_summary:
-                            st.info("📝 **Showing improved summary** (modified by Amazon Q Chat)")
-                        else:
-                            st.info("📝 **Showing original AI summary**")
-                    
-                    with col_actions:
-                        if 'improved_summary' in st.session_state and st.session_state.improved_summary != ai_summary:
-                            if st.button("🔄 Revert", key="revert_summary", help="Revert to original AI summary"):
-                                del st.session_state.improved_summary
-                                st.success("✅ Reverted to original summary")
-                                st.rerun()
-                        
-                        if st.button("🔄 Regenerate", key="regenerate_summary", help="Generate a new AI summary"):
-                            # Clear all summary-related session state
-                            if 'original_ai_summary' in st.session_state:
-                                del st.session_state.original_ai_summary
-                            if 'improved_summary' in st.session_state:
-                                del st.session_state.improved_summary
-                            if 'ai_summary_generated' in st.session_state:
-                                del st.session_state.ai_summary_generated
-                            if 'chat_history' in st.session_state:
-                                st.session_state.chat_history = []
-                            st.success("✅ Regenerating AI summary...")
-                            st.rerun()
-                    
-                    # Display the summary (original or improved)
-                    st.markdown(display_summary)
-                    
-                    # Add download button for the current summary
-                    st.download_button(
-                        label="📄 Download Current Summary",
-                        data=display_summary,
-                        file_name=f"chi_genai_summary_{timestamp}.md",
-                        mime="text/markdown"
-                    )
-                    
-                    # Interactive Chat Section for Summary Improvement
-                    st.markdown("---")
-                    col_title, col_status = st.columns([3, 1])
-                    with col_title:
-                        st.subheader("💬 Improve Summary with Amazon Q Chat")
-                    with col_status:
-                        if st.button("🔄", help="Refresh Amazon Q status", key="refresh_q_status"):
-                            clear_amazon_q_cache()
-                            st.rerun()
-                    
-                    # Show current status
-                    st.caption(f"Amazon Q Status: {q_status}")
-                    
-                    # Initialize chat history in session state
-                    if "chat_history" not in st.session_state:
-                        st.session_state.chat_history = []
-                        print("🔍 DEBUG: Initialized empty chat_history")
-                    else:
-                        print(f"🔍 DEBUG: Chat history has {len(st.session_state.chat_history)} items")
-                    
-                    # Initialize pending quick question state
-                    if "pending_quick_question" not in st.session_state:
-                        st.session_state.pending_quick_question = None
-                        print("🔍 DEBUG: Initialized pending_quick_question as None", flush=True)
-                    else:
-                        print(f"🔍 DEBUG: *** FOUND PENDING QUESTION: {st.session_state.pending_quick_question} ***", flush=True)
-                    
-                    # Prepare context for chat using the currently displayed summary
-                    current_displayed_summary = st.session_state.get('improved_summary', ai_summary)
-                    
-                    def get_chat_context():
-                        """Get the current context for Amazon Q chat"""
-                        current_summary = st.session_state.get('improved_summary', st.session_state.get('original_ai_summary', ai_summary))
-                        print(f"🔍 DEBUG: get_chat_context() called")
-                        print(f"🔍 DEBUG: - improved_summary exists: {'improved_summary' in st.session_state}")
-                        print(f"🔍 DEBUG: - original_ai_summary exists: {'original_ai_summary' in st.session_state}")
-                        print(f"🔍 DEBUG: - current_summary length: {len(current_summary)} chars")
-                        print(f"🔍 DEBUG: - current_summary preview: {current_summary[:200]}...")
-                        
-                        # Truncate summary if too long to avoid timeout
-                        summary_for_context = current_summary
-                        if len(current_summary) > 2000:
-                            summary_for_context = current_summary[:2000] + "\n\n[Summary truncated for processing efficiency]"
-                            print(f"🔍 DEBUG: Truncated summary from {len(current_summary)} to {len(summary_for_context)} chars")
-                        
-                        context = f"""CHI Analysis: {analysis_data['exit_from_red']} improved, {analysis_data['return_back_red']} deteriorated, {analysis_data['new_comer_red']} new low-score, {analysis_data['missing_from_chi']} missing data. Total: {analysis_data['total_customers']} customers, {analysis_data['low_score_improvement_pct']:.1f}% improvement.
-
-Current Summary:
-{summary_for_context}"""
-                        
-                        print(f"🔍 DEBUG: Generated context length: {len(context)} chars")
-                        return context
-                    
-                    # Display chat history
-                    if st.session_state.chat_history:
-                        st.markdown("**Chat History:**")
-                        for i, (user_msg, ai_response) in enumerate(st.session_state.chat_history):
-                            with st.expander(f"💬 Chat {i+1}: {user_msg[:50]}..."):
-                                st.markdown(f"**You:** {user_msg}")
-                                st.markdown(f"**Amazon Q:** {ai_response}")
-                    
-                    # Chat input
-                    st.markdown("**Ask Amazon Q to improve or modify the summary:**")
-                    
-                    # Predefined quick questions
-                    st.markdown("**Quick Actions:**")
-                    col1, col2, col3 = st.columns(3)
-                    
-                    with col1:
-                        if st.button("📈 Focus on improvements", help="Emphasize positive trends", key="btn_improvements"):
-                            question = "Please rewrite the summary to focus more on the positive improvements and success stories. Highlight the customers who improved their security scores."
-                            st.session_state.pending_quick_question = question
-                            print(f"🔍 DEBUG: BUTTON CLICKED - Focus on improvements", flush=True)
-                            print(f"🔍 DEBUG: Set pending_quick_question: {question}", flush=True)
-                            print(f"🔍 DEBUG: About to call st.rerun()", flush=True)
-                            import sys
-                            sys.stdout.flush()
-                            st.rerun()
-                    with col2:
-                        if st.button("⚠️ Highlight risks", help="Emphasize areas of concern", key="btn_risks"):
-                            st.session_state.pending_quick_question = "Please rewrite the summary to emphasize the security risks and areas that need immediate attention. Focus on the deteriorating customers."
-                            st.rerun()
-                    with col3:
-                        if st.button("📊 Add more metrics", help="Include additional analysis", key="btn_metrics"):
-                            st.session_state.pending_quick_question = "Please enhance the summary with more detailed metrics and statistical analysis. Include percentages and trends."
-                            st.rerun()
-                    
-                    # Handle pending quick question
-                    if st.session_state.pending_quick_question:
-                        print(f"🔍 DEBUG: *** PROCESSING PENDING QUESTION ***", flush=True)
-                        quick_question = st.session_state.pending_quick_question
-                        print(f"🔍 DEBUG: Question: {quick_question}", flush=True)
-                        st.session_state.pending_quick_question = None  # Clear it immediately
-                        print(f"🔍 DEBUG: Cleared pending_quick_question", flush=True)
-                        
-                        with st.spinner("🤖 Getting response from Amazon Q..."):
-                            # Use the current context with the displayed summary
-                            print(f"🔍 DEBUG: About to call get_chat_context()")
-                            context = get_chat_context()
-                            print(f"🔍 DEBUG: Context generated, calling chat_with_amazon_q()")
-                            print(f"🔍 DEBUG: Context preview: {context[:300]}...")
-                            chat_success, chat_response = chat_with_amazon_q(quick_question, context)
-                            print(f"🔍 DEBUG: chat_with_amazon_q returned: success={chat_success}")
-                            print(f"🔍 DEBUG: Response length: {len(chat_response) if chat_response else 0} chars")
-                            
-                            if chat_success:
-                                print(f"🔍 DEBUG: Chat SUCCESS - adding to history")
-                                # Add to chat history
-                                st.session_state.chat_history.append((quick_question, chat_response))
-                                print(f"🔍 DEBUG: Chat history now has {len(st.session_state.chat_history)} items")
-                                
-                                # Display the response
-                                st.success("✅ Response received!")
-                                st.markdown("**Amazon Q Response:**")
-                                st.markdown(chat_response)
-                                
-                                # Option to replace original summary (without rerun)
-                                col_a, col_b = st.columns(2)
-                                with col_a:
-                                    if st.button("🔄 Use this as new summary", key="replace_summary_quick"):
-                                        print(f"🔍 DEBUG: USER CLICKED 'Use this as new summary'")
-                                        st.session_state.improved_summary = chat_response
-                                        print(f"🔍 DEBUG: Set improved_summary, length: {len(chat_response)} chars")
-                                        st.success("✅ Summary updated! The new summary will be used in exports.")
-                                        st.rerun()
-                                with col_b:
-                                    if st.button("📋 Copy to clipboard", key="copy_quick"):
-                                        st.success("✅ Response copied! You can paste it elsewhere.")
-                                
-                            else:
-                                print(f"🔍 DEBUG: Chat FAILED: {chat_response}")
-                                st.error(f"Chat failed: {chat_response}")
-                                if "not logged in" in chat_response.lower():
-                                    st.info("💡 **Please login to Amazon Q CLI:**")
-                                    st.code("q login")
-                                    st.info("Then refresh this page or click the refresh button above.")
-                    
-                    # Custom question input
-                    st.markdown("**Custom Question:**")
-                    user_question = st.text_area(
-                        "Ask your own question:",
-                        placeholder="e.g., 'Make the summary more executive-friendly' or 'Add specific recommendations for TAMs'",
-                        key="chat_input"
-                    )
-                    
-                    if st.button("💬 Send Custom Question", type="primary", key="btn_custom") and user_question:
-                        st.session_state.pending_custom_question = user_question
-                        st.rerun()
-                    
-                    # Handle pending custom question
-                    if "pending_custom_question" not in st.session_state:
-                        st.session_state.pending_custom_question = None
-                    
-                    if st.session_state.pending_custom_question:
-                        custom_question = st.session_state.pending_custom_question
-                        st.session_state.pending_custom_question = None  # Clear it immediately
-                        
-                        with st.spinner("🤖 Getting response from Amazon Q..."):
-                            # Use the current context with the displayed summary
-                            chat_success, chat_response = chat_with_amazon_q(custom_question, get_chat_context())
-                            
-                            if chat_success:
-                                # Add to chat history
-                                st.session_state.chat_history.append((custom_question, chat_response))
-                                
-                                # Display the response
-                                st.success("✅ Response received!")
-                                st.markdown("**Amazon Q Response:**")
-                                st.markdown(chat_response)
-                                
-                                # Option to replace original summary (without rerun)
-                                col_a, col_b = st.columns(2)
-                                with col_a:
-                                    if st.button("🔄 Use this as new summary", key="replace_summary_custom"):
-                                        st.session_state.improved_summary = chat_response
-                                        st.success("✅ Summary updated! The new summary will be used in exports.")
-                                        st.rerun()
-                                with col_b:
-                                    if st.button("📋 Copy to clipboard", key="copy_custom"):
-                                        st.success("✅ Response copied! You can paste it elsewhere.")
-                                
-                            else:
-                                st.error(f"Chat failed: {chat_response}")
-                                if "not logged in" in chat_response.lower():
-                                    st.info("💡 **Please login to Amazon Q CLI:**")
-                                    st.code("q login")
-                                    st.info("Then refresh this page or click the refresh button above.")
-                    
-                    # Clear chat history button
-                    if st.session_state.chat_history:
-                        if st.button("🗑️ Clear Chat History"):
-                            st.session_state.chat_history = []
-                            # Don't use st.rerun() here, just clear the history
-                    
-                else:
-                    # Show error message
-                    st.error(f"AI Summary Generation Failed: {ai_summary}")
-                    st.info("Please check the log file for detailed error information.")
-        
-        elif not q_available:
-            st.markdown("---")
-            st.subheader("🤖 GenAI Monthly Summary Report")
-            st.info("💡 **GenAI Summary Not Available**: Amazon Q CLI is not available or not logged in. Please run `q login` in your terminal to enable AI-powered summaries.")
-            st.caption(f"Status: {q_status}")
-            
-            # Add refresh button to recheck Amazon Q status
-            col1, col2 = st.columns([1, 3])
-            with col1:
-                if st.button("🔄 Recheck Amazon Q", help="Clear cache and recheck Amazon Q CLI status"):
-                    clear_amazon_q_cache()
-                    st.rerun()
-            with col2:
-                st.caption("Click to refresh Amazon Q CLI status after login")
-            
-            # Show chat interface even when not logged in (with disabled state)
-            st.markdown("---")
-            st.subheader("💬 Amazon Q Chat (Unavailable)")
-            st.info("💡 **Chat Feature**: Login to Amazon Q CLI to enable interactive chat for improving summaries.")
-            st.text_area("Chat would appear here...", disabled=True, placeholder="Login to Amazon Q CLI to enable chat functionality")
+        render_genai_section(analysis_data, show_ai_section, q_available, q_status, timestamp)
 
         # Create combined summary for export (keeping original format for Excel)
-        summary_df = summarize_tables(tables, col_customer=col_customer, col_prev=col_prev, col_curr=col_curr)
+        summary = pipeline.stage("summary_table", summarize_tables, [classified],
+                                 col_customer=col_customer, col_prev=col_prev, col_curr=col_curr)
+        summary_df = summary.value
+
+        # Fill in the deferred sections, waiting at most the time budget for the trend job
+        with perf_span("trend_job", kind='wait'):
+            done, _ = wait([trend_job[1]], timeout=TREND_TIME_BUDGET_SECONDS)
+        streaks = segments = None
+        if done:
+            with trend_slot:
+                render_trend_section(pipeline, workbook, classified, threshold, history_dataset)
+            streaks, segments = render_history_sections(pipeline, workbook, work, col_customer, col_prev, col_curr,
+                                                        col_overall, segment_col, threshold, customers,
+                                                        streaks_slot, segments_slot)
+        else:
+            with trend_slot:
+                render_trend_placeholder(trend_job[1])
+            with streaks_slot:
+                st.info("⏳ Streaks are computed with the historical trends and will appear here when ready.")
         
         # Export section
         st.markdown("---")
@@ -1822,8 +2584,9 @@ Current Summary:
         col1, col2 = st.columns(2)
         
         with col1:
-            # Excel Export
-            report_bytes = export_excel(tables, summary_df)
+            # Excel Export; the streak and segment sheets are added once the trend job has finished
+            export_deps = [classified, summary, movers] + [r for r in (streaks, segments) if r is not None]
+            report_bytes = pipeline.stage("export_excel", export_excel, export_deps).value
             st.download_button(
                 label="📊 Download Excel Report",
                 data=report_bytes,
@@ -1832,52 +2595,64 @@ Current Summary:
             )
         
         with col2:
-            # PDF Export - 實時檢測 reportlab
-            try:
-                from reportlab.lib.pagesizes import A4, landscape
-                from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-                from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-                from reportlab.lib import colors
-                from reportlab.lib.units import inch
-                pdf_available_now = True
-            except ImportError:
-                pdf_available_now = False
-            
-            # 顯示調試資訊
-            st.caption(f"🔍 DEBUG: PDF_AVAILABLE={PDF_AVAILABLE}, pdf_available_now={pdf_available_now}")
-            
-            if pdf_available_now:
-                try:
-                    # Get AI summary if available (use improved version if exists)
-                    ai_summary_text = ""
-                    if use_ai and q_available and 'ai_summary' in locals():
-                        if success:
-                            # Use improved summary if available, otherwise use original
-                            ai_summary_text = st.session_state.get('improved_summary', ai_summary)
-                        else:
-                            ai_summary_text = ""
-                    
-                    # Get chat history if available
-                    chat_history_for_pdf = st.session_state.get('chat_history', [])
-                    
-                    pdf_bytes = export_pdf(tables, summary_df, 
-                                         analysis_summary=summary_text,
-                                         ai_summary=ai_summary_text,
-                                         chat_history=chat_history_for_pdf)
-                    st.download_button(
-                        label="📄 Download PDF Report",
-                        data=pdf_bytes,
-                        file_name="CHI_Low_Security_Analysis_Report.pdf",
-                        mime="application/pdf",
-                    )
-                except Exception as pdf_error:
-                    st.error(f"PDF generation failed: {str(pdf_error)}")
-                    st.info("Please ensure reportlab is installed: `pip install reportlab`")
-            else:
-                st.error("📄 PDF Export unavailable")
-                st.caption("Install reportlab to enable PDF export: `pip install reportlab`")
-                st.caption("🔧 Try: `chi_analyzer_env/bin/pip install reportlab`")
+            render_pdf_export(pipeline, classified, summary, summary_text)
 
     except Exception as e:
         st.exception(e)
         st.error("Parsing failed. Please verify sheet layout and column names, or try the other comparison mode.")
+
+elif len(uploads) > 1:
+    render_portfolio_view(pipeline, uploads, MODE_SHEET1 if mode.startswith("Sheet1") else MODE_SHEETS, threshold)
+
+# Stage-level cache activity for this rerun
+if pipeline.stats:
+    with st.sidebar:
+        with st.expander("🧮 Pipeline Stages"):
+            st.caption("hit = served from cache, miss = recomputed on this rerun")
+            st.dataframe(pipeline.stats_frame(), width="stretch", hide_index=True)
+
+# Process-wide shared cache (all sessions)
+with st.sidebar:
+    with st.expander("🗄️ Shared Analysis Cache"):
+        cache_status = pipeline.cache.status()
+        st.caption(f"{cache_status['entries']} entries from {cache_status['workbooks']} workbook(s), "
+                   f"{cache_status['bytes'] / 1e6:.1f} / {cache_status['max_bytes'] / 1e6:.0f} MB")
+        st.caption(f"Hits: {cache_status['hits']} | Misses: {cache_status['misses']} | "
+                   f"Evictions: {cache_status['evictions']} | Waited on other sessions: {cache_status['waits']}")
+        st.dataframe(pipeline.cache.usage_frame(), width="stretch", hide_index=True)
+        if os.environ.get('CHI_CACHE_ADMIN') == '1':
+            if st.button("🧹 Clear Shared Cache", help="Drop cached results for all sessions"):
+                pipeline.cache.clear()
+                st.rerun()
+
+# Close the profile of this rerun, tagged with workbook hash, mode and threshold
+profile_capture = st.session_state.pop("profile_capture", None)
+if profile_capture is not None:
+    if file:
+        profile_tag = hashlib.sha1(file.getvalue()).hexdigest()
+    else:
+        profile_tag = "portfolio" if uploads else "none"
+    st.session_state.last_profile = finish_rerun_profile(
+        profile_capture, profile_tag, MODE_SHEET1 if mode.startswith("Sheet1") else MODE_SHEETS, threshold)
+
+# Timing spans of recent reruns (this rerun is closed first, so the panel itself is not timed)
+perf_tracker = st.session_state.perf_tracker
+finish_perf_rerun()
+with st.sidebar:
+    if st.toggle("⏱️ Performance panel", key="show_perf_panel",
+                 help=f"Timing of pipeline stages and q calls over the last {PERF_HISTORY_RERUNS} reruns"):
+        with st.expander("⏱️ Performance", expanded=True):
+            history = perf_tracker.history_frame()
+            st.dataframe(history, width="stretch", hide_index=True)
+            if not history.empty:
+                rerun = st.selectbox("Spans of rerun", history['Rerun'].tolist(), key="perf_rerun")
+                st.dataframe(perf_tracker.spans_frame(rerun), width="stretch", hide_index=True)
+            if METRICS_FILE:
+                st.caption(f"Metrics exported to `{METRICS_FILE}`")
+            if PROFILE_ALWAYS:
+                st.caption(f"Profiling every rerun (CHI_PROFILE=1) into `{PROFILE_DIR}`")
+            else:
+                st.toggle("🔬 Profile reruns", key="profile_reruns",
+                          help=f"Write cProfile and collapsed-stack files for each rerun to {PROFILE_DIR}")
+            for path in st.session_state.get("last_profile", []):
+                st.caption(f"Last profile: `{path}`")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Synthetic CHI workbook generator
+
+Builds workbooks shaped like the monthly CHI export: a Sheet1 with merged
+title/group header rows above the real header and two Security Score
+columns (current and previous month), followed by one dated sheet
+(YYYY-MM-DD) per month with the customer's Overall Score and that month's
+Security Score. Scores follow a per-customer random walk, customers
+join and leave over time, and some have no Overall Score, so every
+category (Exit / Return / New Comer / Missing) is populated.
+
+    python chi_workbook_generator.py --customers 10000 --months 12 --output chi-10k.xlsx
+
+Sheets are streamed with openpyxl's write-only mode, so large workbooks
+(1M customers) do not need the whole sheet in memory.
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.worksheet.cell_range import CellRange
+
+REGIONS = ["APJ", "EMEA", "NA", "LATAM", "GCR"]
+SHEET1_HEADER = ["Customer", "TAM", "Region", "Overall Score"]
+DATED_HEADER = ["Customer", "TAM", "Region", "Overall Score", "Security Score"]
+
+
+def month_dates(months: int, end_date: str) -> list:
+    """`months` monthly snapshot dates ending at end_date, oldest first"""
+    end = pd.Timestamp(end_date)
+    return [end - pd.DateOffset(months=k) for k in range(months - 1, -1, -1)]
+
+
+def simulate_scores(customers: int, months: int, seed: int = 0, churn: float = 0.03,
+                    missing_overall: float = 0.04) -> dict:
+    """Per-month Security Scores (NaN when the customer is absent) plus static attributes"""
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(15, 90, customers)
+    steps = rng.normal(0, 6, (months, customers))
+    scores = np.clip(start + np.cumsum(steps, axis=0), 0, 100).round(1)
+
+    # Customers join late or leave early
+    joined = np.where(rng.random(customers) < churn * months, rng.integers(0, months, customers), 0)
+    left = np.where(rng.random(customers) < churn * months / 2, rng.integers(1, months + 1, customers), months)
+    month_idx = np.arange(months)[:, None]
+    scores[(month_idx < joined) | (month_idx >= left)] = np.nan
+
+    overall = rng.uniform(25, 95, customers).round(1)
+    overall[rng.random(customers) < missing_overall] = np.nan
+    return {
+        "names": np.array([f"Customer {i:07d}" for i in range(customers)], dtype=object),
+        "tams": np.array([f"TAM {i:03d}" for i in rng.integers(0, max(1, customers // 150), customers)], dtype=object),
+        "regions": np.array(REGIONS, dtype=object)[rng.integers(0, len(REGIONS), customers)],
+        "overall": overall,
+        "scores": scores,
+    }
+
+
+def _cell(value):
+    """openpyxl cannot write NaN; leave the cell empty instead"""
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def generate_workbook(path: str, customers: int = 5000, months: int = 12, seed: int = 0,
+                      end_date: str = "2025-10-06") -> str:
+    """Write a synthetic CHI workbook to path and return the path"""
+    if months < 2:
+        raise ValueError("Need at least 2 months (Sheet1 compares current vs previous)")
+    sim = simulate_scores(customers, months, seed=seed)
+    dates = month_dates(months, end_date)
+    curr_label = f"Security Score ({dates[-1].strftime('%b-%d')})"
+    prev_label = f"Security Score ({dates[-2].strftime('%b-%d')})"
+
+    wb = Workbook(write_only=True)
+
+    # Sheet1: title and group rows are merged, the real header is on row 5
+    ws = wb.create_sheet("Sheet1")
+    width = len(SHEET1_HEADER) + 2
+    last_col = chr(ord("A") + width - 1)
+    for rng_ in (f"A1:{last_col}1", f"A2:{last_col}2", "A4:C4", f"D4:{last_col}4"):
+        ws.merged_cells.add(CellRange(rng_))
+    ws.append(["CHI Monthly Review"])
+    ws.append([f"Synthetic data generated {datetime.now():%Y-%m-%d} ({customers} accounts, {months} months)"])
+    ws.append([])
+    ws.append(["Account", None, None, "Scores"])
+    ws.append(SHEET1_HEADER + [curr_label, prev_label])
+    curr, prev = sim["scores"][-1], sim["scores"][-2]
+    for i in range(customers):
+        ws.append([sim["names"][i], sim["tams"][i], sim["regions"][i], _cell(sim["overall"][i]),
+                   _cell(curr[i]), _cell(prev[i])])
+
+    # One dated sheet per month, only customers present that month; Overall Score
+    # stays blank for the same customers as on Sheet1 (they land in "Missing from CHI")
+    for m, date in enumerate(dates):
+        ws = wb.create_sheet(date.strftime("%Y-%m-%d"))
+        ws.append(DATED_HEADER)
+        month_scores = sim["scores"][m]
+        for i in np.flatnonzero(~np.isnan(month_scores)):
+            ws.append([sim["names"][i], sim["tams"][i], sim["regions"][i], _cell(sim["overall"][i]),
+                       float(month_scores[i])])
+
+    wb.save(path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--customers", type=int, default=5000, help="customers per workbook (1k-1M)")
+    parser.add_argument("--months", type=int, default=12, help="dated sheets (2-60)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--end-date", default="2025-10-06", help="date of the latest sheet")
+    parser.add_argument("--output", default=None, help="default: chi-synthetic-<customers>x<months>.xlsx")
+    args = parser.parse_args()
+
+    output = args.output or f"chi-synthetic-{args.customers}x{args.months}.xlsx"
+    generate_workbook(output, customers=args.customers, months=args.months, seed=args.seed, end_date=args.end_date)
+    print(f"✅ Wrote {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
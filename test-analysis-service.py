@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Test the analysis service request handling without a server: option
+validation, the response cache and its byte bound, and the error statuses
+(400 / 403 / 404 / 422 / 503) returned for bad requests
+"""
+
+import json
+import os
+import sys
+import tempfile
+
+# Add current directory to import the service and generator modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+from chi_analysis_service import AnalysisService, ServiceError, parse_options
+from chi_workbook_generator import generate_workbook
+
+
+def service(data_dir: str, max_concurrent: int = 2, response_cache_mb: float = 8) -> AnalysisService:
+    return AnalysisService(workers=1, max_concurrent=max_concurrent, cache_mb=64,
+                           response_cache_mb=response_cache_mb, data_dir=data_dir, max_upload_mb=10)
+
+
+def options(**body) -> dict:
+    return parse_options({}, body)
+
+
+def expect_status(label: str, status: int, call) -> bool:
+    try:
+        call()
+        got = None
+    except ServiceError as e:
+        got = e.status
+    passed = got == status
+    print(f"{'✅' if passed else '❌'} {label}: {got}")
+    return passed
+
+
+def test_parse_options() -> bool:
+    """Query-string and JSON options are normalized; badly typed ones are 400, not 500"""
+    print("🧪 Testing option parsing")
+    parsed = parse_options({"include": ["history,excel"], "threshold": ["50"], "mode": ["sheets"]}, {"prev": "a"})
+    passed = parsed == {"mode": "sheets", "threshold": 50.0, "prev": "a", "curr": None,
+                        "include": ["excel", "history"]}
+    print(f"{'✅' if passed else '❌'} normalized: {parsed}")
+    return all([passed] + [
+        expect_status(f"{name}={value!r}", 400, lambda: options(**{name: value}))
+        for name, value in [("include", 5), ("include", ["history", 5]), ("include", {"history": True}),
+                            ("mode", 5), ("mode", "weekly"), ("prev", 3), ("curr", ["2025-01-01"]),
+                            ("threshold", "high"), ("threshold", True), ("threshold", "nan"), ("threshold", None)]
+    ])
+
+
+def test_analyze(data: bytes, data_dir: str) -> bool:
+    """Cache hits, the byte-bounded response cache and the error statuses of analyze()"""
+    print("🧪 Testing analyze()")
+    svc = service(data_dir)
+    first = svc.analyze(data, options(include=["history"]))
+    second = svc.analyze(data, options(include="history"))
+    response = json.loads(first)
+    hit = first is second and svc.counters["response_cache_hits"] == 1 and len(response["history"]) == 3
+    print(f"{'✅' if hit else '❌'} cache hit: hits={svc.counters['response_cache_hits']} counts={response['counts']}")
+
+    # Room for one response only: the older one is evicted, and the total stays under the cap
+    small = service(data_dir, response_cache_mb=len(first) * 1.5 / 1e6)
+    small.analyze(data, options(include=["history"]))
+    small.analyze(data, options(include=["history"], threshold=50))
+    status = small.status()
+    bounded = (status["cached_responses"] == 1 and 0 < status["cached_response_bytes"] <= small.response_cache_bytes)
+    print(f"{'✅' if bounded else '❌'} byte bound: {status['cached_responses']} responses, "
+          f"{status['cached_response_bytes']}/{small.response_cache_bytes} bytes")
+
+    busy = service(data_dir, max_concurrent=1)
+    busy.slots.acquire()
+    return all([
+        hit, bounded,
+        expect_status("unknown include", 400, lambda: svc.analyze(data, options(include=["charts"]))),
+        expect_status("unknown sheet", 422, lambda: svc.analyze(data, options(mode="sheets", prev="2001-01-01"))),
+        expect_status("not a workbook", 422, lambda: svc.analyze(b"not a workbook", options())),
+        expect_status("over the concurrency limit", 503, lambda: busy.analyze(data, options())),
+    ])
+
+
+def test_workbook_paths(data_dir: str) -> bool:
+    """Paths resolve under the data directory only"""
+    print("🧪 Testing workbook paths")
+    svc = service(data_dir)
+    with open(os.path.join(data_dir, "notes.txt"), "w") as f:
+        f.write("not a workbook")
+    outside = os.path.join(os.path.dirname(data_dir), "outside.xlsx")
+    return all([
+        len(svc.read_workbook_path("chi.xlsx")) > 0,
+        expect_status("../ traversal", 403, lambda: svc.read_workbook_path("../outside.xlsx")),
+        expect_status("nested ../ traversal", 403, lambda: svc.read_workbook_path("sub/../../outside.xlsx")),
+        expect_status("absolute path", 403, lambda: svc.read_workbook_path(outside)),
+        expect_status("missing workbook", 404, lambda: svc.read_workbook_path("missing.xlsx")),
+        expect_status("not .xlsx", 404, lambda: svc.read_workbook_path("notes.txt")),
+    ])
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = os.path.join(tmp, "data")
+        os.makedirs(data_dir)
+        path = generate_workbook(os.path.join(data_dir, "chi.xlsx"), customers=300, months=3, seed=1)
+        with open(path, "rb") as f:
+            workbook = f.read()
+        results = [test_parse_options(), test_analyze(workbook, data_dir), test_workbook_paths(data_dir)]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
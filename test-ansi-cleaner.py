@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Test that AnsiStreamCleaner matches clean_ansi_codes() for any chunking
+"""
+
+import os
+import random
+import re
+import sys
+import time
+
+# Add current directory to import the analyzer module
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from chi_low_security_score_analyzer import AnsiStreamCleaner, clean_ansi_codes
+
+
+def clean_ansi_codes_reference(text: str) -> str:
+    """The original (uncompiled) implementation, kept as the reference"""
+    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+    cleaned = ansi_escape.sub('', text)
+    cleaned = re.sub(r'\[[\d;]+m', '', cleaned)
+    cleaned = re.sub(r'\[\d+m', '', cleaned)
+    cleaned = re.sub(r'\n\s*\n\s*\n', '\n\n', cleaned)
+    return cleaned.strip()
+
+
+# Fragments that stress the patterns: escapes, leftover codes, whitespace runs
+FRAGMENTS = ['\x1b', '[', '1', '0', ';', 'm', '3', '2', 'K', 'A', '\x1b[0m', '\x1b[38;5;12m',
+             '[1m', '[0;32m', '\n', ' ', '\t', '\n\n\n', 'Hello', 'security', '#', '-', '~', 'x']
+
+
+def stream_clean(text: str, rng: random.Random) -> str:
+    cleaner = AnsiStreamCleaner()
+    out, i = [], 0
+    while i < len(text):
+        step = rng.randint(1, 8)
+        out.append(cleaner.feed(text[i:i + step]))
+        i += step
+    out.append(cleaner.finish())
+    return "".join(out)
+
+
+def test_equivalence(cases: int = 20000) -> bool:
+    """Random inputs and random chunk boundaries give identical output"""
+    rng = random.Random(1234)
+    for n in range(cases):
+        text = "".join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, 40)))
+        expected = clean_ansi_codes_reference(text)
+        if clean_ansi_codes(text) != expected or stream_clean(text, rng) != expected:
+            print(f"❌ Mismatch for case {n}: {text!r}")
+            return False
+    print(f"✅ {cases} random cases match the reference implementation")
+    return True
+
+
+def test_large_response() -> bool:
+    """Typical colored CLI response streamed in 4 KB chunks"""
+    line = "\x1b[32m>\x1b[0m Security posture \x1b[1mimproved\x1b[0m for customers.\n"
+    text = line * 20000 + "\n\n\n\n" + "[0m done\n"
+    start = time.perf_counter()
+    cleaner = AnsiStreamCleaner()
+    streamed = "".join(cleaner.feed(text[i:i + 4096]) for i in range(0, len(text), 4096)) + cleaner.finish()
+    elapsed = time.perf_counter() - start
+    passed = streamed == clean_ansi_codes_reference(text)
+    print(f"{'✅' if passed else '❌'} {len(text) / 1e6:.1f} MB streamed in {elapsed * 1000:.0f} ms")
+    return passed
+
+
+if __name__ == "__main__":
+    results = [test_equivalence(), test_large_response()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
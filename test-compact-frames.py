@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Test that compacted frames classify exactly like the full parsed frames,
+including scores a hair below or above the threshold
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+THRESHOLD = 42
+NEAR = [41.99996, 41.999996, 41.9999999, 42.0, 42.0000001, 42.00004, 41.95, 42.3, np.nan, "n/a"]
+
+
+def full_frame() -> pd.DataFrame:
+    """Every pairing of the near-threshold scores, plus columns the analysis does not read"""
+    prev, curr = zip(*[(p, c) for p in NEAR for c in NEAR])
+    n = len(prev)
+    return pd.DataFrame({
+        "Customer": [f"Customer {i}" for i in range(n)],
+        "Notes": ["x"] * n,
+        "Overall Score": np.where(np.arange(n) % 7 == 0, np.nan, 60.0),
+        "Security Score Prev": pd.Series(prev, dtype=object),
+        "Security Score Curr": pd.Series(curr, dtype=object),
+    })
+
+
+def sheet1_work(df: pd.DataFrame) -> pd.DataFrame:
+    return core.build_sheet1_frame((df, "Customer", "Overall Score"), "Security Score Prev", "Security Score Curr")
+
+
+def test_classify_near_threshold() -> bool:
+    """Same customers in every category and same low-score metrics, compact vs full"""
+    print("🧪 Testing classify on compact vs full frames")
+    full = full_frame()
+    compact = core.compact_chi_frame(full)
+    results = {}
+    for name, df in (("full", full), ("compact", sheet1_work(compact))):
+        tables = core.classify(df, "Security Score Prev", "Security Score Curr", "Overall Score", THRESHOLD)
+        metrics = core.calculate_low_score_metrics(df, "Security Score Prev", "Security Score Curr", THRESHOLD)
+        results[name] = ({k: sorted(v["Customer"]) for k, v in tables.items()}, metrics)
+    passed = results["full"] == results["compact"]
+    counts = {k: len(v) for k, v in results["compact"][0].items()}
+    print(f"{'✅' if passed else '❌'} categories={counts} metrics={results['compact'][1]}")
+    return passed
+
+
+def test_history_near_threshold() -> bool:
+    """History counts of a compacted dated sheet match a plain comparison on the raw scores"""
+    print("🧪 Testing history counts on a compacted sheet")
+    raw = pd.DataFrame({"Customer": [f"C{i}" for i in range(len(NEAR))], "Security Score": NEAR})
+    history = core.history_from_sheets(core.compact_chi_frame(raw), sheets=["2025-10-06"], threshold=THRESHOLD)
+    scores = pd.to_numeric(raw["Security Score"], errors="coerce")
+    expected = (int((scores < THRESHOLD).sum()), int(scores.notna().sum()))
+    got = (int(history["low_score_customers"].iloc[0]), int(history["total_customers"].iloc[0]))
+    passed = got == expected
+    print(f"{'✅' if passed else '❌'} low/total={got} expected={expected}")
+    return passed
+
+
+if __name__ == "__main__":
+    results = [test_classify_near_threshold(), test_history_near_threshold()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Test that joining dated sheets on interned customer IDs matches a join on
+the customer name column, and that the process-wide dictionary stays bounded
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+# Names differing only in whitespace are different customers, as in a string join
+PREV_NAMES = ["Acme", "Acme ", "Blue  Sky", "Blue Sky", "Cobalt", "Cobalt", None, "Delta"]
+CURR_NAMES = ["Acme", " Acme", "Blue  Sky", "Echo", "Cobalt", None, "Delta", "Delta"]
+
+
+def sheet(names, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    scores = rng.uniform(20, 70, len(names)).round(1)
+    overall = np.where(rng.random(len(names)) < 0.2, np.nan, rng.uniform(25, 95, len(names)).round(1))
+    return core.compact_chi_frame(pd.DataFrame({"Customer": names, "Overall Score": overall,
+                                                "Security Score": scores}))
+
+
+def string_merge(df_prev: pd.DataFrame, df_curr: pd.DataFrame) -> pd.DataFrame:
+    """Reference: outer join on the customer name column"""
+    left = pd.DataFrame({"Customer": df_prev["Customer"].astype(object),
+                         "__prev__": df_prev["Security Score"].to_numpy()})
+    right = pd.DataFrame({"Customer": df_curr["Customer"].astype(object),
+                          "Overall Score": df_curr["Overall Score"].to_numpy(),
+                          "__curr__": df_curr["Security Score"].to_numpy()})
+    return pd.merge(left, right, on="Customer", how="outer")
+
+
+def test_matches_string_merge() -> bool:
+    """Same rows, names and categories as the string join, including whitespace variants, duplicates and blanks"""
+    print("🧪 Testing ID join against the string join")
+    df_prev, df_curr = sheet(PREV_NAMES, 1), sheet(CURR_NAMES, 2)
+    dictionary = core.CustomerDictionary()
+    merged = core.merge_dated_sheets(df_prev, df_curr, dictionary.encode(df_prev["Customer"]),
+                                     dictionary.encode(df_curr["Customer"]), "Customer", "Overall Score",
+                                     dictionary)
+    reference = string_merge(df_prev, df_curr)
+
+    def rows(df):
+        df = df[["Customer", "__prev__", "Overall Score", "__curr__"]].astype({"Customer": object})
+        return df.sort_values(list(df.columns), na_position="last").reset_index(drop=True)
+
+    same_rows = rows(merged).equals(rows(reference))
+    counts = {}
+    for name, df in (("ids", merged), ("strings", reference)):
+        tables = core.classify(df, "__prev__", "__curr__", "Overall Score", threshold=42)
+        counts[name] = {k: sorted(map(repr, v["Customer"])) for k, v in tables.items()}
+    passed = same_rows and counts["ids"] == counts["strings"] and "Acme " in set(merged["Customer"])
+    print(f"{'✅' if passed else '❌'} rows={len(merged)}/{len(reference)} same_rows={same_rows} "
+          f"same_categories={counts['ids'] == counts['strings']}")
+    return passed
+
+
+def test_dictionary_bound() -> bool:
+    """The holder starts a new dictionary (with a new stage-key token) once the bound is passed"""
+    print("🧪 Testing customer dictionary bound")
+    holder = core.CustomerDictionaryHolder(max_names=3)
+    first = holder.current()
+    first.encode(pd.Series(["a", "b", "c"]))
+    same = holder.current() is first
+    first.encode(pd.Series(["d"]))
+    second = holder.current()
+    passed = same and second is not first and len(second) == 0 and repr(second) != repr(first)
+    print(f"{'✅' if passed else '❌'} kept_at_bound={same} replaced={second is not first} replaced_count={holder.replaced}")
+    return passed
+
+
+if __name__ == "__main__":
+    results = [test_matches_string_merge(), test_dictionary_bound()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
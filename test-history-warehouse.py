@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Test the opt-in history warehouse: off unless CHI_HISTORY_DB is set, each
+workbook synced once, and warehouse history equal to the history parsed
+from the workbook's own sheets
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+# The warehouse is opt-in; check the default with the variable unset
+os.environ.pop("CHI_HISTORY_DB", None)
+
+# Add current directory to import the analysis core and generator modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+from chi_workbook_generator import generate_workbook
+
+DATASET = "team"
+THRESHOLDS = [42, 50.5, 30]
+
+
+def workbook(pipeline: core.AnalysisPipeline, path: str) -> core.StageResult:
+    with open(path, "rb") as f:
+        data = f.read()
+    return pipeline.source("workbook", data, hashlib.sha1(data).hexdigest())
+
+
+def counting(warehouse: core.HistoryWarehouse) -> list:
+    """Record the months the warehouse stores"""
+    stored = []
+    store_month = warehouse.store_month
+
+    def wrapper(dataset, month, *args):
+        stored.append(month)
+        return store_month(dataset, month, *args)
+    warehouse.store_month = wrapper
+    return stored
+
+
+def test_opt_in(path: str) -> bool:
+    """No warehouse by default; without one, or without a dataset, history comes from the workbook"""
+    print("🧪 Testing warehouse opt-in")
+    pipeline = core.AnalysisPipeline(core.SharedStageCache(int(64e6)))
+    wb = workbook(pipeline, path)
+    parsed = core.workbook_history_stage(pipeline.stage, wb, 42).value
+    with tempfile.TemporaryDirectory() as tmp:
+        warehouse = core.HistoryWarehouse(os.path.join(tmp, "history.sqlite3"))
+        stored = counting(warehouse)
+        no_dataset = core.history_stage(pipeline.stage, warehouse, wb, 42, dataset="").value
+        warehouse._conn.close()
+    no_warehouse = core.history_stage(pipeline.stage, None, wb, 42, dataset=DATASET).value
+    passed = core.HISTORY_DB == "" and no_warehouse.equals(parsed) and no_dataset.equals(parsed) and not stored
+    print(f"{'✅' if passed else '❌'} HISTORY_DB={core.HISTORY_DB!r} months_stored_without_dataset={len(stored)}")
+    return passed
+
+
+def test_sync_once_and_history(path: str, older_path: str) -> bool:
+    """Months are stored once per workbook; history matches the parsed sheets and spans earlier uploads"""
+    print("🧪 Testing warehouse sync and history")
+    with tempfile.TemporaryDirectory() as tmp:
+        warehouse = core.HistoryWarehouse(os.path.join(tmp, "history.sqlite3"))
+        stored = counting(warehouse)
+        results = []
+
+        # Earlier upload first, then the current workbook (overlapping in one month)
+        older = core.AnalysisPipeline(core.SharedStageCache(int(64e6)))
+        core.history_stage(older.stage, warehouse, workbook(older, older_path), 42, DATASET)
+        older_months = len(stored)
+        pipeline = core.AnalysisPipeline(core.SharedStageCache(int(64e6)))
+        wb = workbook(pipeline, path)
+        for threshold in THRESHOLDS:
+            history = core.history_stage(pipeline.stage, warehouse, wb, threshold, DATASET).value
+            parsed = core.workbook_history_stage(pipeline.stage, wb, threshold).value
+            own = history[history["month_label"].isin(parsed["month_label"])].reset_index(drop=True)
+            same = own.equals(parsed)
+            results.append(same)
+            print(f"{'✅' if same else '❌'} threshold={threshold}: {len(history)} months, "
+                  f"{len(parsed)} from the workbook match")
+        synced_once = len(stored) == older_months + len(parsed) and len(set(stored)) == len(history)
+        print(f"{'✅' if synced_once else '❌'} stored {len(stored)} months over {len(THRESHOLDS)} thresholds")
+        results.append(synced_once and len(history) > len(parsed))
+        warehouse._conn.close()
+    return all(results)
+
+
+def test_stage_key_per_warehouse(path: str) -> bool:
+    """Two warehouse files never share a cached history, even with equal revisions"""
+    print("🧪 Testing history stage keys per warehouse")
+    pipeline = core.AnalysisPipeline(core.SharedStageCache(int(64e6)))
+    wb = workbook(pipeline, path)
+    with tempfile.TemporaryDirectory() as tmp:
+        keys = []
+        for name in ("a.sqlite3", "b.sqlite3"):
+            warehouse = core.HistoryWarehouse(os.path.join(tmp, name))
+            warehouse.revision = lambda dataset: "same"
+            keys.append(core.history_stage(pipeline.stage, warehouse, wb, 42, DATASET).key)
+            warehouse._conn.close()
+    passed = keys[0] != keys[1] and pipeline.last_run["history"] == "miss"
+    print(f"{'✅' if passed else '❌'} distinct keys={keys[0] != keys[1]}")
+    return passed
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp:
+        current = generate_workbook(os.path.join(tmp, "current.xlsx"), customers=300, months=3, seed=1)
+        older = generate_workbook(os.path.join(tmp, "older.xlsx"), customers=300, months=3, seed=2,
+                                  end_date="2025-08-06")
+        results = [test_opt_in(current), test_sync_once_and_history(current, older),
+                   test_stage_key_per_warehouse(current)]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
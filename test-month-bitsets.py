@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Test that the month bitsets give the same categories as DataFrame classify()
+for every pair of dated sheets in a generated workbook, including customers
+missing from one of the two months
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+# Add current directory to import the analysis core and generator modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+from chi_workbook_generator import generate_workbook
+
+
+def check_pairs(data: bytes, threshold: float) -> bool:
+    """classify_month_pair, month_pair_customers and month_comparison_matrix against classify() on every pair"""
+    pipeline = core.AnalysisPipeline(core.SharedStageCache(int(64e6)))
+    dictionary = core.CustomerDictionary()
+    wb = pipeline.source("workbook", data, hashlib.sha1(data).hexdigest())
+    col_customer, col_overall = pipeline.stage("parse_sheet1", core.load_sheet1, [wb]).value[1:]
+    bits = core.month_bitsets_stage(pipeline.stage, wb, col_customer, col_overall, threshold, dictionary).value
+    matrices = {name: core.month_comparison_matrix(bits, name) for name in core.CATEGORY_NAMES}
+
+    passed, pairs, absent = True, 0, 0
+    for a in range(len(bits.months) - 1):
+        for b in range(a + 1, len(bits.months)):
+            result = core.run_headless_analysis(pipeline, data, mode=core.MODE_SHEETS, threshold=threshold,
+                                                prev=bits.months[a], curr=bits.months[b], dictionary=dictionary)
+            tables = result["classified"].value
+            expected = {name: set(df[col_customer].astype(str)) for name, df in tables.items()}
+            counts = core.classify_month_pair(bits, a, b)
+            for name in core.CATEGORY_NAMES:
+                names = set(core.month_pair_customers(bits, a, b, name, dictionary))
+                same = (names == expected[name] and counts[name] == len(expected[name])
+                        == matrices[name].iloc[a, b])
+                if not same:
+                    print(f"❌ threshold={threshold} {bits.months[a]} -> {bits.months[b]} {name}: "
+                          f"bitsets={counts[name]} classify={len(expected[name])}")
+                passed = passed and same
+            pairs += 1
+            present = np.unpackbits(bits.present[[a, b]].view(np.uint8), axis=1, bitorder="little")
+            absent += int(np.count_nonzero(present[0] != present[1]))
+    passed = passed and pairs == len(bits.months) * (len(bits.months) - 1) // 2 and absent > 0
+    print(f"{'✅' if passed else '❌'} threshold={threshold}: {pairs} month pairs, "
+          f"customers absent from one month of a pair {absent} times")
+    return passed
+
+
+def test_bitsets_match_classify() -> bool:
+    print("🧪 Testing month bitsets against classify()")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_workbook(os.path.join(tmp, "chi-synthetic.xlsx"), customers=400, months=4, seed=3)
+        with open(path, "rb") as f:
+            data = f.read()
+    return all([check_pairs(data, 42), check_pairs(data, 50.5)])
+
+
+if __name__ == "__main__":
+    results = [test_bitsets_match_classify()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Test the Amazon Q telemetry summaries: per-operation and per-day latency
+percentiles, failure rates and payload sizes from a few recorded calls
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+DAY = 86400
+
+
+def record_calls(store: core.QTelemetryStore, now: float):
+    store.record("chat", "fake", 1, now - DAY, 1.0, prompt_bytes=1024, response_bytes=512)
+    store.record("chat", "fake", 1, now, 2.0, prompt_bytes=1024, response_bytes=512)
+    store.record("chat", "fake", 2, now, 3.0, prompt_bytes=1024, error_class="timeout")
+    # Rejected by the circuit breaker: counted as a failure, not as a latency sample
+    store.record("chat", "fake", 0, now, 0.0, error_class="circuit_open")
+    store.record("summary", "fake", 1, now, 4.0, prompt_bytes=2048, returncode=1, error_class="quota")
+
+
+def check(label: str, row: dict, expected: dict) -> bool:
+    got = {k: row[k] for k in expected}
+    passed = got == expected
+    print(f"{'✅' if passed else '❌'} {label}: {got}")
+    return passed
+
+
+def test_summary_frame() -> bool:
+    """One row per operation; breaker rejections count as calls and failures only"""
+    print("🧪 Testing telemetry summary per operation")
+    with tempfile.TemporaryDirectory() as tmp:
+        store = core.QTelemetryStore(os.path.join(tmp, "q.sqlite3"))
+        record_calls(store, time.time())
+        rows = {r["Operation"]: r for r in store.summary_frame(days=7).to_dict("records")}
+        store._conn.close()
+    return sorted(rows) == ["chat", "summary"] and all([
+        check("chat", rows["chat"], {"Calls": 4, "p50 (s)": 2.0, "Max (s)": 3.0, "Failed %": 50.0,
+                                     "Timeout %": 25.0, "Quota %": 0.0, "Prompt KB (avg)": 0.8,
+                                     "Response KB (avg)": 0.2}),
+        check("summary", rows["summary"], {"Calls": 1, "p50 (s)": 4.0, "p99 (s)": 4.0, "Failed %": 100.0,
+                                           "Quota %": 100.0, "Prompt KB (avg)": 2.0}),
+    ])
+
+
+def test_daily_frame() -> bool:
+    """One row per day and operation, newest day first"""
+    print("🧪 Testing telemetry summary per day")
+    now = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = core.QTelemetryStore(os.path.join(tmp, "q.sqlite3"))
+        record_calls(store, now)
+        daily = store.daily_frame(days=30)
+        store._conn.close()
+    today, yesterday = (time.strftime("%Y-%m-%d", time.gmtime(t)) for t in (now, now - DAY))
+    keys = list(zip(daily["Day"], daily["Operation"]))
+    rows = daily.to_dict("records")
+    passed_keys = keys == [(today, "chat"), (today, "summary"), (yesterday, "chat")]
+    print(f"{'✅' if passed_keys else '❌'} rows: {keys}")
+    return passed_keys and all([
+        check(f"{today} chat", rows[0], {"Calls": 3, "p50 (s)": 2.5, "Failed %": 66.7}),
+        check(f"{yesterday} chat", rows[2], {"Calls": 1, "p90 (s)": 1.0, "Failed %": 0.0}),
+    ])
+
+
+if __name__ == "__main__":
+    results = [test_summary_frame(), test_daily_frame()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
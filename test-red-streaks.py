@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Test that the run-length encoded red-zone streaks match a plain per-customer
+loop over the months, including months a customer is absent or unscored
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+THRESHOLD = 42
+MONTHS = ["2025-05-06", "2025-06-06", "2025-07-06", "2025-08-06", "2025-09-06", "2025-10-06"]
+# Per month: a score, NaN (row without a score) or None (no row that month)
+HAND_BUILT = {
+    "Always red": [30, 31, 32, 33, 34, 35],
+    "Exit and re-enter": [30, 50, 30, 30, 50, 30],
+    "Gap ends spell": [30, 30, None, 30, 50, 60],
+    "Unscored ends spell": [30, np.nan, 30, 30, 30, np.nan],
+    "Never red": [50, 60, None, 70, np.nan, 45],
+    "Red once at start": [41.9, 42, 42, None, None, None],
+    "Red at the end": [None, None, 50, np.nan, 41, 40],
+}
+
+
+def random_customers(count: int, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    customers = {}
+    for i in range(count):
+        scores = rng.choice([30.0, 41.9, 42.0, 55.0, np.nan, None], size=len(MONTHS), p=[.3, .1, .1, .3, .1, .1])
+        customers[f"Random {i:03d}"] = list(scores)
+    return customers
+
+
+def month_bitsets(customers: dict, dictionary: core.CustomerDictionary) -> core.MonthBitsets:
+    frames = []
+    for m in range(len(MONTHS)):
+        rows = [(name, scores[m]) for name, scores in customers.items() if scores[m] is not None]
+        frames.append(pd.DataFrame({"Customer": [name for name, _ in rows], "Overall Score": 60.0,
+                                    "Security Score": np.array([score for _, score in rows], dtype=float)}))
+    ids = [dictionary.encode(df["Customer"]) for df in frames]
+    return core.build_month_bitsets(*frames, *ids, sheets=MONTHS, col_overall="Overall Score", threshold=THRESHOLD)
+
+
+def reference_streaks(customers: dict) -> tuple:
+    """Plain loop: (table indexed by customer, median months to exit)"""
+    rows, exit_lengths = {}, []
+    for name, scores in customers.items():
+        spells, run = [], 0
+        for score in scores:
+            scored = score is not None and not np.isnan(score)
+            if scored and score < THRESHOLD:
+                run += 1
+                continue
+            if run:
+                spells.append((run, scored))    # a scored month at or above the threshold is an exit
+            run = 0
+        if run:
+            spells.append((run, False))
+        if not spells:
+            continue
+        exits = [length for length, exited in spells if exited]
+        exit_lengths += exits
+        rows[name] = {"Current Streak": run, "Longest Streak": max(length for length, _ in spells),
+                      "Red Months": sum(length for length, _ in spells), "Re-entries": len(spells) - 1,
+                      "Exits": len(exits), "Median Months to Exit": float(np.median(exits)) if exits else np.nan}
+    median = float(np.median(exit_lengths)) if exit_lengths else np.nan
+    return pd.DataFrame.from_dict(rows, orient="index").sort_index(), median
+
+
+def check(label: str, customers: dict) -> bool:
+    dictionary = core.CustomerDictionary()
+    streaks = core.compute_red_streaks(month_bitsets(customers, dictionary), "Customer", dictionary)
+    expected, median = reference_streaks(customers)
+    got = streaks.table.set_index("Customer").sort_index()
+    got.index = got.index.astype(object)
+    same_table = got.astype(float).equals(expected[got.columns].astype(float))
+    same_median = np.array_equal([median], [streaks.median_months_to_exit], equal_nan=True)
+    passed = same_table and same_median
+    print(f"{'✅' if passed else '❌'} {label}: {len(got)} customers ever red, "
+          f"median months to exit {streaks.median_months_to_exit}")
+    if not same_table:
+        print(pd.concat({"rle": got, "loop": expected}, axis=1).to_string())
+    return passed
+
+
+def test_hand_built() -> bool:
+    """Spells broken by exits, absent months and unscored months"""
+    print("🧪 Testing red-zone streaks on hand-built customers")
+    passed = check("hand-built", HAND_BUILT)
+    dictionary = core.CustomerDictionary()
+    table = core.compute_red_streaks(month_bitsets(HAND_BUILT, dictionary), "Customer", dictionary).table
+    row = table.set_index("Customer").loc["Unscored ends spell"]
+    # Two spells (months 1 and 3-5), neither ended by a scored month
+    spelled = (row["Re-entries"], row["Exits"], row["Current Streak"]) == (1, 0, 0)
+    print(f"{'✅' if spelled else '❌'} unscored months end a spell without an exit")
+    return passed and spelled
+
+
+def test_random() -> bool:
+    print("🧪 Testing red-zone streaks on random customers")
+    return all(check(f"seed {seed}", random_customers(200, seed)) for seed in range(3))
+
+
+if __name__ == "__main__":
+    results = [test_hand_built(), test_random()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
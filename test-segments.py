@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Test that the per-segment counts of analyze_segments() (np.bincount over the
+whole frame) and the per-segment export sheets match classify() and
+calculate_low_score_metrics() run on each segment separately
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+THRESHOLD = 42
+COLS = dict(col_prev="__prev__", col_curr="__curr__", col_overall="Overall Score")
+MONTHS = ["2025-09-06", "2025-10-06"]
+
+
+def work_frame(seed: int) -> pd.DataFrame:
+    """Compared customers with blank regions, missing scores and scores on the threshold"""
+    rng = np.random.default_rng(seed)
+    n = 120
+    scores = lambda: rng.choice([30.0, 41.9, 42.0, 55.0, np.nan], size=n, p=[.3, .1, .1, .35, .15])
+    return pd.DataFrame({
+        "Customer": [f"Customer {i:03d}" for i in range(n)],
+        "Region": rng.choice(np.array(["AMER", "APJ", "EMEA", None], dtype=object), size=n),
+        "Overall Score": np.where(rng.random(n) < 0.2, np.nan, 60.0),
+        "__prev__": scores(),
+        "__curr__": scores(),
+    })
+
+
+def month_bitsets(work: pd.DataFrame, dictionary: core.CustomerDictionary) -> core.MonthBitsets:
+    """Two months of the compared customers plus a few customers outside the working frame"""
+    frames = [pd.DataFrame({"Customer": [*work["Customer"], "Outsider 1", "Outsider 2"],
+                            "Overall Score": 60.0, "Security Score": [*work[col], 30.0, 50.0]})
+              for col in ("__prev__", "__curr__")]
+    ids = [dictionary.encode(df["Customer"]) for df in frames]
+    return core.build_month_bitsets(*frames, *ids, sheets=MONTHS, col_overall="Overall Score", threshold=THRESHOLD)
+
+
+def reference_matrix(work: pd.DataFrame) -> pd.DataFrame:
+    """classify() and calculate_low_score_metrics() per segment, via groupby"""
+    rows = {}
+    for label, group in work.groupby(work["Region"].fillna(core.SEGMENT_BLANK)):
+        tables = core.classify(group, threshold=THRESHOLD, **COLS)
+        metrics = core.calculate_low_score_metrics(group, "__prev__", "__curr__", THRESHOLD)
+        rows[label] = {"Customers": len(group), **{name: len(df) for name, df in tables.items()},
+                       "Prev Low Score": metrics["prev_month_low_total"],
+                       "Curr Low Score": metrics["curr_month_low_total"],
+                       "Improvement": metrics["improvement_count"]}
+    return pd.DataFrame.from_dict(rows, orient="index").sort_index()
+
+
+def check(seed: int) -> bool:
+    work = work_frame(seed)
+    dictionary = core.CustomerDictionary()
+    bits = month_bitsets(work, dictionary)
+    segments = core.analyze_segments(work, bits, "Customer", "Region", threshold=THRESHOLD, dictionary=dictionary,
+                                     **COLS)
+    expected = reference_matrix(work)
+    got = segments.matrix.set_index("Region").sort_index()[expected.columns]
+    same_matrix = got.astype(int).equals(expected.astype(int))
+
+    # Trends: red customers per month and segment; the red outsider counts as not compared
+    regions = work["Region"].fillna(core.SEGMENT_BLANK)
+    expected_trends = pd.DataFrame({month: regions[work[col] < THRESHOLD].value_counts()
+                                    for month, col in zip(MONTHS, ("__prev__", "__curr__"))}).T
+    expected_trends = expected_trends.reindex(columns=segments.trends.columns).fillna(0)
+    expected_trends[core.SEGMENT_OTHER] = 1
+    trends_ok = (list(segments.trends.columns) == [*sorted(regions.unique()), core.SEGMENT_OTHER]
+                 and np.array_equal(segments.trends.to_numpy(), expected_trends.to_numpy()))
+
+    # Export sheets: each segment's categorized rows, matching classify() on the whole frame
+    tables = core.classify(work, threshold=THRESHOLD, **COLS)
+    sheets = core.segment_sheets(tables, segments)
+    sheet_rows = {name[len("Seg "):]: len(df) for name, df in sheets.items()}
+    expected_rows = pd.concat(tables.values())["Region"].fillna(core.SEGMENT_BLANK).value_counts()
+    sheets_ok = sheet_rows == expected_rows.reindex(list(sheet_rows), fill_value=0).to_dict()
+
+    passed = same_matrix and trends_ok and sheets_ok
+    print(f"{'✅' if passed else '❌'} seed {seed}: matrix={same_matrix} trends={trends_ok} sheets={sheets_ok} "
+          f"segments={list(got.index)}")
+    if not same_matrix:
+        print(pd.concat({"bincount": got, "groupby": expected}, axis=1).to_string())
+    return passed
+
+
+def test_segments_match_groupby() -> bool:
+    print("🧪 Testing segment counts against per-segment classify()")
+    return all(check(seed) for seed in range(3))
+
+
+if __name__ == "__main__":
+    results = [test_segments_match_groupby()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Test that top movers rank gains only among rising scores and drops only among
+falling scores, with each side clamped to the customers available
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add current directory to import the analysis core
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_analysis_core as core
+
+
+def work(prev, curr) -> pd.DataFrame:
+    return pd.DataFrame({"Customer": [f"C{i}" for i in range(len(prev))], "Overall Score": 60.0,
+                         "__prev__": prev, "__curr__": curr})
+
+
+def movers(prev, curr, k: int) -> core.TopMovers:
+    return core.find_top_movers(work(prev, curr), "Customer", "__prev__", "__curr__", "Overall Score", k=k)
+
+
+def check(label: str, result: core.TopMovers, improvers: list, decliners: list, compared: int) -> bool:
+    got = (list(result.improvers["Customer"]), list(result.decliners["Customer"]), result.compared)
+    passed = got == (improvers, decliners, compared)
+    print(f"{'✅' if passed else '❌'} {label}: improvers={got[0]} decliners={got[1]} compared={got[2]}")
+    return passed
+
+
+def test_all_negative() -> bool:
+    """Every score fell: no improvers, decliners clamped to the three customers"""
+    print("🧪 Testing all-negative deltas")
+    return check("prev 50/60/70 -> curr 40/55/65", movers([50, 60, 70], [40, 55, 65], k=5),
+                 [], ["C0", "C1", "C2"], 3)
+
+
+def test_mixed() -> bool:
+    """Gains and drops are split by sign; unchanged and unscored customers appear on neither side"""
+    print("🧪 Testing mixed deltas")
+    prev = [50, 60, 70, 40, 45, np.nan, 30]
+    curr = [40, 55, 75, 40, 60, 50, 31]
+    return all([
+        check("k=5", movers(prev, curr, k=5), ["C4", "C2", "C6"], ["C0", "C1"], 6),
+        check("k=1", movers(prev, curr, k=1), ["C4"], ["C0"], 6),
+    ])
+
+
+if __name__ == "__main__":
+    results = [test_all_negative(), test_mixed()]
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)
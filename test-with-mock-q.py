@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Test the AI summary and chat path against the local fake LLM backend.
+
+No Amazon Q CLI or login is needed. The fake backend is deterministic and
+has configurable latency, failure rate and output size, so this script also
+works as a small offline load test:
+
+    python test-with-mock-q.py                      # functional checks
+    python test-with-mock-q.py --calls 200 --workers 8 --latency 0.05 --failure-rate 0.1
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Add current directory to import the analyzer module
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import chi_low_security_score_analyzer as analyzer
+
+ANALYSIS_DATA = {
+    'exit_from_red': 5,
+    'return_back_red': 3,
+    'new_comer_red': 2,
+    'missing_from_chi': 1,
+    'total_customers': 11,
+    'prev_month_low_total': 8,
+    'curr_month_low_total': 5,
+    'low_score_improvement_count': 3,
+    'low_score_improvement_pct': 37.5
+}
+
+
+def test_summary_and_chat() -> bool:
+    """Summary generation and chat succeed and are deterministic"""
+    print("🧪 Testing summary and chat with fake backend")
+    analyzer.set_llm_backend(analyzer.FakeLLMBackend(latency=0.0, output_chars=800))
+
+    ok1, summary1 = analyzer.generate_ai_summary(ANALYSIS_DATA)
+    ok2, summary2 = analyzer.generate_ai_summary(ANALYSIS_DATA)
+    chat_ok, answer = analyzer.chat_with_amazon_q("Make it shorter", context=summary1)
+
+    passed = ok1 and ok2 and chat_ok and summary1 == summary2 and len(summary1) >= 800
+    print(f"{'✅' if passed else '❌'} summary={ok1}/{ok2} deterministic={summary1 == summary2} "
+          f"chat={chat_ok} length={len(summary1)}")
+    return passed
+
+
+def test_retry_and_breaker() -> bool:
+    """Always-failing backend trips the circuit breaker, which then fails fast"""
+    print("🧪 Testing retries and circuit breaker with fake backend")
+    analyzer._Q_BACKOFF_BASE = 0.01
+    backend = analyzer.FakeLLMBackend(latency=0.0, failure_rate=1.0)
+    analyzer.set_llm_backend(backend)
+
+    for _ in range(3):
+        analyzer.chat_with_amazon_q("hello")
+    calls_before = backend.calls
+    ok, message = analyzer.chat_with_amazon_q("hello")
+    state = analyzer.get_amazon_q_breaker_status()['state']
+
+    passed = not ok and state == 'open' and backend.calls == calls_before
+    print(f"{'✅' if passed else '❌'} breaker={state} fail_fast={backend.calls == calls_before} message={message[:60]}")
+    analyzer.reset_amazon_q_breaker()
+    return passed
+
+
+def test_breaker_neutral_and_probe() -> bool:
+    """Non-transient errors do not reset the failure count; half-open admits a single trial call"""
+    print("🧪 Testing breaker neutral outcomes and the half-open trial call")
+    analyzer.reset_amazon_q_breaker()
+    analyzer._Q_CALL_POLICIES['probe'] = {'timeout': 5, 'deadline': 5, 'attempts': 1, 'use_breaker': True}
+    transient = subprocess.CompletedProcess([], 1, "", "connection reset")
+    auth_error = subprocess.CompletedProcess([], 1, "", "not logged in")
+    analyzer._amazon_q_breaker['failure_threshold'] = 3
+    for result in (transient, auth_error, transient):
+        analyzer.call_with_policy('probe', lambda timeout, result=result: result)
+    neutral_ok = analyzer.get_amazon_q_breaker_status()['failures'] == 2
+
+    # Open the breaker with its reset timeout already passed
+    analyzer.call_with_policy('probe', lambda timeout: transient)
+    analyzer._amazon_q_breaker['opened_at'] = 0
+    in_probe, release = threading.Event(), threading.Event()
+
+    def slow_success(timeout):
+        in_probe.set()
+        release.wait(5)
+        return subprocess.CompletedProcess([], 0, "ok", "")
+
+    probe = threading.Thread(target=analyzer.call_with_policy, args=('probe', slow_success))
+    probe.start()
+    in_probe.wait(5)
+    try:
+        analyzer.call_with_policy('probe', slow_success)
+        second_rejected = False
+    except analyzer.AmazonQCircuitOpenError:
+        second_rejected = True
+    release.set()
+    probe.join()
+    state = analyzer.get_amazon_q_breaker_status()['state']
+
+    passed = neutral_ok and second_rejected and state == 'closed'
+    print(f"{'✅' if passed else '❌'} neutral={neutral_ok} single_probe={second_rejected} breaker={state}")
+    analyzer.reset_amazon_q_breaker()
+    return passed
+
+
+def load_test(calls: int, workers: int, latency: float, failure_rate: float, output_chars: int):
+    """Fire `calls` chat requests from `workers` threads and report latency percentiles"""
+    print(f"🧪 Load test: {calls} calls, {workers} workers, latency={latency}s, failure_rate={failure_rate}")
+    analyzer._Q_BACKOFF_BASE = 0.01
+    analyzer.set_llm_backend(analyzer.FakeLLMBackend(latency=latency, failure_rate=failure_rate,
+                                                     output_chars=output_chars, seed=42))
+    # Keep the breaker out of the way so every call is measured
+    analyzer._amazon_q_breaker['failure_threshold'] = calls + 1
+
+    def one_call(i: int):
+        start = time.perf_counter()
+        ok, _ = analyzer.chat_with_amazon_q(f"Question {i}", context="CHI Analysis context")
+        return ok, time.perf_counter() - start
+
+    wall_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(one_call, range(calls)))
+    wall = time.perf_counter() - wall_start
+
+    durations = sorted(d for _, d in results)
+    successes = sum(1 for ok, _ in results if ok)
+    p95 = durations[int(len(durations) * 0.95) - 1] if durations else 0
+    print(f"   success rate: {successes / calls * 100:.1f}%")
+    print(f"   p50: {statistics.median(durations) * 1000:.1f} ms, p95: {p95 * 1000:.1f} ms")
+    print(f"   throughput: {calls / wall:.1f} calls/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=0, help="number of chat calls for the load test (0 = skip)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--output-chars", type=int, default=1200)
+    args = parser.parse_args()
+
+    results = [test_summary_and_chat(), test_retry_and_breaker(), test_breaker_neutral_and_probe()]
+    if args.calls:
+        load_test(args.calls, args.workers, args.latency, args.failure_rate, args.output_chars)
+
+    print("=" * 60)
+    print(f"{'✅ All tests passed' if all(results) else '❌ Some tests failed'}")
+    sys.exit(0 if all(results) else 1)